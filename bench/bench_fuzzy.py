@@ -0,0 +1,85 @@
+"""Benchmark de la búsqueda tolerante a errores de tipeo (GET /products/search).
+
+Sobre un catálogo sintético de `--rows` productos mide, para consultas con y sin
+errores de tipeo, cuántos resultados devolvía la búsqueda anterior (LIKE
+'%término%' en SQLite) y cuántos devuelve ProductSearchIndex, y el tiempo por
+consulta de cada una: el LIKE, la búsqueda aproximada con el cache de palabras
+frío (primera vez que se ve cada palabra) y caliente. También informa el tiempo
+de construir el índice, que se paga una vez por versión de catálogo.
+
+Uso:
+    python bench/bench_fuzzy.py [--rows 100000] [--repeat 2000]
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bench.catalog import temp_database  # noqa: E402
+
+QUERIES = [
+    "camiseta",
+    "pantalon negro",
+    "remra",
+    "pantalon negr",
+    "remeras rojas",
+    "chaketa gris xl",
+    "sudadra azul talle m",
+    "pantalones blancos",
+    "campera",
+    "zapatillas",
+]
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=2000, help="Consultas por medición de la búsqueda aproximada")
+    parser.add_argument("--like-repeat", type=int, default=5, help="Consultas por medición del LIKE")
+    args = parser.parse_args()
+
+    temp_database("fuzzy.db", rows=args.rows, log_level="WARNING")
+
+    import main
+
+    index = main.product_search_index
+    main.facet_index._current()
+    start = time.perf_counter()
+    snapshot = index._current()
+    build_ms = (time.perf_counter() - start) * 1000
+    stats = index.snapshot()
+    print(f"Productos: {args.rows}  grupos: {stats['groups']}  vocabulario: {stats['vocabulary']}  "
+          f"construcción del índice: {build_ms:.1f}ms")
+
+    conn = main.get_db_connection()
+
+    def like(query):
+        return conn.execute(
+            f"SELECT {main.PRODUCT_COLUMNS} FROM products WHERE name LIKE ? OR description LIKE ?",
+            (f"%{query}%", f"%{query}%")
+        ).fetchall()
+
+    def cold(query):
+        snapshot["resolved"].clear()
+        return index.search(query)
+
+    print(f"\n{'consulta':24}{'LIKE filas':>11}{'LIKE ms':>10}{'aprox. total':>14}"
+          f"{'frío µs':>10}{'caliente µs':>13}  interpretación")
+    for query in QUERIES:
+        like_rows = len(like(query))
+        like_ms = min(timeit.repeat(lambda: like(query), number=args.like_repeat, repeat=3)) / args.like_repeat * 1000
+        result = index.search(query)
+        cold_us = min(timeit.repeat(lambda: cold(query), number=args.repeat, repeat=3)) / args.repeat * 1e6
+        warm_us = min(timeit.repeat(lambda: index.search(query), number=args.repeat, repeat=3)) / args.repeat * 1e6
+        terms = " ".join(label or "?" for label in result["terms"].values())
+        print(f"{query:24}{like_rows:>11}{like_ms:>10.2f}{result['total']:>14}"
+              f"{cold_us:>10.1f}{warm_us:>13.1f}  {terms}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,93 @@
+"""Benchmark del costo de logging por mensaje en el hilo que atiende el request.
+
+Compara los print() síncronos anteriores (mensaje, respuesta completa y debug
+de extracción por regex) con StructuredLogger, que encola los registros y los
+escribe en JSON desde un thread en segundo plano. Ambos escriben a un pipe
+consumido por otro thread, como el stdout de un contenedor leído por el
+colector de logs.
+
+Uso:
+    python bench/bench_logging.py [--messages 20000]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.catalog import temp_database  # noqa: E402
+
+temp_database()
+
+import main  # noqa: E402
+
+MESSAGE = "quiero 2 del producto 15 y 1 del producto 8"
+RESPONSE = "🛍️ *PRODUCTOS DISPONIBLES:*\n\n" + "🔸 *Camiseta S Negro*\n   💰 $1292.00\n   📦 Stock: 457\n\n" * 10
+PRODUCTS = [{"product_id": 15, "qty": 2}, {"product_id": 8, "qty": 1}]
+
+
+def pipe_sink():
+    """Stream de escritura sobre un pipe que otro thread va vaciando"""
+    read_fd, write_fd = os.pipe()
+
+    def drain():
+        while True:
+            data = os.read(read_fd, 65536)
+            if not data:
+                return
+
+    threading.Thread(target=drain, daemon=True).start()
+    # Sin buffer de línea, como stdout con PYTHONUNBUFFERED en el contenedor
+    return os.fdopen(write_fd, "w", encoding="utf-8", buffering=1)
+
+
+def legacy_turn(out, from_number):
+    print(f"📱 Mensaje de {from_number}: {MESSAGE}", file=out, flush=True)
+    print(f"🔍 Productos extraídos del mensaje '{MESSAGE}': {PRODUCTS}", file=out, flush=True)
+    print(f"🤖 Respuesta AI: {RESPONSE}", file=out, flush=True)
+    print(f"✅ Mensaje enviado a {from_number}", file=out, flush=True)
+
+
+def structured_turn(logger, from_number):
+    logger.info("📱 Mensaje recibido", channel="whatsapp", sender=from_number, chars=len(MESSAGE), text=main.preview(MESSAGE))
+    logger.debug("🔍 Productos extraídos del mensaje", message=main.preview(MESSAGE), products=PRODUCTS)
+    logger.info("🤖 Respuesta AI", chars=len(RESPONSE))
+    logger.info("✅ Mensaje enviado", to=from_number)
+
+
+def timed(turn, messages):
+    latencies = []
+    for i in range(messages):
+        start = time.perf_counter()
+        turn(f"54911{i:06d}")
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return sum(latencies) / messages, latencies[int(messages * 0.99) - 1]
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    out = pipe_sink()
+    legacy = timed(lambda number: legacy_turn(out, number), args.messages)
+
+    # DEBUG habilitado para incluir el muestreo de las líneas de alto volumen
+    logger = main.StructuredLogger(
+        "bench", level="DEBUG", stream=pipe_sink(),
+        sample_rates={main.StructuredLogger.LEVELS["DEBUG"]: 0.01}
+    )
+    structured = timed(lambda number: structured_turn(logger, number), args.messages)
+    logger.close(timeout=30)
+
+    print(f"Mensajes: {args.messages}")
+    print(f"{'':24}{'media µs':>10}{'p99 µs':>10}")
+    print(f"{'print() síncrono':24}{legacy[0] * 1e6:>10.2f}{legacy[1] * 1e6:>10.2f}")
+    print(f"{'StructuredLogger':24}{structured[0] * 1e6:>10.2f}{structured[1] * 1e6:>10.2f}")
+    print(f"Reducción media: {(1 - structured[0] / legacy[0]) * 100:.1f} %")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,131 @@
+"""Benchmark del outbox de WhatsApp contra el stub local de la Graph API.
+
+Encola `--messages` mensajes repartidos entre `--recipients` destinatarios y
+mide cuántos mensajes por segundo sostiene OutboundSender hasta vaciar la cola,
+para cada tamaño del pool (`--workers 1,4,16`). Como referencia mide también el
+envío anterior: un POST sincrónico por mensaje, uno detrás de otro.
+
+Con `--graph-error-rate` el stub responde 429/503 a una fracción de los
+requests y se ven los reintentos; `--mps` es el límite global de la Graph API
+(1000 por defecto, el tier más alto, para medir el pool y no el limitador).
+
+Uso:
+    python bench/bench_outbox.py [--messages 2000] [--recipients 500] [--workers 1,4,16]
+                                 [--graph-latency-ms 50] [--graph-error-rate 0.05] [--mps 80]
+"""
+import argparse
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bench.catalog import temp_database  # noqa: E402
+from bench.stubs import StubServer  # noqa: E402
+
+
+def sequential_send(main, recipients, messages):
+    """El camino anterior: un requests.post sin sesión ni reintentos por mensaje"""
+    import requests
+    url = f"{main.WHATSAPP_API_URL}/{os.environ['WHATSAPP_PHONE_NUMBER_ID']}/messages"
+    headers = {"Authorization": f"Bearer {os.environ['WHATSAPP_TOKEN']}", "Content-Type": "application/json"}
+    start = time.perf_counter()
+    delivered = 0
+    for index in range(messages):
+        data = {"messaging_product": "whatsapp", "to": recipients[index % len(recipients)],
+                "type": "text", "text": {"body": f"Mensaje {index}"}}
+        delivered += requests.post(url, headers=headers, json=data).status_code == 200
+    return delivered, time.perf_counter() - start
+
+
+def drain(main, sender, recipients, messages, timeout):
+    """Encola todos los mensajes y espera a que no quede nada pendiente"""
+    conn = main.get_db_connection()
+    conn.execute("DELETE FROM outbox")
+    conn.commit()
+
+    start = time.perf_counter()
+    for index in range(messages):
+        sender.enqueue(recipients[index % len(recipients)], f"Mensaje {index}")
+    enqueued = time.perf_counter() - start
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pending = conn.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+        if not pending:
+            break
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - start
+
+    latencies = [row[0] for row in conn.execute(
+        "SELECT finished_at - created_at FROM outbox WHERE status = 'sent' ORDER BY 1")]
+    statuses = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+    conn.close()
+    return enqueued, elapsed, latencies, statuses
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=500)
+    parser.add_argument("--workers", default="1,4,16", help="Tamaños de pool a medir, separados por coma")
+    parser.add_argument("--graph-latency-ms", type=float, default=50.0)
+    parser.add_argument("--graph-error-rate", type=float, default=0.0)
+    parser.add_argument("--mps", type=float, default=1000.0, help="Límite global de mensajes por segundo")
+    parser.add_argument("--baseline-messages", type=int, default=200,
+                        help="Mensajes para medir el envío sincrónico anterior (0 para omitirlo)")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    stub = StubServer(latency_ms={"graph": args.graph_latency_ms},
+                      error_rate={"graph": args.graph_error_rate}).start()
+    os.environ.update(stub.app_env())
+    temp_database("outbox.db", log_level="ERROR")
+
+    import main
+
+    recipients = [f"54911{index:08d}" for index in range(args.recipients)]
+    print(f"Mensajes: {args.messages}  destinatarios: {args.recipients}  "
+          f"latencia Graph: {args.graph_latency_ms:.0f}ms  errores: {args.graph_error_rate:.0%}  "
+          f"límite global: {args.mps:.0f} msg/s")
+    print(f"\n{'modo':28}{'msg/s':>10}{'encolar ms/msg':>16}{'p50 s':>9}{'p95 s':>9}"
+          f"{'reintentos':>12}{'fallidos':>10}")
+
+    if args.baseline_messages:
+        delivered, elapsed = sequential_send(main, recipients, args.baseline_messages)
+        print(f"{'envío sincrónico (anterior)':28}{delivered / elapsed:>10.1f}{'-':>16}{'-':>9}{'-':>9}"
+              f"{'-':>12}{args.baseline_messages - delivered:>10}")
+
+    for workers in [int(count) for count in args.workers.split(",") if count.strip()]:
+        sender = main.OutboundSender(
+            workers=workers,
+            batch_size=main.OUTBOX_BATCH_SIZE,
+            max_attempts=main.OUTBOX_MAX_ATTEMPTS,
+            lease_seconds=main.OUTBOX_LEASE_SECONDS,
+            messages_per_second=args.mps,
+            recipient_messages_per_second=main.WHATSAPP_RECIPIENT_MPS,
+            recipient_burst=main.WHATSAPP_RECIPIENT_BURST,
+            backoff_base=0.1,
+            backoff_max=2.0,
+        )
+        enqueued, elapsed, latencies, statuses = drain(main, sender, recipients, args.messages, args.timeout)
+        sender.stop()
+        stats = sender.snapshot()["processed"]
+        sent = statuses.get("sent", 0)
+        print(f"{f'outbox · {workers} hilos':28}{sent / elapsed:>10.1f}{enqueued / args.messages * 1000:>16.3f}"
+              f"{percentile(latencies, 0.5):>9.2f}{percentile(latencies, 0.95):>9.2f}"
+              f"{stats['retried']:>12}{statuses.get('failed', 0):>10}")
+        if statuses.get("pending") or statuses.get("sending"):
+            print(f"  ⚠️ quedaron mensajes sin enviar tras {args.timeout:.0f}s: {statuses}")
+
+    print(f"\nStub Graph API: {stub.stats()['graph']}")
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main_()
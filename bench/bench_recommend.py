@@ -0,0 +1,91 @@
+"""Benchmark del índice de recomendaciones (GET /products/recommend).
+
+Sobre un catálogo sintético de `--rows` productos mide:
+
+- la construcción completa del índice TF-IDF y la actualización incremental
+  después de cambiar la descripción de `--changed` productos (solo se vectorizan
+  los textos nuevos);
+- el tiempo por consulta (expansión de conceptos + producto matriz-vector + top-k);
+- la precisión de los `--k` productos que recibe el modelo para pedidos abiertos:
+  los primeros del catálogo (lo que mandaba antes ACCION:get_products) contra
+  los recomendados.
+
+Uso:
+    python bench/bench_recommend.py [--rows 100000] [--k 5] [--changed 1000]
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bench.catalog import temp_database  # noqa: E402
+
+# Pedido abierto -> qué productos le sirven (para medir precisión)
+QUERIES = [
+    ("algo para el verano", lambda p: "ligera" in p["description"] or p["product_type"] in ("Camiseta", "Falda")),
+    ("ropa para ir al gimnasio", lambda p: p["category"] == "Deportivo"),
+    ("algo elegante para una fiesta", lambda p: p["category"] == "Formal" or "elegante" in p["description"]),
+    ("algo abrigado para el frío", lambda p: p["product_type"] in ("Chaqueta", "Sudadera")),
+    ("qué me pongo para la oficina", lambda p: p["category"] == "Formal"),
+    ("regalo para mi papá", lambda p: "calidad" in p["description"] or "elegante" in p["description"]),
+    ("remeras negras cómodas", lambda p: p["product_type"] == "Camiseta" and p["color"] == "Negro"),
+]
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--changed", type=int, default=1000, help="Productos con descripción nueva para la actualización incremental")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    temp_database("recommend.db", rows=args.rows, log_level="WARNING")
+
+    import main
+
+    recommender = main.product_recommender
+    main.facet_index._current()
+    start = time.perf_counter()
+    recommender._current()
+    build_ms = (time.perf_counter() - start) * 1000
+    stats = recommender.snapshot()
+    print(f"Productos: {args.rows}  textos distintos: {stats['texts']}  vocabulario: {stats['vocabulary']}")
+    print(f"Construcción completa: {build_ms:.1f}ms")
+
+    # Cambiar descripciones y medir la actualización incremental (sin contar el índice de facetas)
+    conn = main.get_db_connection()
+    conn.executemany(
+        "UPDATE products SET description = ? WHERE id = ?",
+        [(f"Casual - Edición limitada {product_id % 50}.", product_id)
+         for product_id in range(1, args.rows + 1, max(args.rows // args.changed, 1))][:args.changed]
+    )
+    conn.commit()
+    conn.close()
+    main.bump_catalog_version()
+    main.facet_index._current()
+    before = recommender.vectorized
+    start = time.perf_counter()
+    recommender._current()
+    update_ms = (time.perf_counter() - start) * 1000
+    print(f"Actualización incremental ({args.changed} productos cambiados, "
+          f"{recommender.vectorized - before} textos vectorizados): {update_ms:.1f}ms")
+
+    catalog = main.facet_index.search(limit=args.k)
+    print(f"\n{'pedido':34}{'µs':>9}{'antes p@k':>11}{'ahora p@k':>11}  recomendados")
+    for query, relevant in QUERIES:
+        seconds = min(timeit.repeat(lambda: recommender.recommend(query, args.k), number=args.repeat, repeat=3))
+        result = recommender.recommend(query, args.k)
+        products = result["products"]
+        before_precision = sum(map(relevant, catalog)) / len(catalog)
+        after_precision = sum(map(relevant, products)) / len(products) if products else 0.0
+        names = ", ".join(product["name"] for product in products[:3])
+        print(f"{query:34}{seconds / args.repeat * 1e6:>9.0f}{before_precision:>11.2f}{after_precision:>11.2f}  {names}")
+
+
+if __name__ == "__main__":
+    main_()
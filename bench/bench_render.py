@@ -0,0 +1,83 @@
+"""Benchmark del renderizado de mensajes de productos.
+
+Compara el armado anterior (concatenación con `+=` y formato de cada producto
+en cada llamada) con ProductRenderer (snippets precalculados por versión de
+catálogo y `join`), para listas de 10, 100 y 1000 productos.
+
+Uso:
+    python bench/bench_render.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.catalog import temp_database  # noqa: E402
+
+temp_database()
+
+from main import ProductRenderer, WHATSAPP_MAX_BODY, split_message  # noqa: E402
+
+TIPOS = ["Camisa", "Camiseta", "Chaqueta", "Falda", "Pantalón", "Sudadera"]
+TALLAS = ["S", "M", "L", "XL", "XXL"]
+COLORES = ["Amarillo", "Azul", "Blanco", "Gris", "Negro", "Rojo", "Verde"]
+CATEGORIAS = ["Casual", "Deportivo", "Formal"]
+
+
+def synthetic_products(count):
+    rng = random.Random(42)
+    return [
+        {
+            "id": i,
+            "name": f"{rng.choice(TIPOS)} {rng.choice(TALLAS)} {rng.choice(COLORES)}",
+            "description": "Prenda cómoda y ligera.",
+            "price": float(rng.randint(300, 1500)),
+            "stock": rng.randint(0, 500),
+            "category": rng.choice(CATEGORIAS),
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def legacy_render(products, search_query=None):
+    """Implementación anterior de _format_products_response (sin tope de items)"""
+    if search_query:
+        result = f"🔍 *RESULTADOS PARA '{search_query.upper()}'*\n\n"
+    else:
+        result = "🛍️ *PRODUCTOS DISPONIBLES:*\n\n"
+
+    for product in products:
+        result += f"🔸 *{product['name']}*\n"
+        result += f"   💰 ${product['price']:.2f}\n"
+        result += f"   📦 Stock: {product['stock']}\n"
+        result += f"   🏷️ {product['category']}\n"
+        result += f"   ID: {product['id']}\n\n"
+
+    result += "💡 *¿Necesitas más detalles de algún producto específico?*"
+    return result
+
+
+def main():
+    renderer = ProductRenderer()
+    print(f"{'items':>6} {'legacy (µs)':>12} {'renderer (µs)':>14} {'speedup':>8} {'mensajes':>9}")
+    for count in (10, 100, 1000):
+        products = synthetic_products(count)
+        renderer.render_products(products, max_items=None)  # precalienta los snippets
+
+        number = max(10, 20000 // count)
+        legacy = min(timeit.repeat(lambda: legacy_render(products), number=number, repeat=5)) / number
+        current = min(timeit.repeat(
+            lambda: split_message(renderer.render_products(products, max_items=None), WHATSAPP_MAX_BODY),
+            number=number, repeat=5
+        )) / number
+
+        messages = split_message(renderer.render_products(products, max_items=None), WHATSAPP_MAX_BODY)
+        assert all(len(m) <= WHATSAPP_MAX_BODY for m in messages)
+        print(f"{count:>6} {legacy * 1e6:>12.1f} {current * 1e6:>14.1f} {legacy / current:>7.2f}x {len(messages):>9}")
+
+    print(f"\nCache de snippets: {renderer.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Simula meses de tráfico de carritos con y sin la retención de carritos.
+
+Cada día simulado se crean `--carts-per-day` carritos (una parte se actualiza
+el mismo día) y, con retención, se ejecuta una pasada de CartRetention con el
+reloj simulado. Cada `--report-every` días se imprime el tamaño del archivo de
+la BD, las filas de carts y carts_archive, y la latencia de buscar un carrito
+por id y de insertar uno nuevo.
+
+Uso:
+    python bench/bench_retention.py [--days 120] [--carts-per-day 2000]
+                                    [--expiry-days 7] [--archive-days 30]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.catalog import temp_database  # noqa: E402
+
+temp_database(log_level="WARNING")
+
+import main  # noqa: E402
+
+
+def cart_items(rng, products):
+    chosen = rng.sample(products, 3)
+    return json.dumps([{"product_id": p[0], "name": p[1], "price": p[2], "qty": rng.randint(1, 5)} for p in chosen])
+
+
+def simulate_day(conn, rng, products, day_start, carts_per_day, update_ratio):
+    rows = []
+    for _ in range(carts_per_day):
+        created = day_start + timedelta(seconds=rng.randint(0, 86399))
+        items = cart_items(rng, products)
+        rows.append((items, 100.0, 3, created.isoformat(), created.isoformat()))
+    conn.executemany(
+        "INSERT INTO carts (items, total_amount, total_items, created_at, updated_at) VALUES (?, ?, ?, ?, ?)", rows
+    )
+    # Parte de los carritos se actualiza más tarde el mismo día
+    first_id = conn.execute("SELECT MAX(id) FROM carts").fetchone()[0] - carts_per_day + 1
+    updated = [((day_start + timedelta(hours=23)).isoformat(), first_id + offset)
+               for offset in rng.sample(range(carts_per_day), int(carts_per_day * update_ratio))]
+    conn.executemany("UPDATE carts SET updated_at = ? WHERE id = ?", updated)
+    conn.commit()
+
+
+def measure(conn, rng, day_start, samples=300):
+    """Latencia media (ms) de GET /carts/{id} sobre carritos activos y de un INSERT con commit"""
+    low, high = conn.execute("SELECT MIN(id), MAX(id) FROM carts").fetchone()
+    ids = [rng.randint(low, high) for _ in range(samples)]
+    start = time.perf_counter()
+    for cart_id in ids:
+        try:
+            main.get_cart(cart_id)
+        except main.HTTPException:
+            pass
+    lookup = (time.perf_counter() - start) / samples * 1000
+
+    start = time.perf_counter()
+    for _ in range(samples // 10):
+        conn.execute("INSERT INTO carts (items, total_amount, total_items, created_at, updated_at) "
+                     "VALUES ('[]', 0, 0, ?, ?)", (day_start.isoformat(), day_start.isoformat()))
+        conn.commit()
+    insert = (time.perf_counter() - start) / (samples // 10) * 1000
+    return lookup, insert
+
+
+def run(label, path, args, retention):
+    main.DB_PATH = path
+    main.initialize_database()
+    conn = main.get_db_connection()
+    products = conn.execute("SELECT id, name, price FROM products").fetchall()
+    rng = random.Random(42)
+    start = datetime(2025, 1, 1)
+
+    print(f"\n{label}")
+    print(f"{'día':>5}{'MB BD':>10}{'MB WAL':>9}{'carts':>10}{'archivo':>10}{'get ms':>9}{'insert ms':>11}")
+    for day in range(1, args.days + 1):
+        day_start = start + timedelta(days=day - 1)
+        simulate_day(conn, rng, products, day_start, args.carts_per_day, args.update_ratio)
+        if retention:
+            retention.run_once(now=day_start + timedelta(days=1), force=True)
+        if day % args.report_every == 0 or day == args.days:
+            lookup, insert = measure(conn, rng, day_start)
+            size = main.database_size_report(conn, exact=True)
+            print(f"{day:>5}{size['file_bytes'] / 1e6:>10.2f}{size['wal_bytes'] / 1e6:>9.2f}"
+                  f"{size['rows']['carts']:>10}{size['rows'].get('carts_archive', 0):>10}"
+                  f"{lookup:>9.3f}{insert:>11.3f}")
+    conn.close()
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--carts-per-day", type=int, default=2000)
+    parser.add_argument("--update-ratio", type=float, default=0.3)
+    parser.add_argument("--expiry-days", type=float, default=7)
+    parser.add_argument("--archive-days", type=float, default=30)
+    parser.add_argument("--report-every", type=int, default=15)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    print(f"{args.days} días · {args.carts_per_day} carritos/día · vencen a los {args.expiry_days:g} días · "
+          f"archivo por {args.archive_days:g} días")
+
+    run("Sin retención", os.path.join(tmp, "sin_retencion.db"), args, None)
+    retention = main.CartRetention(
+        expiry_days=args.expiry_days,
+        archive_retention_days=args.archive_days,
+        interval_seconds=main.CART_RETENTION_INTERVAL_SECONDS,
+        batch_size=main.CART_RETENTION_BATCH_SIZE,
+        vacuum_pages=main.VACUUM_PAGES_PER_STEP,
+    )
+    run("Con retención", os.path.join(tmp, "con_retencion.db"), args, retention)
+    print(f"\nRetención: {retention.snapshot()}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,113 @@
+"""Benchmark de serialización de respuestas de la API (listado de 10k productos y carritos).
+
+Compara el camino anterior (un modelo pydantic por fila validado contra el
+response_model y serializado con el encoder de FastAPI) con el modo rápido
+(FAST_JSON_RESPONSES): productos serializados con orjson una vez por versión
+de catálogo y unidos como bytes, y carritos armados insertando el texto de
+`items` guardado en la BD sin json.loads/json.dumps.
+
+Mide la serialización sola y el request completo con TestClient (con el cache
+HTTP del catálogo desactivado para que cada request ejecute el endpoint).
+
+Uso:
+    python bench/bench_serialization.py [--rows 10000] [--carts 500]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+from typing import List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bench.catalog import temp_database  # noqa: E402
+
+
+def best_of(func, number, repeat=5):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def seed_carts(main, count, items_per_cart=5):
+    conn = main.get_db_connection()
+    products = conn.execute("SELECT id, name, price FROM products LIMIT ?", (items_per_cart,)).fetchall()
+    items = json.dumps([{"product_id": p[0], "name": p[1], "price": p[2], "qty": 1} for p in products])
+    total = sum(p[2] for p in products)
+    conn.executemany(
+        "INSERT INTO carts (items, total_amount, total_items, created_at) VALUES (?, ?, ?, ?)",
+        [(items, total, len(products), f"2025-01-{1 + i % 28:02d}T10:00:00") for i in range(count)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--carts", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=30)
+    args = parser.parse_args()
+
+    temp_database("serialization.db", rows=args.rows)
+
+    import main
+    from fastapi.testclient import TestClient
+    from pydantic import TypeAdapter
+
+    seed_carts(main, args.carts)
+    products = main.facet_index.search()
+    adapter = TypeAdapter(List[main.Product])
+
+    def legacy_products():
+        # Lo que hacía FastAPI con response_model=List[Product] sobre modelos construidos por fila
+        models = [main.Product(**product) for product in products]
+        content = adapter.dump_python(adapter.validate_python(models), mode="json")
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def cold_products():
+        return main.encode_product_list([main.json_bytes(product) for product in products])
+
+    def warm_products():
+        return main.facet_index.search_json()
+
+    assert json.loads(legacy_products()) == json.loads(warm_products())
+
+    print(f"Productos: {len(products)}  carritos: {args.carts}  orjson: {main.orjson is not None}")
+    print(f"\n{'serialización de GET /products':40}{'ms':>10}{'speedup':>10}")
+    legacy = best_of(legacy_products, 3)
+    for label, func in (
+        ("pydantic + encoder (anterior)", legacy_products),
+        ("json_bytes por request", cold_products),
+        ("bytes precalculados por versión", warm_products),
+    ):
+        seconds = legacy if func is legacy_products else best_of(func, 3)
+        print(f"{label:40}{seconds * 1000:>10.2f}{legacy / seconds:>9.1f}x")
+
+    # Request completo sin el cache HTTP del catálogo (cada request ejecuta el endpoint)
+    main.catalog_response_cache.max_entries = 0
+    client = TestClient(main.app)
+    print(f"\n{'request completo':40}{'anterior ms':>12}{'rápido ms':>12}{'speedup':>10}")
+    for label, path in (
+        (f"GET /products ({len(products)})", "/products"),
+        ("GET /products?category=Formal", "/products?category=Formal"),
+        (f"GET /carts?limit={min(args.carts, 500)}", f"/carts?limit={min(args.carts, 500)}"),
+    ):
+        timings = {}
+        bodies = {}
+        for mode in (False, True):
+            main.FAST_JSON_RESPONSES = mode
+            client.get(path)
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                response = client.get(path, headers={"Accept-Encoding": "identity"})
+            timings[mode] = (time.perf_counter() - start) / args.requests
+            bodies[mode] = response.json()
+        assert bodies[False] == bodies[True], path
+        print(f"{label:40}{timings[False] * 1000:>12.2f}{timings[True] * 1000:>12.2f}"
+              f"{timings[False] / timings[True]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,131 @@
+"""Generador de catálogos sintéticos en SQLite (1k / 100k / 1M productos).
+
+Los productos siguen la forma del Excel real (TIPO_PRENDA TALLA COLOR, con
+CATEGORÍA y DESCRIPCIÓN) y se guardan con el esquema base de la app; al
+arrancar, la app aplica sobre la copia las migraciones que falten.
+
+Los catálogos se cachean en bench/.cache para no regenerarlos en cada corrida.
+
+Uso:
+    python bench/catalog.py --rows 100000 [--output catalogo.db]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+TIPOS = ["Camisa", "Camiseta", "Chaqueta", "Falda", "Pantalón", "Sudadera"]
+TALLAS = ["S", "M", "L", "XL", "XXL"]
+COLORES = ["Amarillo", "Azul", "Blanco", "Gris", "Negro", "Rojo", "Verde"]
+CATEGORIAS = ["Casual", "Deportivo", "Formal"]
+DESCRIPCIONES = [
+    "Ideal para uso diario.",
+    "Prenda cómoda y ligera.",
+    "Diseño moderno y elegante.",
+    "Material de alta calidad.",
+]
+
+
+def synthetic_rows(rows, seed=42):
+    rng = random.Random(seed)
+    for _ in range(rows):
+        categoria = rng.choice(CATEGORIAS)
+        yield (
+            f"{rng.choice(TIPOS)} {rng.choice(TALLAS)} {rng.choice(COLORES)}",
+            f"{categoria} - {rng.choice(DESCRIPCIONES)}",
+            float(rng.randint(300, 1500)),
+            rng.randint(1, 500),
+            categoria,
+        )
+
+
+def generate_catalog(path, rows, seed=42):
+    """Crea una base SQLite con `rows` productos y la tabla de carritos vacía"""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute('''
+        CREATE TABLE products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            price REAL NOT NULL,
+            stock INTEGER NOT NULL,
+            category TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE carts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            items TEXT NOT NULL,
+            total_amount REAL NOT NULL,
+            total_items INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.executemany(
+        "INSERT INTO products (name, description, price, stock, category) VALUES (?, ?, ?, ?, ?)",
+        synthetic_rows(rows, seed)
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def ensure_catalog(rows, seed=42):
+    """Ruta del catálogo cacheado de `rows` productos (lo genera si no existe)"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cached = os.path.join(CACHE_DIR, f"catalog_{rows}_{seed}.db")
+    if not os.path.exists(cached):
+        start = time.perf_counter()
+        generate_catalog(cached + ".tmp", rows, seed)
+        os.replace(cached + ".tmp", cached)
+        print(f"Catálogo de {rows} productos generado en {time.perf_counter() - start:.1f}s")
+    return cached
+
+
+def catalog_copy(rows, destination, seed=42):
+    """Copia a `destination` un catálogo de `rows` productos"""
+    shutil.copyfile(ensure_catalog(rows, seed), destination)
+    return destination
+
+
+def temp_database(name="app.db", rows=None, log_level=None):
+    """Apunta DATABASE_PATH a una BD nueva en un directorio temporal y devuelve su ruta.
+
+    Importar main inicializa la BD configurada: los benchmarks llaman a esto antes
+    del import para no tocar la real. Con `rows` la BD arranca como copia del
+    catálogo sintético; sin él, main la crea y carga el Excel.
+    """
+    path = os.path.join(tempfile.mkdtemp(), name)
+    if rows:
+        catalog_copy(rows, path)
+    os.environ["DATABASE_PATH"] = path
+    if log_level:
+        os.environ.setdefault("LOG_LEVEL", log_level)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Ruta de salida (por defecto solo se cachea)")
+    args = parser.parse_args()
+
+    if args.output:
+        catalog_copy(args.rows, args.output, args.seed)
+        print(f"Catálogo escrito en {args.output}")
+    else:
+        print(f"Catálogo en {ensure_catalog(args.rows, args.seed)}")
+
+
+if __name__ == "__main__":
+    main()
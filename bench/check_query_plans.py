@@ -0,0 +1,62 @@
+"""Verifica con EXPLAIN QUERY PLAN que el listado de carritos por fecha usa índices.
+
+Aplica las migraciones sobre una copia de un catálogo sintético y arma, con
+build_carts_query de main.py, las consultas de GET /carts por rango de fechas.
+Termina con código 1 si alguna hace un recorrido completo de tabla.
+
+Los filtros de GET /products no llegan a SQLite (se resuelven sobre el índice de
+facetas en memoria): las consultas que ese endpoint sí ejecuta, y la semántica
+de sus filtros, se verifican en tests/test_query_plans.py.
+
+Uso:
+    python bench/check_query_plans.py [--rows 10000]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.catalog import catalog_copy, temp_database  # noqa: E402
+
+temp_database()
+
+from main import apply_migrations, build_carts_query, explain_query_plan, full_scans  # noqa: E402
+
+def cart_cases():
+    yield {"created_from": "2025-01-01T00:00:00"}
+    yield {"created_to": "2025-02-01T00:00:00"}
+    yield {"created_from": "2025-01-01T00:00:00", "created_to": "2025-02-01T00:00:00"}
+    yield {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = catalog_copy(args.rows, os.path.join(tmp, "plans.db"))
+        conn = sqlite3.connect(path)
+        apply_migrations(conn)
+
+        failures = 0
+        checks = [("carts", kwargs, build_carts_query(**kwargs)) for kwargs in cart_cases()]
+        for table, kwargs, (sql, params) in checks:
+            plan = explain_query_plan(conn, sql, params)
+            scans = full_scans(plan)
+            failures += bool(scans)
+            status = "SCAN" if scans else "ok"
+            print(f"{status:>4}  {table:<8} {kwargs}")
+            for step in plan:
+                print(f"        {step}")
+
+        conn.close()
+
+    print(f"\n{len(checks) - failures}/{len(checks)} consultas sin recorridos completos")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
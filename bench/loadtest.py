@@ -0,0 +1,368 @@
+"""Harness de carga end-to-end contra la app FastAPI real.
+
+Levanta la app con uvicorn en un subproceso sobre una copia de un catálogo
+sintético, con Gemini, la Graph API y Twilio reemplazados por el stub local
+(bench/stubs.py, con latencia inyectable), y ejecuta cada escenario con la
+concurrencia pedida. Reporta throughput y p50/p95/p99, guarda los resultados
+en bench/results/ y los compara con la corrida anterior de la misma
+configuración.
+
+Escenarios: products_list, products_search, product_detail, products_batch,
+cart_create, cart_update, webhook, twilio_webhook.
+
+Con `--workers 1,2,4` corre la misma carga con cada cantidad de workers y
+muestra cómo escala el throughput; `--server gunicorn` usa el modo de
+despliegue multi-worker (gunicorn.conf.py) en lugar de `uvicorn --workers`.
+
+Uso:
+    python bench/loadtest.py --rows 1000 --concurrency 16 --requests 500
+    python bench/loadtest.py --server gunicorn --workers 1,2,4 --scenarios products_list,product_detail
+    python bench/loadtest.py --rows 100000 --scenarios product_detail,cart_create
+    python bench/loadtest.py --gemini-latency-ms 400 --scenarios webhook,twilio_webhook
+
+Requiere httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, REPO_DIR)
+
+from bench.catalog import catalog_copy  # noqa: E402
+from bench.stubs import StubServer  # noqa: E402
+
+SCENARIOS = (
+    "products_list", "products_search", "product_detail", "products_batch",
+    "cart_create", "cart_update", "webhook", "twilio_webhook",
+)
+SEARCH_TERMS = ["camisa", "pantalón", "negro", "falda", "azul", "sudadera xl"]
+AGENT_MESSAGES = [
+    "hola", "productos", "buscar camisa", "producto {id}",
+    "quiero 2 del producto {id}", "busco algo en color negro para una fiesta",
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class AppProcess:
+    """La app corriendo con uvicorn (o gunicorn) en un subproceso, apuntada al stub"""
+
+    def __init__(self, database_path, stub, workers=1, extra_env=None, server="uvicorn"):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ)
+        self.env.update(stub.app_env())
+        self.env.update({
+            "DATABASE_PATH": database_path,
+            "API_BASE_URL": self.url,
+            "LOG_LEVEL": "WARNING",
+            "GEMINI_RPM": "1000000",
+            "GEMINI_TPM": "1000000000",
+            "PYTHONUNBUFFERED": "1",
+        })
+        self.env.update(extra_env or {})
+        self.workers = workers
+        self.server = server
+        self.process = None
+
+    def __enter__(self):
+        if self.server == "gunicorn":
+            command = [
+                sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py",
+                "--bind", f"127.0.0.1:{self.port}", "--workers", str(self.workers),
+            ]
+        else:
+            command = [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--host", "127.0.0.1", "--port", str(self.port),
+                "--workers", str(self.workers), "--log-level", "warning", "--no-access-log",
+            ]
+        self.process = subprocess.Popen(command, cwd=REPO_DIR, env=self.env)
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"La app terminó al arrancar (código {self.process.returncode})")
+            try:
+                if httpx.get(f"{self.url}/readyz", timeout=1).status_code == 200:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("La app no respondió /readyz a tiempo")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def build_request(scenario, rng, rows, cart_ids):
+    """(método, ruta, kwargs de httpx) para un request del escenario"""
+    product_id = rng.randint(1, rows)
+    if scenario == "products_list":
+        return "GET", "/products", {}
+    if scenario == "products_search":
+        return "GET", "/products", {"params": {"q": rng.choice(SEARCH_TERMS)}}
+    if scenario == "product_detail":
+        return "GET", f"/products/{product_id}", {}
+    if scenario == "products_batch":
+        ids = ",".join(str(rng.randint(1, rows)) for _ in range(10))
+        return "GET", "/products", {"params": {"ids": ids}}
+    if scenario == "cart_create":
+        return "POST", "/carts", {"json": {"items": [{"product_id": product_id, "qty": 1}]}}
+    if scenario == "cart_update":
+        return "PATCH", f"/carts/{rng.choice(cart_ids)}", {
+            "json": {"items": [{"product_id": product_id, "qty": 1}]}
+        }
+
+    text = rng.choice(AGENT_MESSAGES).format(id=product_id)
+    sender = f"54911{rng.randint(0, 999999):06d}"
+    if scenario == "webhook":
+        return "POST", "/webhook", {"json": {"entry": [{"changes": [{
+            "field": "messages",
+            "value": {"messages": [{"from": sender, "type": "text", "text": {"body": text}}]},
+        }]}]}}
+    return "POST", "/twilio-webhook", {"data": {"Body": text, "From": f"whatsapp:+{sender}"}}
+
+
+async def run_scenario(base_url, scenario, requests, concurrency, rows, cart_ids, seed):
+    rng = random.Random(seed)
+    planned = [build_request(scenario, rng, rows, cart_ids) for _ in range(requests)]
+    latencies = []
+    errors = 0
+    status_counts = {}
+    next_index = 0
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def worker():
+            nonlocal next_index, errors
+            while next_index < len(planned):
+                method, path, kwargs = planned[next_index]
+                next_index += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, **kwargs)
+                    status = response.status_code
+                    await response.aread()
+                except httpx.HTTPError:
+                    status = "error"
+                latencies.append(time.perf_counter() - start)
+                status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+                # Los webhooks responden 200 con {"status": "error"} cuando fallan
+                if status == "error" or status >= 400 or (
+                    path.endswith("webhook") and response.json().get("status") != "success"
+                ):
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "status_counts": status_counts,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+def seed_carts(base_url, rows, count=50):
+    ids = []
+    with httpx.Client(base_url=base_url, timeout=30) as client:
+        for product_id in range(1, min(rows, count) + 1):
+            response = client.post("/carts", json={"items": [{"product_id": product_id, "qty": 1}]})
+            response.raise_for_status()
+            ids.append(response.json()["id"])
+    return ids
+
+
+def config_key(config):
+    """Identifica corridas comparables (misma carga y mismas latencias inyectadas)"""
+    keys = ("rows", "concurrency", "requests", "workers", "server",
+            "gemini_latency_ms", "graph_latency_ms", "twilio_latency_ms")
+    return {key: config[key] for key in keys}
+
+
+def previous_result(config, path=None):
+    if path:
+        with open(path) as fh:
+            return json.load(fh)
+    for candidate in sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")), reverse=True):
+        with open(candidate) as fh:
+            data = json.load(fh)
+        if config_key(dict({"server": "uvicorn"}, **data.get("config", {}))) == config_key(config):
+            return data
+    return None
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results, baseline):
+    header = f"{'escenario':<16}{'req':>7}{'err':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    if baseline:
+        header += f"{'Δ req/s':>10}{'Δ p95':>9}"
+    print(header)
+    for scenario, data in results.items():
+        line = (
+            f"{scenario:<16}{data['requests']:>7}{data['errors']:>6}{data['throughput_rps']:>10.1f}"
+            f"{data['p50_ms']:>10.2f}{data['p95_ms']:>10.2f}{data['p99_ms']:>10.2f}"
+        )
+        previous = (baseline or {}).get("scenarios", {}).get(scenario)
+        if previous and previous["throughput_rps"] and previous["p95_ms"]:
+            rps_delta = (data["throughput_rps"] / previous["throughput_rps"] - 1) * 100
+            p95_delta = (data["p95_ms"] / previous["p95_ms"] - 1) * 100
+            line += f"{rps_delta:>+9.1f}%{p95_delta:>+8.1f}%"
+        print(line)
+
+
+def run_benchmark(config):
+    """Ejecuta los escenarios y devuelve {"config", "scenarios", ...}"""
+    stub = StubServer(latency_ms={
+        "gemini": config["gemini_latency_ms"],
+        "graph": config["graph_latency_ms"],
+        "twilio": config["twilio_latency_ms"],
+    }).start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            database = catalog_copy(config["rows"], os.path.join(workdir, "bench.db"))
+            with AppProcess(database, stub, workers=config["workers"], server=config["server"]) as app:
+                cart_ids = seed_carts(app.url, config["rows"]) if "cart_update" in config["scenarios"] else []
+                results = {}
+                for index, scenario in enumerate(config["scenarios"]):
+                    results[scenario] = asyncio.run(run_scenario(
+                        app.url, scenario, config["requests"], config["concurrency"],
+                        config["rows"], cart_ids, seed=config["seed"] + index
+                    ))
+    finally:
+        stub_stats = stub.stats()
+        stub.stop()
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "config": config,
+        "stub_requests": stub_stats,
+        "scenarios": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="Productos del catálogo sintético (1000, 100000, 1000000...)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="Requests por escenario")
+    parser.add_argument("--workers", default="1", help="Procesos de la app; lista separada por comas para medir escalado (1,2,4)")
+    parser.add_argument("--server", choices=("uvicorn", "gunicorn"), default="uvicorn")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--gemini-latency-ms", type=float, default=300.0)
+    parser.add_argument("--graph-latency-ms", type=float, default=50.0)
+    parser.add_argument("--twilio-latency-ms", type=float, default=50.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", help="Resultado JSON contra el que comparar (por defecto, la última corrida equivalente)")
+    parser.add_argument("--no-save", action="store_true")
+    return parser.parse_args(argv)
+
+
+def print_scaling(results):
+    """Throughput por escenario para cada cantidad de workers, relativo a la primera"""
+    workers = list(results)
+    print(f"\nEscalado de throughput (req/s) · {os.cpu_count()} CPUs")
+    print(f"{'escenario':<16}" + "".join(f"{f'{count} w':>12}" for count in workers))
+    for scenario in results[workers[0]]["scenarios"]:
+        base = results[workers[0]]["scenarios"][scenario]["throughput_rps"]
+        cells = []
+        for count in workers:
+            rps = results[count]["scenarios"][scenario]["throughput_rps"]
+            cells.append(f"{rps:>7.1f} ({rps / base:.1f}x)" if base else f"{rps:>12.1f}")
+        print(f"{scenario:<16}" + "".join(f"{cell:>12}" for cell in cells))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Escenarios desconocidos: {', '.join(sorted(unknown))}")
+    worker_counts = [int(count) for count in args.workers.split(",") if count.strip()]
+
+    results = {}
+    for workers in worker_counts:
+        config = {
+            "rows": args.rows,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "workers": workers,
+            "server": args.server,
+            "scenarios": scenarios,
+            "gemini_latency_ms": args.gemini_latency_ms,
+            "graph_latency_ms": args.graph_latency_ms,
+            "twilio_latency_ms": args.twilio_latency_ms,
+            "seed": args.seed,
+        }
+        baseline = previous_result(config, args.baseline)
+        result = results[workers] = run_benchmark(config)
+
+        print(f"\nCatálogo: {args.rows} productos · concurrencia {args.concurrency} · "
+              f"{args.server} con {workers} workers")
+        print_report(result["scenarios"], baseline)
+        print(f"Requests al stub: {result['stub_requests']}")
+        if baseline:
+            print(f"Comparado con {baseline['timestamp']} ({baseline.get('git_revision') or 'sin revisión'})")
+
+        if not args.no_save:
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(RESULTS_DIR, f"{stamp}-{args.rows}rows-c{args.concurrency}-{args.server}-w{workers}.json")
+            with open(path, "w") as fh:
+                json.dump(result, fh, indent=2)
+            print(f"Resultados guardados en {os.path.relpath(path, REPO_DIR)}")
+
+    if len(results) > 1:
+        print_scaling(results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
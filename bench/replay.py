@@ -0,0 +1,302 @@
+"""Reproduce tráfico de webhooks grabado (WhatsApp Business / Twilio) contra la app en proceso.
+
+Cada línea del archivo JSONL es un webhook recibido:
+
+    {"ts": "2025-06-10T15:00:54Z", "channel": "whatsapp", "payload": {...cuerpo JSON de Meta...}}
+    {"ts": 1749567654.0, "channel": "twilio", "payload": {"Body": "hola", "From": "whatsapp:+54911..."}}
+
+También se aceptan los cuerpos sin el sobre: un JSON con `entry` es de WhatsApp (la hora
+sale del `timestamp` del mensaje) y uno con `Body` y `From` es de Twilio.
+
+La app corre con uvicorn en un hilo de este proceso sobre una BD temporal, con Gemini,
+la Graph API y Twilio reemplazados por el stub local (bench/stubs.py). Los webhooks se
+envían por HTTP a /webhook y /twilio-webhook respetando los intervalos originales
+divididos por `--speed` (0 = sin esperas); los de un mismo remitente van en orden, uno
+detrás de otro, como en una conversación real.
+
+Cada webhook lleva X-Request-ID propio y el agente anota sus turnos en AgentTurnLog
+(también en GET /debug/agent-turns), así que el reporte muestra por mensaje la latencia
+del agente, el camino de resolución, las llamadas al modelo, las tools y las
+operaciones de carrito. Con `--output` se guarda un JSON por turno para comparar
+corridas.
+
+Uso:
+    python bench/replay.py bench/traffic/sample_webhooks.jsonl --speed 10
+    python bench/replay.py grabacion.jsonl --speed 0 --gemini-latency-ms 800 --output turnos.jsonl
+    python bench/replay.py grabacion.jsonl --rows 100000 --max-gap 5
+
+Requiere httpx (pip install httpx).
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bench.catalog import temp_database  # noqa: E402
+from bench.stubs import StubServer  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def load_events(path):
+    """[{index, ts, channel, sender, payload}] en el orden del archivo"""
+    events = []
+    with open(path, encoding="utf-8") as traffic:
+        for line_number, line in enumerate(traffic, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            payload = record.get("payload", record)
+            channel = record.get("channel") or ("whatsapp" if "entry" in payload else "twilio")
+            ts = parse_timestamp(record.get("ts"))
+
+            if channel == "whatsapp":
+                messages = [message
+                            for entry in payload.get("entry", [])
+                            for change in entry.get("changes", [])
+                            for message in change.get("value", {}).get("messages", [])]
+                sender = messages[0].get("from", "") if messages else ""
+                if ts is None and messages:
+                    ts = parse_timestamp(messages[0].get("timestamp"))
+            elif channel == "twilio":
+                if "Body" not in payload or "From" not in payload:
+                    raise ValueError(f"Línea {line_number}: webhook de Twilio sin Body/From")
+                sender = payload["From"]
+            else:
+                raise ValueError(f"Línea {line_number}: canal desconocido {channel!r}")
+
+            if ts is None:
+                ts = events[-1]["ts"] if events else 0.0
+            events.append({"index": len(events), "ts": ts, "channel": channel,
+                           "sender": sender, "payload": payload})
+    return events
+
+
+def schedule(events, speed, max_gap):
+    """Segundos desde el inicio de la reproducción en que sale cada evento"""
+    offset = 0.0
+    previous = None
+    for event in sorted(events, key=lambda e: (e["ts"], e["index"])):
+        if previous is not None:
+            gap = max(event["ts"] - previous, 0.0)
+            if max_gap is not None:
+                gap = min(gap, max_gap)
+            offset += gap / speed if speed else 0.0
+        previous = event["ts"]
+        event["due"] = offset
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class InProcessApp:
+    """La app servida por uvicorn en un hilo: las tools del agente le hacen HTTP como en producción"""
+
+    def __init__(self, main, port):
+        import uvicorn
+        self.url = f"http://127.0.0.1:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        deadline = time.monotonic() + 30
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("La app no arrancó")
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def replay(events, base_url, concurrency):
+    """Envía los eventos; devuelve {índice: (status, segundos de webhook, segundos de retraso)}"""
+    conversations = OrderedDict()
+    for event in sorted(events, key=lambda e: e["due"]):
+        conversations.setdefault((event["channel"], event["sender"]), []).append(event)
+
+    results = {}
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def run_conversation(conversation):
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            for event in conversation:
+                wait = start + event["due"] - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                lag = time.perf_counter() - start - event["due"]
+                headers = {"X-Request-ID": f"replay-{event['index']}"}
+                sent = time.perf_counter()
+                try:
+                    if event["channel"] == "whatsapp":
+                        response = client.post("/webhook", json=event["payload"], headers=headers)
+                    else:
+                        response = client.post("/twilio-webhook", data=event["payload"], headers=headers)
+                    ok = response.status_code == 200 and response.json().get("status") == "success"
+                except httpx.HTTPError:
+                    ok = False
+                with lock:
+                    results[event["index"]] = (ok, time.perf_counter() - sent, lag)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(conversations)))) as pool:
+        list(pool.map(run_conversation, conversations.values()))
+    return results, time.perf_counter() - start
+
+
+def wait_outbox(main, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = main.outbound_sender.snapshot()["statuses"]
+        if not counts.get("pending") and not counts.get("sending"):
+            break
+        time.sleep(0.05)
+    return main.outbound_sender.snapshot()["statuses"]
+
+
+def print_report(events, results, turns, elapsed, stub_stats, outbox):
+    by_request = {}
+    for turn in turns:
+        by_request.setdefault(turn["request_id"], []).append(turn)
+
+    latencies = sorted(turn["latency_ms"] for turn in turns)
+    webhook_ms = sorted(result[1] * 1000 for result in results.values())
+    lags = sorted(result[2] * 1000 for result in results.values())
+    failed = sum(not result[0] for result in results.values())
+    recorded_span = max(e["ts"] for e in events) - min(e["ts"] for e in events)
+
+    print(f"\nWebhooks: {len(events)} ({failed} con error)  turnos del agente: {len(turns)}  "
+          f"duración: {elapsed:.1f}s (grabación: {recorded_span:.0f}s)")
+    print(f"{'':24}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for label, values in (("agente ms/turno", latencies), ("webhook ms", webhook_ms), ("retraso de envío ms", lags)):
+        print(f"{label:24}{percentile(values, 0.5):>9.1f}{percentile(values, 0.95):>9.1f}"
+              f"{percentile(values, 0.99):>9.1f}{(values[-1] if values else 0.0):>9.1f}")
+
+    print(f"\n{'camino':14}{'turnos':>8}{'ms p50':>9}{'ms p95':>9}{'modelo/turno':>14}{'tools/turno':>13}")
+    paths = {}
+    for turn in turns:
+        paths.setdefault(turn["path"], []).append(turn)
+    for path, path_turns in sorted(paths.items(), key=lambda item: -len(item[1])):
+        path_latencies = sorted(turn["latency_ms"] for turn in path_turns)
+        print(f"{str(path):14}{len(path_turns):>8}{percentile(path_latencies, 0.5):>9.1f}"
+              f"{percentile(path_latencies, 0.95):>9.1f}"
+              f"{sum(t['model_calls'] for t in path_turns) / len(path_turns):>14.2f}"
+              f"{sum(t['tool_calls'] for t in path_turns) / len(path_turns):>13.2f}")
+
+    model_calls = Counter(turn["model_calls"] for turn in turns)
+    total_model_calls = sum(turn["model_calls"] for turn in turns)
+    print(f"\nLlamadas al modelo: {total_model_calls} ({total_model_calls / max(len(turns), 1):.2f} por turno; "
+          + ", ".join(f"{count} turnos con {calls}" for calls, count in sorted(model_calls.items())) + ")")
+
+    cart_ops = Counter((op["op"], op["ok"]) for turn in turns for op in turn["cart_ops"])
+    print("Operaciones de carrito: " + (", ".join(
+        f"{operation} {'ok' if ok else 'fallida'}: {count}" for (operation, ok), count in sorted(cart_ops.items())
+    ) or "ninguna"))
+    intents = Counter(turn["intent"] for turn in turns)
+    print("Intents: " + ", ".join(f"{intent} {count}" for intent, count in intents.most_common()))
+    missing = [event["index"] for event in events if f"replay-{event['index']}" not in by_request]
+    if missing:
+        print(f"Webhooks sin turno del agente (sin texto o con error): {len(missing)}")
+    print(f"Outbox WhatsApp: {outbox}")
+    print("Stub: " + ", ".join(f"{service} {data['requests']} req" for service, data in stub_stats.items()))
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traffic", nargs="?", default=os.path.join(BENCH_DIR, "traffic", "sample_webhooks.jsonl"))
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Factor de aceleración sobre los intervalos grabados (0 = sin esperas)")
+    parser.add_argument("--max-gap", type=float, default=None,
+                        help="Tope en segundos grabados para los silencios entre webhooks")
+    parser.add_argument("--concurrency", type=int, default=64, help="Conversaciones en curso a la vez")
+    parser.add_argument("--rows", type=int, default=0,
+                        help="Catálogo sintético de N productos (0 = cargar el Excel como en producción)")
+    parser.add_argument("--gemini-latency-ms", type=float, default=300.0)
+    parser.add_argument("--graph-latency-ms", type=float, default=50.0)
+    parser.add_argument("--twilio-latency-ms", type=float, default=50.0)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="Archivo JSONL con un registro por turno del agente")
+    args = parser.parse_args()
+
+    events = load_events(args.traffic)
+    if not events:
+        sys.exit(f"{args.traffic} no tiene webhooks")
+    schedule(events, args.speed, args.max_gap)
+
+    stub = StubServer(
+        latency_ms={"gemini": args.gemini_latency_ms, "graph": args.graph_latency_ms,
+                    "twilio": args.twilio_latency_ms},
+        error_rate={"gemini": args.gemini_error_rate},
+    ).start()
+    port = free_port()
+    temp_database("replay.db", rows=args.rows, log_level="WARNING")
+    os.environ.update(stub.app_env())
+    os.environ.update({
+        "API_BASE_URL": f"http://127.0.0.1:{port}",
+        "GEMINI_RPM": "1000000",
+        "GEMINI_TPM": "1000000000",
+    })
+
+    import main
+
+    senders = len({(event["channel"], event["sender"]) for event in events})
+    speed = f"x{args.speed:g}" if args.speed else "sin esperas"
+    print(f"{args.traffic}: {len(events)} webhooks de {senders} remitentes · velocidad {speed} · "
+          f"Gemini {args.gemini_latency_ms:.0f}ms")
+
+    with InProcessApp(main, port) as app:
+        first_seq = main.agent_turn_log.last_sequence
+        results, elapsed = replay(events, app.url, args.concurrency)
+        outbox = wait_outbox(main, timeout=60)
+        turns = [turn for turn in main.agent_turn_log.recent(first_seq)
+                 if str(turn["request_id"]).startswith("replay-")]
+    stub_stats = stub.stats()
+    stub.stop()
+
+    print_report(events, results, turns, elapsed, stub_stats, outbox)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            for turn in turns:
+                event = events[int(turn["request_id"].split("-", 1)[1])]
+                output.write(json.dumps(dict(turn, channel=event["channel"], recorded_ts=event["ts"],
+                                             webhook_ms=round(results[event["index"]][1] * 1000, 3)),
+                                        ensure_ascii=False) + "\n")
+        print(f"Turnos guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main_()
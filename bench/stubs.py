@@ -0,0 +1,217 @@
+"""Servidores locales que reemplazan a Gemini, la Graph API de WhatsApp y Twilio.
+
+Un único servidor HTTP atiende las tres APIs según la ruta:
+
+    POST /v1beta/models/<modelo>:generateContent      → Gemini (transport REST)
+    POST /<versión>/<phone_number_id>/messages         → Graph API de WhatsApp
+    POST /2010-04-01/Accounts/<sid>/Messages.json      → Twilio
+    GET  /_stats                                       → contadores del stub
+
+La latencia y la tasa de errores de cada servicio se inyectan por parámetro.
+La app se apunta al stub con GEMINI_API_ENDPOINT, WHATSAPP_API_URL y
+TWILIO_API_BASE_URL (ver `app_env()`).
+
+Uso standalone:
+    python bench/stubs.py --port 9100 --gemini-latency-ms 300 --graph-latency-ms 50
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICES = ("gemini", "graph", "twilio")
+
+_PRODUCT_ID = re.compile(r"producto\s+(?:id\s+)?(\d+)")
+_SEARCH = re.compile(r"busc\w*\s+(.+)")
+_RECOMMEND = re.compile(r"recomend|recomiend|regalo|\balgo para\b")
+
+
+def gemini_reply(prompt):
+    """Respuesta determinística que ejercita el mismo flujo que Gemini (acción + segunda llamada)"""
+    if "IMPORTANTE: Analiza el mensaje" not in prompt:
+        return "¡Listo! 😊 Acá tenés la información que pediste. ¿Te ayudo con algo más?"
+
+    message = prompt.rsplit("Usuario:", 1)[-1].strip().lower()
+    product = _PRODUCT_ID.search(message)
+    search = _SEARCH.search(message)
+    if product and any(word in message for word in ("quiero", "comprar", "carrito", "agrega")):
+        return f"ACCION:create_cart:{product.group(1)},1"
+    if product:
+        return f"ACCION:get_product:{product.group(1)}"
+    if search:
+        return f"ACCION:search_products:{search.group(1).split()[0]}"
+    if _RECOMMEND.search(message):
+        return f"ACCION:recommend_products:{message}"
+    return "ACCION:get_products"
+
+
+class StubServer:
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=None, error_rate=None, seed=42):
+        self.latency = {name: (latency_ms or {}).get(name, 0) / 1000.0 for name in SERVICES}
+        self.error_rate = {name: (error_rate or {}).get(name, 0.0) for name in SERVICES}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.counts = {name: {"requests": 0, "errors": 0} for name in SERVICES}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return json.loads(json.dumps(self.counts))
+
+    def app_env(self):
+        """Variables de entorno que apuntan la app a este stub"""
+        return {
+            "GEMINI_API_KEY": "stub-key",
+            "GEMINI_API_ENDPOINT": self.url,
+            "WHATSAPP_TOKEN": "stub-token",
+            "WHATSAPP_PHONE_NUMBER_ID": "100000000000000",
+            "WHATSAPP_API_URL": f"{self.url}/v18.0",
+            "TWILIO_ACCOUNT_SID": "ACstub",
+            "TWILIO_AUTH_TOKEN": "stub-token",
+            "TWILIO_API_BASE_URL": self.url,
+        }
+
+    def _record(self, service):
+        """Cuenta el request y decide si se responde con error (429/5xx)"""
+        with self._lock:
+            self.counts[service]["requests"] += 1
+            failed = self._random.random() < self.error_rate[service]
+            if failed:
+                self.counts[service]["errors"] += 1
+            return failed, next(self._ids)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Encabezados y cuerpo salen en writes separados: sin TCP_NODELAY, Nagle más el
+            # delayed ACK del cliente suman ~40ms a cada respuesta en conexiones keep-alive
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def do_GET(self):
+                if self.path.startswith("/_stats"):
+                    self._send(200, stub.stats())
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                body = self._read_body()
+                path = self.path.split("?", 1)[0]
+
+                if ":generateContent" in path:
+                    service = "gemini"
+                elif path.endswith("/messages"):
+                    service = "graph"
+                elif path.endswith("/Messages.json"):
+                    service = "twilio"
+                else:
+                    self._send(404, {"error": "not found"})
+                    return
+
+                failed, sequence = stub._record(service)
+                if stub.latency[service]:
+                    time.sleep(stub.latency[service])
+                if failed:
+                    status = 429 if sequence % 2 else 503
+                    self._send(status, {"error": {"code": status, "message": "stub error"}})
+                    return
+
+                if service == "gemini":
+                    request = json.loads(body or b"{}")
+                    prompt = "".join(
+                        part.get("text", "")
+                        for content in request.get("contents", [])
+                        for part in content.get("parts", [])
+                    )
+                    text = gemini_reply(prompt)
+                    prompt_tokens = len(prompt) // 4
+                    output_tokens = len(text) // 4
+                    self._send(200, {
+                        "candidates": [{
+                            "content": {"parts": [{"text": text}], "role": "model"},
+                            "finishReason": "STOP",
+                            "index": 0,
+                        }],
+                        "usageMetadata": {
+                            "promptTokenCount": prompt_tokens,
+                            "candidatesTokenCount": output_tokens,
+                            "totalTokenCount": prompt_tokens + output_tokens,
+                        },
+                    })
+                elif service == "graph":
+                    self._send(200, {
+                        "messaging_product": "whatsapp",
+                        "messages": [{"id": f"wamid.stub{sequence}"}],
+                    })
+                else:
+                    self._send(201, {
+                        "sid": f"SM{sequence:032d}",
+                        "status": "queued",
+                        "body": "",
+                    })
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9100)
+    for service in SERVICES:
+        parser.add_argument(f"--{service}-latency-ms", type=float, default=0.0)
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = StubServer(
+        port=args.port,
+        latency_ms={service: getattr(args, f"{service}_latency_ms") for service in SERVICES},
+        error_rate={service: getattr(args, f"{service}_error_rate") for service in SERVICES},
+    ).start()
+    print(f"Stub escuchando en {stub.url}")
+    for name, value in stub.app_env().items():
+        print(f"  {name}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+# Configuración de gunicorn para el modo multi-worker (ver Procfile)
+#
+# Cada worker es un proceso uvicorn con su propia copia del estado en memoria
+# (agente, caches, métricas). La inicialización de la BD se serializa con un
+# lock de archivo y los caches se invalidan entre workers con la versión de
+# catálogo guardada en SQLite (tabla catalog_state).
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Un worker por core: el trabajo pesado (Gemini, envíos) es I/O y corre en el
+# threadpool de cada worker. WEB_CONCURRENCY permite ajustarlo por entorno.
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Los workers lo heredan para repartir entre sí las cuotas de Gemini y de la Graph API
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Las respuestas del agente pueden esperar a Gemini varios segundos
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+# Los logs de la app ya son JSON estructurado por stdout
+accesslog = None
+errorlog = "-"
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'warning')
@@ -1,97 +1,768 @@
-from fastapi import FastAPI, Form, HTTPException, Query
+from fastapi import FastAPI, Form, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
-from typing import List, Optional
+from starlette.routing import Match
+from typing import Dict, List, Optional
 import sqlite3
 import pandas as pd
+import numpy as np
+import atexit
+import bisect
+import functools
+import gzip
+import heapq
+import itertools
 import json
 import os
+import platform
+import queue
+import random
 import requests
-from datetime import datetime
+import re
+import sys
+import threading
+import time
+import traceback
+import unicodedata
+import uuid
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 
+try:
+    import brotli  # opcional: Content-Encoding br para los listados del catálogo
+except ImportError:
+    brotli = None
+
+try:
+    import orjson  # opcional: serialización JSON más rápida para las respuestas de la API
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # lock de inicialización entre workers (no disponible en Windows)
+except ImportError:
+    fcntl = None
+
 # Cargar variables de entorno
 load_dotenv()
 
-# Función para inicializar la base de datos
-def initialize_database():
-    """Inicializa la base de datos con las tablas y productos desde Excel"""
+DB_PATH = os.getenv('DATABASE_PATH', 'laburen_app.db')
+
+# Logging estructurado (JSON) escrito desde un thread en segundo plano.
+# El id de correlación viaja webhook → agente → tools → envío de la respuesta.
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+LOG_PREVIEW_CHARS = int(os.getenv('LOG_PREVIEW_CHARS', '80'))
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def preview(text: str) -> str:
+    """Recorta textos de usuario o respuestas para no volcarlos completos al log"""
+    text = text or ""
+    return text if len(text) <= LOG_PREVIEW_CHARS else text[:LOG_PREVIEW_CHARS] + "…"
+
+
+class StructuredLogger:
+    """Logger JSON no bloqueante.
+    
+    El hilo que atiende el request solo arma una tupla y la encola; el formateo
+    JSON y la escritura ocurren en un thread en segundo plano que escribe por lotes.
+    Los niveles por debajo de WARNING se pueden muestrear (LOG_SAMPLE_DEBUG/INFO).
+    """
+    
+    LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+    LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+    _STOP = object()
+    
+    def __init__(self, name: str, level: str = "INFO", sample_rates: Optional[dict] = None,
+                 stream=None, max_batch: int = 500):
+        self.name = name
+        self.level = self.LEVELS.get(level.upper(), 20)
+        self.sample_rates = sample_rates or {}
+        self.stream = stream or sys.stderr
+        self.max_batch = max_batch
+        self.dropped = 0  # registros descartados por muestreo
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, name=f"{name}-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def _log(self, levelno: int, msg: str, fields: dict, exc: Optional[str] = None):
+        if levelno < self.level:
+            return
+        rate = self.sample_rates.get(levelno, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.dropped += 1
+            return
+        self._queue.put((time.time(), levelno, msg, request_id_var.get(), fields, exc))
+    
+    def debug(self, msg: str, **fields):
+        self._log(10, msg, fields)
+    
+    def info(self, msg: str, **fields):
+        self._log(20, msg, fields)
+    
+    def warning(self, msg: str, **fields):
+        self._log(30, msg, fields)
+    
+    def error(self, msg: str, **fields):
+        self._log(40, msg, fields)
+    
+    def exception(self, msg: str, **fields):
+        """Como error(), con el traceback de la excepción en curso"""
+        self._log(40, msg, fields, traceback.format_exc())
+    
+    def _format(self, item) -> str:
+        created, levelno, msg, request_id, fields, exc = item
+        payload = {
+            "ts": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+            "level": self.LEVEL_NAMES[levelno],
+            "logger": self.name,
+            "msg": msg,
+            "request_id": request_id,
+        }
+        if fields:
+            payload.update(fields)
+        if exc:
+            payload["exc"] = exc
+        return json.dumps(payload, ensure_ascii=False, default=str)
+    
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            while item is not self._STOP and len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            
+            stop = batch[-1] is self._STOP
+            lines = [self._format(entry) for entry in batch if entry is not self._STOP]
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass  # El logging nunca debe romper la aplicación
+            if stop:
+                return
+    
+    def close(self, timeout: float = 2.0):
+        """Vacía la cola y detiene el thread de escritura"""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+
+logger = StructuredLogger(
+    "laburen",
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    sample_rates={
+        StructuredLogger.LEVELS["DEBUG"]: float(os.getenv('LOG_SAMPLE_DEBUG', '0.01')),
+        StructuredLogger.LEVELS["INFO"]: float(os.getenv('LOG_SAMPLE_INFO', '1.0')),
+    }
+)
+
+# Métricas en memoria con exposición en formato de texto de Prometheus
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+
+def _format_labels(labelnames, values) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [conteos por bucket..., suma, cantidad]
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        labelnames = self.labelnames + ("le",)
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(labelnames, labels + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}"
+
+
+class MetricsRegistry:
+    """Registro de métricas; los colectores exponen contadores mantenidos en otros objetos"""
+    
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+    
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def register_collector(self, collector):
+        """`collector()` devuelve [(nombre, tipo, ayuda, [(labels, valor), ...]), ...]"""
+        self._collectors.append(collector)
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+http_request_duration = metrics.histogram(
+    "http_request_duration_seconds", "Duración de los requests HTTP por ruta",
+    ("method", "route", "status")
+)
+db_query_duration = metrics.histogram(
+    "sqlite_query_duration_seconds", "Duración de las consultas SQLite",
+    ("operation", "table"), buckets=DB_BUCKETS
+)
+agent_stage_duration = metrics.histogram(
+    "agent_stage_duration_seconds",
+    "Duración de cada etapa del agente (intent, model_call_1, tool_call, model_call_2, outbound_send)",
+    ("stage",)
+)
+
+
+# Turno del agente en curso en este hilo (lo abre AgentTurnLog.turn en process_message)
+current_turn_var: ContextVar[Optional[dict]] = ContextVar("agent_turn", default=None)
+
+
+def observe_stage(seconds: float, stage: str):
+    """Registra la duración de una etapa del agente en el histograma y en el turno en curso"""
+    agent_stage_duration.observe(seconds, stage)
+    turn = current_turn_var.get()
+    if turn is not None:
+        turn["stages_ms"][stage] = round(turn["stages_ms"].get(stage, 0.0) + seconds * 1000, 3)
+        if stage.startswith("model_call"):
+            turn["model_calls"] += 1
+        elif stage == "tool_call":
+            turn["tool_calls"] += 1
+
+
+def timed_stage(stage: str):
+    """Decorador que registra la duración de una etapa del agente"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_stage(time.perf_counter() - start, stage)
+        return wrapper
+    return decorator
+
+
+_SQL_TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|EXISTS)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+_sql_labels_cache = {}
+
+def _sql_labels(sql: str):
+    """(operación, tabla) de una sentencia, memorizado por texto SQL"""
+    labels = _sql_labels_cache.get(sql)
+    if labels is None:
+        stripped = sql.lstrip()
+        operation = stripped.split(None, 1)[0].upper() if stripped else "UNKNOWN"
+        match = _SQL_TABLE_PATTERN.search(sql)
+        labels = (operation, match.group(1).lower() if match else "-")
+        if len(_sql_labels_cache) < 1024:
+            _sql_labels_cache[sql] = labels
+    return labels
+
+
+class DatabaseStats:
+    """Estado del acceso a SQLite mantenido en memoria, para los probes sin tocar la BD"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.initialized = False
+        self.open_connections = 0
+        self.connections_total = 0
+        self.errors_total = 0
+        self.last_success_at = None
+        self.last_error_at = None
+        self.last_error = None
+    
+    def connection_opened(self):
+        with self._lock:
+            self.open_connections += 1
+            self.connections_total += 1
+    
+    def connection_closed(self):
+        with self._lock:
+            self.open_connections -= 1
+    
+    def record_error(self, error: Exception):
+        with self._lock:
+            self.errors_total += 1
+            self.last_error_at = time.time()
+            self.last_error = str(error)
+    
+    @property
+    def healthy(self) -> bool:
+        """Inicializada y sin errores de SQLite posteriores a la última consulta exitosa"""
+        last_error_at = self.last_error_at
+        return self.initialized and (last_error_at is None or (self.last_success_at or 0) > last_error_at)
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "initialized": self.initialized,
+                "open_connections": self.open_connections,
+                "connections_total": self.connections_total,
+                "errors_total": self.errors_total,
+                "last_success_at": self.last_success_at,
+                "last_error_at": self.last_error_at,
+                "last_error": self.last_error,
+            }
+
+
+db_stats = DatabaseStats()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor que registra la duración de cada consulta y los errores de SQLite"""
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            result = super().execute(sql, parameters)
+        except sqlite3.OperationalError as e:
+            db_stats.record_error(e)
+            raise
+        finally:
+            db_query_duration.observe(time.perf_counter() - start, *_sql_labels(sql))
+        db_stats.last_success_at = time.time()
+        return result
+    
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            result = super().executemany(sql, seq_of_parameters)
+        except sqlite3.OperationalError as e:
+            db_stats.record_error(e)
+            raise
+        finally:
+            db_query_duration.observe(time.perf_counter() - start, *_sql_labels(sql))
+        db_stats.last_success_at = time.time()
+        return result
+    
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            result = super().executescript(sql_script)
+        except sqlite3.OperationalError as e:
+            db_stats.record_error(e)
+            raise
+        finally:
+            db_query_duration.observe(time.perf_counter() - start, *_sql_labels(sql_script))
+        db_stats.last_success_at = time.time()
+        return result
+
+
+class TimedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        db_stats.connection_opened()
+        # Se descuenta en close() o, si nunca se cierra, cuando la recolecta el GC
+        self._closed = weakref.finalize(self, db_stats.connection_closed)
+    
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+    
+    # Los atajos de Connection crean un sqlite3.Cursor propio: pasan por cursor() para medirse igual
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+    
+    def close(self):
+        super().close()
+        self._closed()
+
+
+def get_db_connection() -> sqlite3.Connection:
+    """Conexión a la base de datos con métricas de consultas"""
+    return sqlite3.connect(DB_PATH, factory=TimedConnection)
+
+
+# Versión del catálogo: cambia cada vez que se recargan los productos y
+# sirve para invalidar todo lo que se precalcula a partir de ellos. Vive en la
+# fila única de catalog_state para que todos los workers la compartan; cada
+# proceso la relee como mucho una vez cada CATALOG_VERSION_TTL_SECONDS.
+CATALOG_VERSION_TTL_SECONDS = float(os.getenv('CATALOG_VERSION_TTL_SECONDS', '1.0'))
+_catalog_state = (1, time.time(), float('-inf'))  # (versión, modificado en, leído en)
+_catalog_state_lock = threading.Lock()
+
+def _read_catalog_state() -> tuple:
+    global _catalog_state
+    state = _catalog_state
+    now = time.monotonic()
+    if now - state[2] < CATALOG_VERSION_TTL_SECONDS:
+        return state
+    
     try:
-        conn = sqlite3.connect('laburen_app.db')
-        cursor = conn.cursor()
-        
-        # Verificar si la tabla products existe
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='products';")
-        if cursor.fetchone():
-            print("✅ Tabla 'products' ya existe")
-            # Verificar y crear tabla carts si no existe
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='carts';")
-            if not cursor.fetchone():
-                print("📦 Creando tabla 'carts'...")
-                cursor.execute('''
-                CREATE TABLE carts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    items TEXT NOT NULL,
-                    total_amount REAL NOT NULL,
-                    total_items INTEGER NOT NULL,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-                ''')
-                conn.commit()
-                print("✅ Tabla 'carts' creada")
+        conn = get_db_connection()
+        row = conn.execute("SELECT version, modified_at FROM catalog_state WHERE id = 1").fetchone()
+        conn.close()
+    except sqlite3.Error:
+        row = None  # BD sin migrar todavía: se mantiene la versión local
+    
+    state = (row[0], row[1], now) if row else (state[0], state[1], now)
+    _catalog_state = state
+    return state
+
+def get_catalog_version() -> int:
+    return _read_catalog_state()[0]
+
+def get_catalog_modified_at() -> float:
+    """Momento (epoch) del último cambio de catálogo, para Last-Modified"""
+    return _read_catalog_state()[1]
+
+def bump_catalog_version() -> int:
+    """Marca el catálogo como modificado (invalida caches derivados en todos los workers)"""
+    global _catalog_state
+    with _catalog_state_lock:
+        modified_at = time.time()
+        conn = get_db_connection()
+        try:
+            conn.execute("UPDATE catalog_state SET version = version + 1, modified_at = ? WHERE id = 1", (modified_at,))
+            version = conn.execute("SELECT version FROM catalog_state WHERE id = 1").fetchone()[0]
+            conn.commit()
+        finally:
             conn.close()
-            return
-        
-        # Crear tabla products
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            description TEXT,
-            price REAL NOT NULL,
-            stock INTEGER NOT NULL,
-            category TEXT
-        )
-        ''')
+        _catalog_state = (version, modified_at, time.monotonic())
+        return version
+
+# Migraciones de esquema versionadas: cada una se aplica una sola vez y queda
+# registrada en la tabla schema_migrations
+
+def _migration_base_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT,
+        price REAL NOT NULL,
+        stock INTEGER NOT NULL,
+        category TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS carts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        items TEXT NOT NULL,
+        total_amount REAL NOT NULL,
+        total_items INTEGER NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+def _migration_carts_items_column(cursor):
+    """Recrea carts si viene del esquema anterior sin la columna items"""
+    cursor.execute("PRAGMA table_info(carts)")
+    if any(col[1] == 'items' for col in cursor.fetchall()):
+        return
+    
+    cursor.execute("SELECT COUNT(*) FROM carts")
+    logger.warning("📦 Recreando tabla 'carts' con la columna items", discarded_carts=cursor.fetchone()[0])
+    cursor.execute("DROP TABLE carts")
+    cursor.execute('''
+    CREATE TABLE carts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        items TEXT NOT NULL,
+        total_amount REAL NOT NULL,
+        total_items INTEGER NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+def _migration_products_category(cursor):
+    """Agrega products.category y la completa desde la descripción ('Categoría - ...')"""
+    cursor.execute("PRAGMA table_info(products)")
+    if not any(col[1] == 'category' for col in cursor.fetchall()):
+        cursor.execute("ALTER TABLE products ADD COLUMN category TEXT")
+    cursor.execute('''
+        UPDATE products
+        SET category = TRIM(SUBSTR(description, 1, INSTR(description, ' - ') - 1))
+        WHERE category IS NULL AND INSTR(description, ' - ') > 1
+    ''')
+
+def _migration_filter_indexes(cursor):
+    """Índices para filtrar por categoría, rango de precio y stock, y carritos por fecha"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_category_price_stock ON products(category COLLATE NOCASE, price, stock)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_price_stock ON products(price, stock)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_stock ON products(stock)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_carts_created_at ON carts(created_at)")
+    cursor.execute("ANALYZE")
+
+def _split_product_name(name: str):
+    """'Pantalón XXL Verde' -> ('Pantalón', 'XXL', 'Verde'); None si no sigue el formato del Excel"""
+    parts = (name or '').rsplit(' ', 2)
+    return tuple(parts) if len(parts) == 3 else None
+
+def _migration_products_facets(cursor):
+    """Agrega tipo de prenda, talle y color (TIPO_PRENDA / TALLA / COLOR) y los completa desde el nombre"""
+    cursor.execute("PRAGMA table_info(products)")
+    existing = {col[1] for col in cursor.fetchall()}
+    for column in ("product_type", "size", "color"):
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE products ADD COLUMN {column} TEXT")
+    
+    cursor.execute("SELECT id, name FROM products WHERE size IS NULL")
+    updates = []
+    for product_id, name in cursor.fetchall():
+        parsed = _split_product_name(name)
+        if parsed:
+            updates.append(parsed + (product_id,))
+    cursor.executemany("UPDATE products SET product_type = ?, size = ?, color = ? WHERE id = ?", updates)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_type ON products(product_type COLLATE NOCASE)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_size_color ON products(size COLLATE NOCASE, color COLLATE NOCASE)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_color ON products(color COLLATE NOCASE)")
+    cursor.execute("ANALYZE")
+
+def _migration_catalog_state(cursor):
+    """Fila única con la versión del catálogo, compartida por todos los workers"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS catalog_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL,
+        modified_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute(
+        "INSERT OR IGNORE INTO catalog_state (id, version, modified_at) VALUES (1, 1, ?)",
+        (time.time(),)
+    )
+
+def _migration_outbox(cursor):
+    """Cola persistente de mensajes salientes de WhatsApp (una fila por parte del mensaje)"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        recipient TEXT NOT NULL,
+        body TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        lease_until REAL,
+        created_at REAL NOT NULL,
+        finished_at REAL,
+        provider_message_id TEXT,
+        last_error TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_due ON outbox(status, next_attempt_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_recipient_status ON outbox(recipient, status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_finished_at ON outbox(finished_at)")
+
+def _migration_carts_lifecycle(cursor):
+    """carts.updated_at (última actividad), archivo comprimido de carritos vencidos y leases de mantenimiento"""
+    cursor.execute("PRAGMA table_info(carts)")
+    if not any(col[1] == 'updated_at' for col in cursor.fetchall()):
+        cursor.execute("ALTER TABLE carts ADD COLUMN updated_at TEXT")
+    # created_at puede venir de CURRENT_TIMESTAMP ('AAAA-MM-DD HH:MM:SS'): se normaliza a ISO
+    cursor.execute("UPDATE carts SET updated_at = REPLACE(created_at, ' ', 'T') WHERE updated_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_carts_updated_at ON carts(updated_at)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS carts_archive (
+        id INTEGER PRIMARY KEY,
+        items BLOB NOT NULL,
+        total_amount REAL NOT NULL,
+        total_items INTEGER NOT NULL,
+        created_at TEXT,
+        updated_at TEXT,
+        archived_at TEXT NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_carts_archive_archived_at ON carts_archive(archived_at)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS maintenance_leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''')
+
+def _migration_outbox_request_id(cursor):
+    """outbox.request_id: id de correlación del webhook que originó el mensaje, para los logs del envío"""
+    cursor.execute("PRAGMA table_info(outbox)")
+    if not any(col[1] == 'request_id' for col in cursor.fetchall()):
+        cursor.execute("ALTER TABLE outbox ADD COLUMN request_id TEXT")
+
+def _migration_drop_product_filter_indexes(cursor):
+    """Borra los índices de filtros de productos de las migraciones 4 y 5.
+    
+    GET /products, la búsqueda y las recomendaciones filtran sobre índices en
+    memoria y a SQLite solo le piden el catálogo completo o productos por ID, así
+    que esos índices nadie los leía y solo encarecían la recarga del catálogo.
+    """
+    for index in ("idx_products_category_price_stock", "idx_products_price_stock", "idx_products_stock",
+                  "idx_products_type", "idx_products_size_color", "idx_products_color"):
+        cursor.execute(f"DROP INDEX IF EXISTS {index}")
+
+MIGRATIONS = [
+    (1, "base_tables", _migration_base_tables),
+    (2, "carts_items_column", _migration_carts_items_column),
+    (3, "products_category", _migration_products_category),
+    (4, "filter_indexes", _migration_filter_indexes),
+    (5, "products_facets", _migration_products_facets),
+    (6, "catalog_state", _migration_catalog_state),
+    (7, "outbox", _migration_outbox),
+    (8, "carts_lifecycle", _migration_carts_lifecycle),
+    (9, "outbox_request_id", _migration_outbox_request_id),
+    (10, "drop_product_filter_indexes", _migration_drop_product_filter_indexes),
+]
+
+def apply_migrations(conn) -> List[int]:
+    """Aplica las migraciones pendientes, cada una en su transacción; devuelve las aplicadas"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )
+    ''')
+    applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+    
+    newly_applied = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.now().isoformat())
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info("✅ Migración aplicada", version=version, name=name)
+        newly_applied.append(version)
+    return newly_applied
+
+def _insert_products_from_excel(cursor, df):
+    """Inserta los productos del Excel (columnas TIPO_PRENDA, TALLA, COLOR, ...)"""
+    for _, row in df.iterrows():
+        name = f"{row.get('TIPO_PRENDA', '')} {row.get('TALLA', '')} {row.get('COLOR', '')}".strip()
+        description = f"{row.get('CATEGORÍA', '')} - {row.get('DESCRIPCIÓN', '')}".strip(' - ')
+        price = float(row.get('PRECIO_50_U', 0.0))
+        stock = int(row.get('CANTIDAD_DISPONIBLE', 0))
+        category = row.get('CATEGORÍA') or 'General'
         
-        # Crear tabla carts
         cursor.execute('''
-        CREATE TABLE carts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            items TEXT NOT NULL,
-            total_amount REAL NOT NULL,
-            total_items INTEGER NOT NULL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Cargar productos desde Excel si existe
-        if os.path.exists('products.xlsx'):
-            print("📊 Cargando productos desde Excel...")
-            df = pd.read_excel('products.xlsx')
+            INSERT INTO products (name, description, price, stock, category, product_type, size, color)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (name, description, price, stock, category,
+              row.get('TIPO_PRENDA'), row.get('TALLA'), row.get('COLOR')))
+
+@contextmanager
+def database_init_lock():
+    """Lock de archivo junto a la BD: con varios workers, uno solo inicializa a la vez
+    y los demás encuentran las migraciones aplicadas y los productos cargados"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{DB_PATH}.init.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Función para inicializar la base de datos
+def initialize_database():
+    """Aplica las migraciones pendientes y carga los productos desde Excel si la tabla está vacía"""
+    try:
+        with database_init_lock():
+            conn = get_db_connection()
+            # WAL: lectores de otros workers no se bloquean mientras uno escribe
+            conn.execute("PRAGMA journal_mode = WAL")
+            apply_migrations(conn)
+            # auto_vacuum incremental: la retención de carritos devuelve el espacio libre
+            # de a pasos; pasar una BD existente a este modo requiere un VACUUM único
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info("🧹 Activando auto_vacuum incremental (VACUUM único)")
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
             
-            for _, row in df.iterrows():
-                cursor.execute('''
-                INSERT INTO products (name, description, price, stock, category)
-                VALUES (?, ?, ?, ?, ?)
-                ''', (
-                    row['name'],
-                    row['description'],
-                    row['price'],
-                    row['stock'],
-                    row.get('category', 'General')
-                ))
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM products")
+            if cursor.fetchone()[0]:
+                logger.info("✅ Tabla 'products' ya existe")
+            elif os.path.exists('products.xlsx'):
+                logger.info("📊 Cargando productos desde Excel...")
+                df = pd.read_excel('products.xlsx')
+                _insert_products_from_excel(cursor, df)
+                conn.commit()
+                cursor.execute("ANALYZE")
+                logger.info("✅ Productos cargados", count=len(df))
+                bump_catalog_version()
+            else:
+                logger.warning("⚠️ Archivo products.xlsx no encontrado - BD creada sin productos")
             
-            print(f"✅ Cargados {len(df)} productos")
-        else:
-            print("⚠️ Archivo products.xlsx no encontrado - BD creada sin productos")
-        
-        conn.commit()
-        conn.close()
-        print("✅ Base de datos inicializada correctamente")
+            conn.close()
+        db_stats.initialized = True
+        logger.info("✅ Base de datos inicializada correctamente", pid=os.getpid())
         
-    except Exception as e:
-        print(f"❌ Error inicializando BD: {e}")
+    except Exception:
+        logger.exception("❌ Error inicializando BD")
 
 # Inicializar BD al arrancar la aplicación
 initialize_database()
@@ -103,7 +774,213 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Configurar CORS
+CATALOG_CACHE_MAX_AGE = int(os.getenv('CATALOG_CACHE_MAX_AGE', '60'))
+CATALOG_RESPONSE_CACHE_SIZE = int(os.getenv('CATALOG_RESPONSE_CACHE_SIZE', '256'))
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+
+
+def _accepted_encodings(header: str) -> set:
+    """Codificaciones de Accept-Encoding con q > 0"""
+    accepted = set()
+    for part in header.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        if name:
+            accepted.add(name)
+    return accepted
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110)"""
+    opaque = etag.removeprefix('W/')
+    return any(
+        candidate == '*' or candidate.removeprefix('W/') == opaque
+        for candidate in (part.strip() for part in header.split(','))
+    )
+
+
+class CatalogResponseCache:
+    """Respuestas GET del catálogo cacheadas por versión de catálogo, con ETag y cuerpos comprimidos.
+    
+    El catálogo solo cambia al recargarse, así que una misma URL produce el mismo cuerpo
+    mientras no cambie la versión: el ETag se deriva de (versión, URL), los clientes que ya
+    lo tienen reciben 304 sin ejecutar el endpoint, y el resto recibe los bytes cacheados
+    (gzip/brotli se calculan una vez por entrada y codificación).
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+    
+    @staticmethod
+    def cache_key(request: Request) -> str:
+        query = urlencode(sorted(request.query_params.multi_items()))
+        return f"{request.url.path}?{query}" if query else request.url.path
+    
+    @staticmethod
+    def etag(version: int, key: str) -> str:
+        return f'W/"{version}-{zlib.crc32(key.encode()):08x}"'
+    
+    def get(self, version: int, key: str) -> Optional[dict]:
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def put(self, version: int, key: str, entry: dict):
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+    
+    @staticmethod
+    def encoded_body(entry: dict, accept_encoding: str):
+        """(cuerpo, codificación) a enviar; la versión comprimida se guarda en la entrada"""
+        body = entry["body"]
+        if len(body) < COMPRESS_MIN_BYTES:
+            return body, None
+        accepted = _accepted_encodings(accept_encoding)
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+        else:
+            return body, None
+        
+        encoded = entry["encoded"].get(encoding)
+        if encoded is None:
+            if encoding == "br":
+                encoded = brotli.compress(body, quality=5)
+            else:
+                encoded = gzip.compress(body, compresslevel=6, mtime=0)
+            entry["encoded"][encoding] = encoded
+        return encoded, encoding
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "catalog_version": self._version,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+                "brotli": brotli is not None,
+            }
+
+catalog_response_cache = CatalogResponseCache(CATALOG_RESPONSE_CACHE_SIZE)
+
+
+def _resolve_route(scope: dict):
+    """Ruta que atendería el request (para las métricas de las respuestas servidas desde cache)"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+def _not_modified(request: Request, etag: str, modified_at: float) -> bool:
+    """If-None-Match (tiene prioridad) / If-Modified-Since contra una representación 200"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(modified_at) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@app.middleware("http")
+async def catalog_http_cache(request: Request, call_next):
+    """ETag / Last-Modified / Cache-Control y compresión para los GET del catálogo (/products...)"""
+    if request.method != "GET" or not request.url.path.startswith("/products"):
+        return await call_next(request)
+    
+    version = get_catalog_version()
+    key = CatalogResponseCache.cache_key(request)
+    etag = CatalogResponseCache.etag(version, key)
+    modified_at = get_catalog_modified_at()
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(modified_at, usegmt=True),
+        "Cache-Control": f"public, max-age={CATALOG_CACHE_MAX_AGE}",
+        "Vary": "Accept-Encoding",
+    }
+    
+    entry = catalog_response_cache.get(version, key)
+    if entry is None:
+        # Sin respuesta 200 cacheada: el endpoint decide (404, 422...) antes que los condicionales
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        entry = {"body": body, "media_type": response.headers.get("content-type"), "encoded": {}}
+        catalog_response_cache.put(version, key, entry)
+    else:
+        request.scope["route"] = _resolve_route(request.scope)
+    
+    if _not_modified(request, etag, modified_at):
+        catalog_response_cache.record_not_modified()
+        return Response(status_code=304, headers=headers)
+    
+    body, encoding = CatalogResponseCache.encoded_body(entry, request.headers.get("accept-encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=200, headers=headers, media_type=entry["media_type"])
+
+@app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    """Id de correlación por request; respeta X-Request-ID (llamadas de las tools del agente)"""
+    request_id = request.headers.get("x-request-id") or new_request_id()
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        request_id_var.reset(token)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Histograma de duración por ruta (plantilla de la ruta, no la URL concreta)"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        http_request_duration.observe(
+            time.perf_counter() - start,
+            request.method, route.path if route else "unmatched", status
+        )
+
+# Configurar CORS: se agrega después de los middlewares de arriba para quedar por fuera
+# de todos, así también cubre las respuestas que arma la cache del catálogo (hits y 304)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -119,6 +996,10 @@ class Product(BaseModel):
     description: str
     price: float
     stock: int
+    category: Optional[str] = None
+    product_type: Optional[str] = None
+    size: Optional[str] = None
+    color: Optional[str] = None
 
 class CartItem(BaseModel):
     product_id: int
@@ -127,6 +1008,27 @@ class CartItem(BaseModel):
 class CartCreate(BaseModel):
     items: List[CartItem]
 
+class ProductBatchGet(BaseModel):
+    ids: List[int]
+
+class ProductBatchResponse(BaseModel):
+    products: List[Product]
+    missing: List[int]
+
+class ProductSearchResponse(BaseModel):
+    query: str
+    terms: Dict[str, Optional[str]]
+    total: int
+    products: List[Product]
+
+class RecommendedProduct(Product):
+    score: float
+
+class ProductRecommendResponse(BaseModel):
+    query: str
+    concepts: List[str]
+    products: List[RecommendedProduct]
+
 class CartResponse(BaseModel):
     id: int
     items: List[dict]
@@ -140,37 +1042,30 @@ class CartResponse(BaseModel):
 def load_products():
     """Cargar productos desde Excel"""
     if not os.path.exists('products.xlsx'):
-        print("❌ No se encontró products.xlsx")
+        logger.error("❌ No se encontró products.xlsx")
         return
     
     try:
         df = pd.read_excel('products.xlsx')
-        print(f"✅ Excel leído: {len(df)} productos")
+        logger.info("✅ Excel leído", count=len(df))
         
-        conn = sqlite3.connect('laburen_app.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # Limpiar productos existentes
         cursor.execute('DELETE FROM products')
         
         # Insertar productos nuevos
-        for _, row in df.iterrows():
-            name = f"{row.get('TIPO_PRENDA', '')} {row.get('TALLA', '')} {row.get('COLOR', '')}".strip()
-            description = f"{row.get('CATEGORÍA', '')} - {row.get('DESCRIPCIÓN', '')}".strip(' - ')
-            price = float(row.get('PRECIO_50_U', 0.0))
-            stock = int(row.get('CANTIDAD_DISPONIBLE', 0))
-            
-            cursor.execute('''
-                INSERT INTO products (name, description, price, stock)
-                VALUES (?, ?, ?, ?)
-            ''', (name, description, price, stock))
+        _insert_products_from_excel(cursor, df)
         
         conn.commit()
+        cursor.execute("ANALYZE")
         conn.close()
-        print(f"✅ {len(df)} productos cargados")
+        bump_catalog_version()
+        logger.info("✅ Productos cargados", count=len(df))
         
-    except Exception as e:
-        print(f"❌ Error cargando productos: {e}")
+    except Exception:
+        logger.exception("❌ Error cargando productos")
 
 # La inicialización se hará bajo demanda en initialize_database()
 # load_products() - ya no es necesario, los productos se cargan en initialize_database()
@@ -185,197 +1080,1422 @@ def root():
         "docs": "/docs"
     }
 
-@app.get("/products", response_model=List[Product])
-def get_products(q: Optional[str] = None):
-    """Lista productos con filtro opcional"""
-    conn = sqlite3.connect('laburen_app.db')
-    cursor = conn.cursor()
-    
-    if q:
-        cursor.execute('''
-            SELECT id, name, description, price, stock 
-            FROM products 
-            WHERE name LIKE ? OR description LIKE ?
-        ''', (f'%{q}%', f'%{q}%'))
-    else:
-        cursor.execute('SELECT id, name, description, price, stock FROM products')
-    
-    products = []
-    for row in cursor.fetchall():
-        products.append(Product(
-            id=row[0],
-            name=row[1],
-            description=row[2],
-            price=row[3],
-            stock=row[4]
-        ))
-    
-    conn.close()
+PRODUCT_FIELDS = ("id", "name", "description", "price", "stock", "category", "product_type", "size", "color")
+PRODUCT_COLUMNS = ", ".join(PRODUCT_FIELDS)
+
+def product_from_row(row) -> dict:
+    return dict(zip(PRODUCT_FIELDS, row))
+
+# Serialización directa a bytes para las respuestas con datos de la BD: evita construir
+# un modelo pydantic por fila y el encoder genérico de FastAPI (los modelos siguen
+# documentando las respuestas en /docs). FAST_JSON_RESPONSES=false vuelve al camino anterior.
+FAST_JSON_RESPONSES = os.getenv('FAST_JSON_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+
+if orjson is not None:
+    def json_bytes(value) -> bytes:
+        return orjson.dumps(value)
+else:
+    def json_bytes(value) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class JSONBytesResponse(Response):
+    """Respuesta con un cuerpo JSON ya serializado"""
+    media_type = "application/json"
+
+
+def encode_product_list(encoded_products) -> bytes:
+    return b"[" + b",".join(encoded_products) + b"]"
+
+
+def encode_cart(cart_id, items_json: str, total_amount, total_items, created_at) -> bytes:
+    """Carrito en JSON insertando tal cual el texto de `items` guardado en la BD (sin loads/dumps)"""
+    return b"".join((
+        b'{"id":', json_bytes(cart_id),
+        b',"items":', items_json.encode("utf-8"),
+        b',"total_amount":', json_bytes(float(total_amount)),
+        b',"total_items":', json_bytes(total_items),
+        b',"created_at":', json_bytes(created_at),
+        b"}",
+    ))
+
+MAX_BATCH_IDS = int(os.getenv('MAX_BATCH_IDS', '100'))
+# Límite de parámetros por sentencia en builds viejos de SQLite
+SQLITE_MAX_VARIABLES = 999
+
+def fetch_products_by_ids(cursor, product_ids) -> dict:
+    """Productos por ID con una consulta IN (en tandas si superan el límite de parámetros de SQLite)"""
+    unique_ids = list(dict.fromkeys(product_ids))
+    products = {}
+    for start in range(0, len(unique_ids), SQLITE_MAX_VARIABLES):
+        chunk = unique_ids[start:start + SQLITE_MAX_VARIABLES]
+        placeholders = ",".join("?" * len(chunk))
+        cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id IN ({placeholders})", chunk)
+        for row in cursor.fetchall():
+            product = product_from_row(row)
+            products[product['id']] = product
     return products
 
-@app.get("/products/{product_id}", response_model=Product)
-def get_product(product_id: int):
-    """Obtiene un producto específico"""
-    conn = sqlite3.connect('laburen_app.db')
-    cursor = conn.cursor()
+def get_products_by_ids(product_ids: List[int]):
+    """(productos en el orden pedido, IDs inexistentes) para los endpoints de lectura en lote"""
+    if len(product_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
     
-    cursor.execute('SELECT id, name, description, price, stock FROM products WHERE id = ?', (product_id,))
-    row = cursor.fetchone()
+    conn = get_db_connection()
+    found = fetch_products_by_ids(conn.cursor(), product_ids)
     conn.close()
     
-    if not row:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    return Product(
-        id=row[0],
-        name=row[1],
-        description=row[2],
-        price=row[3],
-        stock=row[4]
+    requested = list(dict.fromkeys(product_ids))
+    return (
+        [found[product_id] for product_id in requested if product_id in found],
+        [product_id for product_id in requested if product_id not in found]
     )
 
-@app.post("/carts", response_model=CartResponse, status_code=201)
-def create_cart(cart_data: CartCreate):
-    """Crea un carrito nuevo"""
-    conn = sqlite3.connect('laburen_app.db')
-    cursor = conn.cursor()
+def build_carts_query(created_from=None, created_to=None, limit=50):
+    """Arma el SELECT de carritos por rango de created_at, del más reciente al más antiguo"""
+    conditions = []
+    params = []
     
-    # Validar productos y calcular totales
-    cart_items = []
-    total_amount = 0.0
+    if created_from:
+        conditions.append("created_at >= ?")
+        params.append(created_from)
+    if created_to:
+        conditions.append("created_at < ?")
+        params.append(created_to)
+    
+    sql = "SELECT id, items, total_amount, total_items, created_at FROM carts"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY created_at DESC LIMIT ?"
+    params.append(limit)
+    return sql, params
+
+def explain_query_plan(conn, sql, params=()):
+    """Devuelve el detalle de cada paso de EXPLAIN QUERY PLAN"""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+def full_scans(plan):
+    """Pasos del plan que recorren una tabla completa sin usar un índice"""
+    return [step for step in plan if step.startswith("SCAN ") and "INDEX" not in step]
+
+class FacetIndex:
+    """Índice en memoria del catálogo por faceta, reconstruido una vez por versión de catálogo.
+    
+    Cada valor de faceta (categoría, tipo, talle, color) apunta al conjunto de IDs que lo
+    tienen y los precios se guardan ordenados para resolver rangos con bisect. Un filtro
+    recorre solo el conjunto de candidatos más chico y verifica el resto por pertenencia,
+    así que el costo es proporcional al resultado y no al tamaño del catálogo.
+    """
+    
+    FACETS = ("category", "product_type", "size", "color")
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = (None, None)  # (versión de catálogo, snapshot)
+        self.builds = 0
+    
+    def _current(self) -> dict:
+        version = get_catalog_version()
+        built_version, snapshot = self._state
+        if built_version == version:
+            return snapshot
+        with self._lock:
+            built_version, snapshot = self._state
+            if built_version != version:
+                snapshot = self._build()
+                self._state = (version, snapshot)
+                self.builds += 1
+            return snapshot
+    
+    def _build(self) -> dict:
+        start = time.perf_counter()
+        conn = get_db_connection()
+        rows = conn.execute(f"SELECT {PRODUCT_COLUMNS} FROM products ORDER BY id").fetchall()
+        conn.close()
+        
+        products = {}
+        postings = {facet: {} for facet in self.FACETS}
+        labels = {facet: {} for facet in self.FACETS}
+        text = {}
+        in_stock = set()
+        for row in rows:
+            product = product_from_row(row)
+            product_id = product['id']
+            products[product_id] = product
+            text[product_id] = normalize_message(f"{product['name']} {product['description'] or ''}")
+            if product['stock'] > 0:
+                in_stock.add(product_id)
+            for facet in self.FACETS:
+                value = product[facet]
+                if value:
+                    key = normalize_message(value)
+                    postings[facet].setdefault(key, set()).add(product_id)
+                    labels[facet].setdefault(key, value)
+        
+        by_price = sorted(products.values(), key=lambda p: p['price'])
+        snapshot = {
+            "products": products,
+            "ids": list(products),
+            "postings": postings,
+            "labels": labels,
+            "text": text,
+            "in_stock": in_stock,
+            "out_of_stock": set(products) - in_stock,
+            "encoded": {},
+            "prices": [p['price'] for p in by_price],
+            "price_ids": [p['id'] for p in by_price],
+        }
+        snapshot["counts"] = self._count(snapshot, snapshot["ids"])
+        logger.info("🧮 Índice de facetas construido", products=len(products),
+                    duration_ms=round((time.perf_counter() - start) * 1000, 1))
+        return snapshot
+    
+    def _count(self, snapshot: dict, ids) -> dict:
+        counts = {facet: {} for facet in self.FACETS}
+        prices = []
+        available = 0
+        products = snapshot["products"]
+        for product_id in ids:
+            product = products[product_id]
+            prices.append(product['price'])
+            available += product['stock'] > 0
+            for facet in self.FACETS:
+                if product[facet]:
+                    counts[facet][product[facet]] = counts[facet].get(product[facet], 0) + 1
+        return {
+            "total": len(prices),
+            "in_stock": available,
+            "price": {"min": min(prices), "max": max(prices)} if prices else None,
+            **{facet: dict(sorted(values.items())) for facet, values in counts.items()},
+        }
+    
+    def labels(self, facet: str) -> dict:
+        """Valores de una faceta: normalizado -> como figura en el catálogo"""
+        return self._current()["labels"][facet]
+    
+    def _match(self, snapshot: dict, filters: dict, q: Optional[str]) -> List[int]:
+        # Cada restricción es (cantidad de candidatos, iterable de candidatos, verificación)
+        constraints = []
+        for facet in self.FACETS:
+            value = filters.get(facet)
+            if value:
+                ids = snapshot["postings"][facet].get(normalize_message(value), set())
+                constraints.append((len(ids), ids, ids.__contains__))
+        
+        min_price = filters.get("min_price")
+        max_price = filters.get("max_price")
+        if min_price is not None or max_price is not None:
+            prices = snapshot["prices"]
+            lo = bisect.bisect_left(prices, min_price) if min_price is not None else 0
+            hi = bisect.bisect_right(prices, max_price) if max_price is not None else len(prices)
+            products = snapshot["products"]
+            low = min_price if min_price is not None else float('-inf')
+            high = max_price if max_price is not None else float('inf')
+            constraints.append((
+                max(hi - lo, 0),
+                snapshot["price_ids"][lo:hi],
+                lambda product_id: low <= products[product_id]['price'] <= high
+            ))
+        
+        in_stock = filters.get("in_stock")
+        if in_stock is not None:
+            ids = snapshot["in_stock"] if in_stock else snapshot["out_of_stock"]
+            constraints.append((len(ids), ids, ids.__contains__))
+        
+        if constraints:
+            constraints.sort(key=lambda c: c[0])
+            checks = [check for _, _, check in constraints[1:]]
+            candidates = [product_id for product_id in constraints[0][1]
+                          if all(check(product_id) for check in checks)]
+            candidates.sort()
+        else:
+            candidates = snapshot["ids"]
+        
+        if q:
+            term = normalize_message(q)
+            text = snapshot["text"]
+            candidates = [product_id for product_id in candidates if term in text[product_id]]
+        return candidates
+    
+    def search(self, q: Optional[str] = None, limit: Optional[int] = None, **filters) -> List[dict]:
+        """Productos que cumplen todos los filtros, ordenados por ID"""
+        snapshot = self._current()
+        ids = self._match(snapshot, filters, q)
+        if limit is not None:
+            ids = ids[:limit]
+        products = snapshot["products"]
+        return [products[product_id] for product_id in ids]
+    
+    def search_json(self, q: Optional[str] = None, limit: Optional[int] = None, **filters) -> bytes:
+        """Igual que search() pero como JSON: cada producto se serializa una vez por versión de catálogo"""
+        snapshot = self._current()
+        ids = self._match(snapshot, filters, q)
+        if limit is not None:
+            ids = ids[:limit]
+        products = snapshot["products"]
+        encoded = snapshot["encoded"]
+        parts = []
+        for product_id in ids:
+            product_json = encoded.get(product_id)
+            if product_json is None:
+                product_json = encoded[product_id] = json_bytes(products[product_id])
+            parts.append(product_json)
+        return encode_product_list(parts)
+    
+    def facet_counts(self, q: Optional[str] = None, **filters) -> dict:
+        """Conteos por faceta; sin filtros devuelve los precalculados para la versión actual"""
+        snapshot = self._current()
+        if not q and all(value is None for value in filters.values()):
+            return snapshot["counts"]
+        return self._count(snapshot, self._match(snapshot, filters, q))
+    
+    def snapshot(self) -> dict:
+        version, snapshot = self._state
+        return {
+            "version": version,
+            "products": len(snapshot["products"]) if snapshot else 0,
+            "builds": self.builds,
+        }
+
+facet_index = FacetIndex()
+
+FUZZY_SEARCH_LIMIT = int(os.getenv('FUZZY_SEARCH_LIMIT', '20'))
+FUZZY_SEARCH_CACHE_SIZE = int(os.getenv('FUZZY_SEARCH_CACHE_SIZE', '4096'))
+
+
+def bounded_edit_distance(a: str, b: str, limit: int) -> int:
+    """Distancia de Damerau-Levenshtein (transposiciones adyacentes); corta en limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                value = min(value, previous2[j - 2] + 1)
+            current[j] = value
+            row_min = min(row_min, value)
+        if row_min > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+def _trigrams(word: str) -> set:
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductSearchIndex:
+    """Búsqueda tolerante a errores de tipeo sobre nombre y categoría, reconstruida una vez por versión de catálogo.
+    
+    Cada palabra de la consulta se resuelve contra el vocabulario del catálogo (más los nombres
+    locales de PRODUCT_TYPE_SYNONYMS): coincidencia exacta, prefijo o distancia de edición acotada
+    por largo, con los candidatos sacados de un índice de trigramas. Los productos con las mismas
+    palabras forman un grupo y el ranking recorre grupos en vez de productos, así que una consulta
+    cuesta lo mismo con 1k que con 100k productos de nombres repetidos.
+    """
+    
+    EXACT, PREFIX = 1.0, 0.9
+    MIN_PREFIX_CHARS = 3
+    
+    def __init__(self, cache_size: int = FUZZY_SEARCH_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._state = (None, None)  # (versión de catálogo, snapshot)
+        self.cache_size = cache_size
+        self.builds = 0
+        self.queries = 0
+        self.corrected = 0
+    
+    @staticmethod
+    def max_edits(word: str) -> int:
+        """Ediciones toleradas según el largo: talles y palabras cortas solo coinciden exactas"""
+        return 0 if len(word) <= 3 else 1 if len(word) <= 5 else 2
+    
+    def _current(self) -> dict:
+        version = get_catalog_version()
+        built_version, snapshot = self._state
+        if built_version == version:
+            return snapshot
+        with self._lock:
+            built_version, snapshot = self._state
+            if built_version != version:
+                snapshot = self._build()
+                self._state = (version, snapshot)
+                self.builds += 1
+            return snapshot
+    
+    def _build(self) -> dict:
+        start = time.perf_counter()
+        catalog = facet_index._current()
+        products = catalog["products"]
+        
+        # Los nombres se repiten: se normaliza una vez por nombre distinto y no por producto
+        by_name = {}
+        for product_id in catalog["ids"]:
+            product = products[product_id]
+            by_name.setdefault(f"{product['name']} {product['category'] or ''}", []).append(product_id)
+        
+        groups = {}
+        labels = {}
+        for name, ids in by_name.items():
+            words = frozenset(normalize_message(name).split())
+            groups.setdefault(words, []).extend(ids)
+            for word in name.split():
+                labels.setdefault(normalize_message(word), word)
+        for ids in groups.values():
+            ids.sort()
+        
+        group_words = list(groups)
+        group_ids = [groups[words] for words in group_words]
+        postings = {}
+        for index, words in enumerate(group_words):
+            for word in words:
+                postings.setdefault(word, []).append(index)
+        
+        # Los sinónimos locales entran al vocabulario como alias de la palabra del catálogo
+        aliases = {word: word for word in postings}
+        for synonym, word in PRODUCT_TYPE_SYNONYMS.items():
+            if word in postings:
+                aliases.setdefault(synonym, word)
+        trigrams = {}
+        for word in aliases:
+            for gram in _trigrams(word):
+                trigrams.setdefault(gram, []).append(word)
+        
+        snapshot = {
+            "group_ids": group_ids,
+            "postings": postings,
+            "aliases": aliases,
+            "vocabulary": sorted(aliases),
+            "trigrams": trigrams,
+            "labels": labels,
+            "products": products,
+            "resolved": OrderedDict(),
+        }
+        logger.info("🔤 Índice de búsqueda aproximada construido", products=len(catalog["ids"]),
+                    groups=len(group_ids), vocabulary=len(aliases),
+                    duration_ms=round((time.perf_counter() - start) * 1000, 1))
+        return snapshot
+    
+    def _lookup(self, snapshot: dict, word: str) -> dict:
+        """Palabras del vocabulario que coinciden con `word` en la mejor clase: exacta, prefijo o por edición"""
+        aliases = snapshot["aliases"]
+        if word in aliases:
+            return {word: self.EXACT}
+        
+        matches = {}
+        if len(word) >= self.MIN_PREFIX_CHARS:
+            vocabulary = snapshot["vocabulary"]
+            index = bisect.bisect_left(vocabulary, word)
+            while index < len(vocabulary) and vocabulary[index].startswith(word):
+                matches[vocabulary[index]] = self.PREFIX
+                index += 1
+        if matches:
+            return matches
+        
+        limit = self.max_edits(word)
+        if not limit:
+            return {}
+        # Cada edición rompe a lo sumo 3 trigramas: con menos en común no puede estar a `limit`
+        grams = _trigrams(word)
+        shared = {}
+        for gram in grams:
+            for candidate in snapshot["trigrams"].get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        needed = len(grams) - 3 * limit
+        best = limit + 1
+        for candidate, count in shared.items():
+            if count < needed:
+                continue
+            distance = bounded_edit_distance(word, candidate, limit)
+            if distance < best:
+                best, matches = distance, {}
+            if distance == best <= limit:
+                matches[candidate] = 1.0 - distance / (len(word) + 1)
+        return matches
+    
+    def _resolve(self, snapshot: dict, word: str) -> dict:
+        """Palabra de la consulta -> {palabra del catálogo: similitud}, cacheado por versión"""
+        resolved = snapshot["resolved"]
+        cached = resolved.get(word)
+        if cached is not None:
+            return cached
+        
+        matches = self._lookup(snapshot, word)
+        # Plurales y género: "remeras", "rojas", "pantalones"
+        if not matches or max(matches.values()) < self.EXACT:
+            for stem in (word[:-2] if word.endswith("es") else None, word[:-1] if word.endswith("s") else None):
+                if stem and len(stem) >= self.MIN_PREFIX_CHARS:
+                    stem_matches = self._lookup(snapshot, stem)
+                    if stem_matches and (not matches or max(stem_matches.values()) > max(matches.values())):
+                        matches = stem_matches
+        
+        aliases = snapshot["aliases"]
+        result = {}
+        for candidate, similarity in matches.items():
+            target = aliases[candidate]
+            result[target] = max(result.get(target, 0.0), similarity)
+        
+        with self._lock:
+            resolved[word] = result
+            while len(resolved) > self.cache_size:
+                resolved.popitem(last=False)
+        return result
+    
+    def search(self, q: str, limit: int = FUZZY_SEARCH_LIMIT) -> dict:
+        """Productos rankeados por las palabras de `q` que reconocen, tolerando errores de tipeo.
+        
+        Primero van los productos que coinciden con más palabras de la consulta y, entre ellos,
+        los de mayor similitud; a igual puntaje, por ID. `terms` indica cómo se interpretó cada
+        palabra (None si no coincide con nada del catálogo).
+        """
+        snapshot = self._current()
+        words = normalize_message(q).split()
+        words = [word for word in words if word not in FILTER_FILLER_WORDS] or words
+        
+        terms = {}
+        scores = {}
+        for word in words:
+            matches = self._resolve(snapshot, word)
+            terms[word] = ", ".join(snapshot["labels"].get(match, match) for match in matches) or None
+            best = {}
+            for match, similarity in matches.items():
+                for group in snapshot["postings"][match]:
+                    if similarity > best.get(group, 0.0):
+                        best[group] = similarity
+            for group, similarity in best.items():
+                matched, score = scores.get(group, (0, 0.0))
+                scores[group] = (matched + 1, score + similarity)
+        
+        self.queries += 1
+        self.corrected += any(label is not None and word not in snapshot["aliases"] for word, label in terms.items())
+        
+        group_ids = snapshot["group_ids"]
+        most = max((matched for matched, _ in scores.values()), default=0)
+        ranked = sorted(((-score, group) for group, (matched, score) in scores.items() if matched == most))
+        total = sum(len(group_ids[group]) for _, group in ranked)
+        
+        # Por nivel de puntaje, los IDs de todos sus grupos intercalados en orden
+        ids = []
+        for _, tier in itertools.groupby(ranked, key=lambda item: item[0]):
+            if len(ids) >= limit:
+                break
+            merged = heapq.merge(*(group_ids[group] for _, group in tier))
+            ids.extend(itertools.islice(merged, limit - len(ids)))
+        
+        products = snapshot["products"]
+        return {
+            "query": q,
+            "terms": terms,
+            "total": total,
+            "products": [products[product_id] for product_id in ids],
+        }
+    
+    def snapshot(self) -> dict:
+        version, snapshot = self._state
+        return {
+            "version": version,
+            "groups": len(snapshot["group_ids"]) if snapshot else 0,
+            "vocabulary": len(snapshot["aliases"]) if snapshot else 0,
+            "cached_terms": len(snapshot["resolved"]) if snapshot else 0,
+            "builds": self.builds,
+            "queries": self.queries,
+            "corrected": self.corrected,
+        }
+
+product_search_index = ProductSearchIndex()
+
+RECOMMEND_TOP_K = int(os.getenv('RECOMMEND_TOP_K', '5'))
+RECOMMEND_MIN_SCORE = float(os.getenv('RECOMMEND_MIN_SCORE', '0.05'))
+
+# Ocasiones y necesidades -> palabras con las que el catálogo describe lo que les sirve (normalizadas)
+RECOMMENDATION_CONCEPTS = {
+    "verano": "ligera comoda camiseta falda aire libre blanco amarillo",
+    "calor": "ligera comoda camiseta falda blanco",
+    "playa": "ligera camiseta falda aire libre casual",
+    "vacaciones": "casual ligera comoda aire libre",
+    "invierno": "chaqueta sudadera pantalon abrigo",
+    "frio": "chaqueta sudadera pantalon abrigo",
+    "abrigo": "chaqueta sudadera",
+    "fiesta": "formal elegante diseno moderno camisa falda negro",
+    "casamiento": "formal elegante camisa pantalon falda",
+    "boda": "formal elegante camisa pantalon falda",
+    "cena": "formal elegante camisa falda",
+    "elegante": "formal elegante diseno moderno",
+    "oficina": "formal camisa pantalon calidad",
+    "trabajo": "formal camisa pantalon uso diario",
+    "entrevista": "formal camisa pantalon elegante",
+    "reunion": "formal camisa elegante",
+    "gimnasio": "deportivo sudadera camiseta comoda",
+    "gym": "deportivo sudadera camiseta comoda",
+    "deporte": "deportivo sudadera camiseta comoda",
+    "entrenar": "deportivo sudadera camiseta comoda",
+    "correr": "deportivo camiseta ligera aire libre",
+    "running": "deportivo camiseta ligera aire libre",
+    "futbol": "deportivo camiseta sudadera",
+    "camping": "aire libre actividades chaqueta pantalon",
+    "trekking": "aire libre actividades chaqueta pantalon deportivo",
+    "montana": "aire libre actividades chaqueta sudadera",
+    "excursion": "aire libre actividades chaqueta",
+    "diario": "uso diario casual camiseta pantalon",
+    "cotidiano": "uso diario casual",
+    "facultad": "uso diario casual camiseta sudadera",
+    "comodo": "comoda ligera casual",
+    "regalo": "alta calidad elegante diseno moderno",
+    "regalar": "alta calidad elegante diseno moderno",
+    "cumpleanos": "alta calidad elegante diseno moderno",
+    "oscuro": "negro gris azul",
+    "claro": "blanco amarillo",
+    "colorido": "rojo amarillo verde azul",
+}
+RECOMMENDATION_STOPWORDS = {
+    "algo", "para", "mi", "mis", "tu", "su", "me", "te", "se", "lo", "le", "les", "que", "recomendas",
+    "recomiendas", "recomendame", "recomienda", "recomendar", "sugeri", "sugerime", "ir", "usar",
+    "ponerme", "puedo", "podria", "sirva", "sirve", "bueno", "buena", "es", "al", "como", "mas", "muy",
+}
+# Peso de las palabras que aporta un concepto frente a las que escribió el usuario
+RECOMMENDATION_CONCEPT_WEIGHT = 0.6
+
+
+def recommendation_stem(word: str) -> str:
+    """Raíz de una palabra normalizada: sin plural ni vocal final ("negras" y "negro" -> "negr")"""
+    for candidate in (word, word[:-1], word[:-2]):
+        if candidate in PRODUCT_TYPE_SYNONYMS:
+            word = PRODUCT_TYPE_SYNONYMS[candidate]
+            break
+    if len(word) > 3 and word.endswith("s"):
+        word = word[:-1]
+    if len(word) > 3 and word[-1] in "aeo":
+        word = word[:-1]
+    return word
+
+
+class ProductRecommender:
+    """Recomendaciones por similitud de texto (TF-IDF) entre un pedido abierto y nombre/descripción de los productos.
+    
+    Cada texto distinto del catálogo es una fila de una matriz NumPy con la frecuencia de sus
+    raíces; al cambiar la versión de catálogo solo se vectorizan los productos nuevos o con
+    texto cambiado y se recalculan en bloque los pesos IDF y la normalización. La consulta se
+    expande con RECOMMENDATION_CONCEPTS ("verano" -> ligera, camiseta, falda...) y se resuelve
+    con un producto matriz-vector; se devuelve un producto en stock por nombre para no repetir
+    la misma prenda.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._state = None
+        # Estado incremental: se conserva entre versiones de catálogo
+        self._texts = {}        # product_id -> texto del producto
+        self._rows = {}         # texto -> fila
+        self._row_ids = []      # fila -> IDs de productos con ese texto
+        self._vocabulary = {}   # raíz -> columna
+        self._tf = np.zeros((0, 0), dtype=np.float32)
+        self.builds = 0
+        self.vectorized = 0
+        self.queries = 0
+    
+    @staticmethod
+    def product_text(product: dict) -> str:
+        return f"{product['name']} {product['description'] or ''} {product['category'] or ''}"
+    
+    def _current(self) -> dict:
+        version = get_catalog_version()
+        if self._version == version:
+            return self._state
+        with self._lock:
+            if self._version != version:
+                self._state = self._update(facet_index._current()["products"])
+                self._version = version
+                self.builds += 1
+            return self._state
+    
+    def _row_for(self, text: str) -> int:
+        row = self._rows.get(text)
+        if row is not None:
+            return row
+        stems = [recommendation_stem(word) for word in normalize_message(text).split()]
+        for stem in stems:
+            self._vocabulary.setdefault(stem, len(self._vocabulary))
+        row = len(self._row_ids)
+        rows, columns = self._tf.shape
+        if row >= rows or len(self._vocabulary) > columns:
+            # Crecer por duplicación para no copiar la matriz en cada fila nueva
+            grown = np.zeros((max(rows * 2, row + 1, 64), max(columns * 2, len(self._vocabulary), 64)),
+                             dtype=np.float32)
+            grown[:rows, :columns] = self._tf
+            self._tf = grown
+        for stem in stems:
+            self._tf[row, self._vocabulary[stem]] += 1.0
+        self._rows[text] = row
+        self._row_ids.append([])
+        return row
+    
+    def _update(self, products: dict) -> dict:
+        start = time.perf_counter()
+        vectorized = 0
+        for product_id in set(self._texts) - set(products):
+            self._row_ids[self._rows[self._texts.pop(product_id)]].remove(product_id)
+        for product_id, product in products.items():
+            text = self.product_text(product)
+            previous = self._texts.get(product_id)
+            if previous == text:
+                continue
+            if previous is not None:
+                self._row_ids[self._rows[previous]].remove(product_id)
+            new_row = text not in self._rows
+            self._row_ids[self._row_for(text)].append(product_id)
+            self._texts[product_id] = text
+            vectorized += new_row
+        self.vectorized += vectorized
+        
+        # IDF por producto (los textos repetidos pesan tantas veces como productos los usan)
+        rows = len(self._row_ids)
+        columns = len(self._vocabulary)
+        tf = self._tf[:rows, :columns]
+        counts = np.array([len(ids) for ids in self._row_ids], dtype=np.float32)
+        df = (tf > 0).T.astype(np.float32) @ counts
+        idf = np.log((1.0 + counts.sum()) / (1.0 + df)) + 1.0
+        weighted = tf * idf
+        norms = np.linalg.norm(weighted, axis=1)
+        norms[norms == 0] = 1.0
+        matrix = weighted / norms[:, None]
+        matrix[counts == 0] = 0.0
+        
+        logger.info("🧭 Índice de recomendaciones actualizado", products=len(products), texts=rows,
+                    vocabulary=columns, vectorized=vectorized,
+                    duration_ms=round((time.perf_counter() - start) * 1000, 1))
+        return {
+            "matrix": matrix,
+            "idf": idf,
+            "vocabulary": dict(self._vocabulary),
+            "row_ids": [sorted(ids) for ids in self._row_ids],
+            "products": products,
+        }
+    
+    def _query_vector(self, state: dict, q: str):
+        """Vector de la consulta y conceptos reconocidos"""
+        weights = {}
+        concepts = []
+        stopwords = FILTER_FILLER_WORDS | RECOMMENDATION_STOPWORDS
+        for word in normalize_message(q).split():
+            if word in stopwords:
+                continue
+            stem = recommendation_stem(word)
+            weights[stem] = max(weights.get(stem, 0.0), 1.0)
+            expansion = RECOMMENDATION_CONCEPTS.get(word) or RECOMMENDATION_CONCEPTS.get(stem)
+            if expansion:
+                concepts.append(word)
+                for related in expansion.split():
+                    related = recommendation_stem(related)
+                    weights[related] = max(weights.get(related, 0.0), RECOMMENDATION_CONCEPT_WEIGHT)
+        
+        vocabulary = state["vocabulary"]
+        vector = np.zeros(len(vocabulary), dtype=np.float32)
+        for stem, weight in weights.items():
+            column = vocabulary.get(stem)
+            if column is not None:
+                vector[column] = weight
+        vector *= state["idf"]
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else None), concepts
+    
+    def recommend(self, q: str, k: int = RECOMMEND_TOP_K, in_stock: bool = True,
+                  min_score: float = RECOMMEND_MIN_SCORE) -> dict:
+        """Los `k` productos más parecidos a un pedido abierto ("algo para el verano"), con su similitud"""
+        state = self._current()
+        self.queries += 1
+        vector, concepts = self._query_vector(state, q)
+        result = {"query": q, "concepts": concepts, "products": []}
+        if vector is None:
+            return result
+        
+        scores = state["matrix"] @ vector
+        candidates = int(np.count_nonzero(scores >= min_score))
+        if not candidates:
+            return result
+        # Alcanza con ordenar las mejores filas; si no rinden k productos en stock se ordena el resto
+        top = min(candidates, k * 4)
+        order = np.argpartition(-scores, top - 1)[:top]
+        order = order[np.argsort(-scores[order], kind="stable")]
+        
+        products = state["products"]
+        picked = []
+        seen = set()
+        names = set()
+        for rows in (order, np.argsort(-scores, kind="stable")[:candidates]):
+            for row in rows:
+                row = int(row)
+                if len(picked) >= k:
+                    break
+                if row in seen:
+                    continue
+                seen.add(row)
+                for product_id in state["row_ids"][row]:
+                    product = products[product_id]
+                    if product['name'] not in names and (not in_stock or product['stock'] > 0):
+                        names.add(product['name'])
+                        picked.append(dict(product, score=round(float(scores[row]), 4)))
+                        break
+            if len(picked) >= k or top == candidates:
+                break
+        result["products"] = picked
+        return result
+    
+    def snapshot(self) -> dict:
+        state = self._state
+        return {
+            "version": self._version,
+            "texts": len(state["row_ids"]) if state else 0,
+            "vocabulary": len(state["vocabulary"]) if state else 0,
+            "builds": self.builds,
+            "vectorized_texts": self.vectorized,
+            "queries": self.queries,
+        }
+
+product_recommender = ProductRecommender()
+
+@app.get("/products", response_model=List[Product])
+def get_products(
+    ids: Optional[str] = None,
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    product_type: Optional[str] = None,
+    size: Optional[str] = None,
+    color: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    in_stock: Optional[bool] = None
+):
+    """Lista productos con búsqueda por texto y filtros por categoría, tipo, talle, color, precio y stock.
+    
+    Con `ids=1,2,3` devuelve esos productos en ese orden (los inexistentes se omiten) y
+    no aplica el resto de los filtros.
+    """
+    if ids is not None:
+        try:
+            product_ids = [int(part) for part in ids.split(',') if part.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+        products = get_products_by_ids(product_ids)[0]
+        if FAST_JSON_RESPONSES:
+            return JSONBytesResponse(encode_product_list([json_bytes(product) for product in products]))
+        return products
+    
+    filters = dict(
+        q=q, category=category, product_type=product_type, size=size, color=color,
+        min_price=min_price, max_price=max_price, in_stock=in_stock
+    )
+    if FAST_JSON_RESPONSES:
+        return JSONBytesResponse(facet_index.search_json(**filters))
+    return facet_index.search(**filters)
+
+@app.get("/products/facets")
+def get_product_facets(
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    product_type: Optional[str] = None,
+    size: Optional[str] = None,
+    color: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    in_stock: Optional[bool] = None
+):
+    """Conteos por categoría, tipo, talle y color (y rango de precios) de los productos que cumplen los filtros"""
+    counts = facet_index.facet_counts(
+        q=q, category=category, product_type=product_type, size=size, color=color,
+        min_price=min_price, max_price=max_price, in_stock=in_stock
+    )
+    return {"catalog_version": get_catalog_version(), **counts}
+
+@app.get("/products/search", response_model=ProductSearchResponse)
+def search_products(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(FUZZY_SEARCH_LIMIT, ge=1, le=100)
+):
+    """Búsqueda tolerante a errores de tipeo ("remra negr"), rankeada por coincidencia con el nombre y la categoría"""
+    result = product_search_index.search(q, limit)
+    if FAST_JSON_RESPONSES:
+        return JSONBytesResponse(json_bytes(result))
+    return result
+
+@app.get("/products/recommend", response_model=ProductRecommendResponse)
+def recommend_products(
+    q: str = Query(..., min_length=1),
+    k: int = Query(RECOMMEND_TOP_K, ge=1, le=50),
+    in_stock: bool = True
+):
+    """Productos más parecidos a un pedido abierto ("algo para el verano", "regalo para mi papá")"""
+    result = product_recommender.recommend(q, k, in_stock=in_stock)
+    if FAST_JSON_RESPONSES:
+        return JSONBytesResponse(json_bytes(result))
+    return result
+
+@app.post("/products:batchGet", response_model=ProductBatchResponse)
+def batch_get_products(request: ProductBatchGet):
+    """Devuelve varios productos en una sola consulta, junto con los IDs que no existen"""
+    products, missing = get_products_by_ids(request.ids)
+    return ProductBatchResponse(products=products, missing=missing)
+
+@app.get("/products/{product_id}", response_model=Product)
+def get_product(product_id: int):
+    """Obtiene un producto específico"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(f'SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ?', (product_id,))
+    row = cursor.fetchone()
+    conn.close()
+    
+    if not row:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    if FAST_JSON_RESPONSES:
+        return JSONBytesResponse(json_bytes(product_from_row(row)))
+    return Product(**product_from_row(row))
+
+def cart_response(cart_id, items_json: str, total_amount, total_items, created_at, status_code: int = 200):
+    """Respuesta de un carrito a partir de sus columnas en la BD"""
+    if FAST_JSON_RESPONSES:
+        return JSONBytesResponse(encode_cart(cart_id, items_json, total_amount, total_items, created_at),
+                                 status_code=status_code)
+    return CartResponse(
+        id=cart_id,
+        items=json.loads(items_json),
+        total_amount=total_amount,
+        total_items=total_items,
+        created_at=created_at
+    )
+
+def insert_cart(cart_data: CartCreate) -> dict:
+    """Valida los items y guarda un carrito nuevo; devuelve sus columnas (items ya serializados)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    # Validar productos y calcular totales
+    cart_items = []
+    total_amount = 0.0
     total_items = 0
     
+    # Todos los productos del carrito en una sola consulta
+    products = fetch_products_by_ids(cursor, [item.product_id for item in cart_data.items])
+    
     for item in cart_data.items:
         # Verificar producto existe y tiene stock
-        cursor.execute('SELECT id, name, price, stock FROM products WHERE id = ?', (item.product_id,))
-        product = cursor.fetchone()
+        product = products.get(item.product_id)
         
         if not product:
             conn.close()
             raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
         
-        if product[3] < item.qty:  # stock < qty
+        if product['stock'] < item.qty:
             conn.close()
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product[1]}")
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
         
         cart_items.append({
             "product_id": item.product_id,
-            "name": product[1],
-            "price": product[2],
+            "name": product['name'],
+            "price": product['price'],
             "qty": item.qty
         })
         
-        total_amount += product[2] * item.qty
+        total_amount += product['price'] * item.qty
         total_items += item.qty
     
     # Guardar carrito
+    items_json = json.dumps(cart_items)
+    created_at = datetime.now().isoformat()
     cursor.execute('''
-        INSERT INTO carts (items, total_amount, total_items, created_at)
-        VALUES (?, ?, ?, ?)
-    ''', (json.dumps(cart_items), total_amount, total_items, datetime.now().isoformat()))
+        INSERT INTO carts (items, total_amount, total_items, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (items_json, total_amount, total_items, created_at, created_at))
     
     cart_id = cursor.lastrowid
     conn.commit()
     conn.close()
     
-    return CartResponse(
-        id=cart_id,
-        items=cart_items,
-        total_amount=total_amount,
-        total_items=total_items,
-        created_at=datetime.now().isoformat()
-    )
+    return {
+        "id": cart_id,
+        "items": cart_items,
+        "items_json": items_json,
+        "total_amount": total_amount,
+        "total_items": total_items,
+        "created_at": created_at
+    }
+
+@app.post("/carts", response_model=CartResponse, status_code=201)
+def create_cart(cart_data: CartCreate):
+    """Crea un carrito nuevo"""
+    cart = insert_cart(cart_data)
+    return cart_response(cart["id"], cart["items_json"], cart["total_amount"], cart["total_items"],
+                         cart["created_at"], status_code=201)
+
+@app.get("/carts", response_model=List[CartResponse])
+def list_carts(
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500)
+):
+    """Lista carritos creados en un rango de fechas (ISO 8601, created_to exclusivo)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    sql, params = build_carts_query(created_from, created_to, limit)
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    conn.close()
+    
+    if FAST_JSON_RESPONSES:
+        return JSONBytesResponse(b"[" + b",".join(encode_cart(*row) for row in rows) + b"]")
+    return [
+        CartResponse(
+            id=row[0],
+            items=json.loads(row[1]),
+            total_amount=row[2],
+            total_items=row[3],
+            created_at=row[4]
+        )
+        for row in rows
+    ]
 
 @app.get("/carts/{cart_id}", response_model=CartResponse)
 def get_cart(cart_id: int):
     """Obtiene un carrito específico"""
-    conn = sqlite3.connect('laburen_app.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('SELECT id, items, total_amount, total_items, created_at FROM carts WHERE id = ?', (cart_id,))
     row = cursor.fetchone()
+    if not row:
+        # Los carritos vencidos se siguen pudiendo consultar desde el archivo
+        cursor.execute('SELECT id, items, total_amount, total_items, created_at FROM carts_archive WHERE id = ?', (cart_id,))
+        row = cursor.fetchone()
+        if row:
+            row = (row[0], zlib.decompress(row[1]).decode('utf-8')) + tuple(row[2:])
     conn.close()
     
     if not row:
         raise HTTPException(status_code=404, detail="Cart not found")
     
-    return CartResponse(
-        id=row[0],
-        items=json.loads(row[1]),
-        total_amount=row[2],
-        total_items=row[3],
-        created_at=row[4]
-    )
+    return cart_response(*row)
 
-@app.patch("/carts/{cart_id}", response_model=CartResponse)
-def update_cart(cart_id: int, cart_data: CartCreate):
-    """Actualiza un carrito existente"""
-    conn = sqlite3.connect('laburen_app.db')
+def raise_missing_cart(cart_id: int):
+    """404 si el carrito no existe; 410 si venció por inactividad y está archivado (solo lectura)"""
+    conn = get_db_connection()
+    archived = conn.execute('SELECT 1 FROM carts_archive WHERE id = ?', (cart_id,)).fetchone()
+    conn.close()
+    if archived:
+        raise HTTPException(status_code=410, detail="Cart expired")
+    raise HTTPException(status_code=404, detail="Cart not found")
+
+def replace_cart_items(cart_id: int, cart_data: CartCreate) -> dict:
+    """Valida los items y reemplaza los de un carrito existente; devuelve sus columnas"""
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # Verificar que existe el carrito
-    cursor.execute('SELECT id FROM carts WHERE id = ?', (cart_id,))
-    if not cursor.fetchone():
+    cursor.execute('SELECT created_at FROM carts WHERE id = ?', (cart_id,))
+    existing = cursor.fetchone()
+    if not existing:
         conn.close()
-        raise HTTPException(status_code=404, detail="Cart not found")
+        raise_missing_cart(cart_id)
     
     # Recalcular totales
     cart_items = []
     total_amount = 0.0
     total_items = 0
     
+    products = fetch_products_by_ids(cursor, [item.product_id for item in cart_data.items if item.qty > 0])
+    
     for item in cart_data.items:
         if item.qty <= 0:
             continue  # Saltar items con qty 0 (eliminar)
             
-        cursor.execute('SELECT id, name, price, stock FROM products WHERE id = ?', (item.product_id,))
-        product = cursor.fetchone()
+        product = products.get(item.product_id)
         
         if not product:
             conn.close()
             raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
         
-        if product[3] < item.qty:
+        if product['stock'] < item.qty:
             conn.close()
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product[1]}")
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
         
         cart_items.append({
             "product_id": item.product_id,
-            "name": product[1],
-            "price": product[2],
+            "name": product['name'],
+            "price": product['price'],
             "qty": item.qty
         })
         
-        total_amount += product[2] * item.qty
+        total_amount += product['price'] * item.qty
         total_items += item.qty
     
     # Actualizar carrito
+    items_json = json.dumps(cart_items)
     cursor.execute('''
         UPDATE carts 
-        SET items = ?, total_amount = ?, total_items = ?
+        SET items = ?, total_amount = ?, total_items = ?, updated_at = ?
         WHERE id = ?
-    ''', (json.dumps(cart_items), total_amount, total_items, cart_id))
+    ''', (items_json, total_amount, total_items, datetime.now().isoformat(), cart_id))
+    updated = cursor.rowcount
     
     conn.commit()
     conn.close()
+    if not updated:
+        raise_missing_cart(cart_id)  # se archivó mientras se validaban los items
     
-    return CartResponse(
-        id=cart_id,
-        items=cart_items,
-        total_amount=total_amount,
-        total_items=total_items,
-        created_at=datetime.now().isoformat()
-    )
+    return {
+        "id": cart_id,
+        "items": cart_items,
+        "items_json": items_json,
+        "total_amount": total_amount,
+        "total_items": total_items,
+        "created_at": existing[0]
+    }
+
+@app.patch("/carts/{cart_id}", response_model=CartResponse)
+def update_cart(cart_id: int, cart_data: CartCreate):
+    """Actualiza un carrito existente"""
+    cart = replace_cart_items(cart_id, cart_data)
+    return cart_response(cart["id"], cart["items_json"], cart["total_amount"], cart["total_items"],
+                         cart["created_at"])
+
+# Retención de carritos: los que no se tocan en CART_EXPIRY_DAYS se mueven a
+# carts_archive con los items comprimidos (zlib), el archivo se purga después
+# de CART_ARCHIVE_RETENTION_DAYS y las páginas liberadas se devuelven al
+# sistema con incremental_vacuum. Corre en un hilo de fondo; con varios
+# workers, un lease en la BD hace que solo uno lo ejecute por intervalo.
+CART_EXPIRY_DAYS = float(os.getenv('CART_EXPIRY_DAYS', '7'))
+CART_ARCHIVE_RETENTION_DAYS = float(os.getenv('CART_ARCHIVE_RETENTION_DAYS', '180'))
+CART_RETENTION_INTERVAL_SECONDS = float(os.getenv('CART_RETENTION_INTERVAL_SECONDS', '3600'))
+CART_RETENTION_BATCH_SIZE = int(os.getenv('CART_RETENTION_BATCH_SIZE', '500'))
+VACUUM_PAGES_PER_STEP = int(os.getenv('VACUUM_PAGES_PER_STEP', '256'))
+
+CART_EXPIRED_MESSAGE = "⌛ Ese carrito venció por inactividad. Decime qué productos querés y armamos uno nuevo."
+
+
+def acquire_maintenance_lease(conn, name: str, owner: str, seconds: float) -> bool:
+    """Toma (o renueva) el lease `name` si está libre o vencido; True si quedó a nombre de `owner`"""
+    now = time.time()
+    cursor = conn.execute('''
+        INSERT INTO maintenance_leases (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE maintenance_leases.expires_at <= ? OR maintenance_leases.owner = excluded.owner
+    ''', (name, owner, now + seconds, now))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+class CartRetention:
+    """Expira y archiva carritos inactivos, purga el archivo viejo y compacta la BD de a pasos"""
+    
+    LEASE_NAME = "cart_retention"
+    ANALYZED_TABLES = ("carts", "carts_archive", "outbox")
+    
+    def __init__(self, expiry_days: float, archive_retention_days: float, interval_seconds: float,
+                 batch_size: int, vacuum_pages: int):
+        self.expiry_days = expiry_days
+        self.archive_retention_days = archive_retention_days
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"runs": 0, "skipped": 0, "archived": 0, "purged": 0, "vacuumed_pages": 0}
+        self._last_run = None
+    
+    @property
+    def owner(self) -> str:
+        return f"{platform.node()}:{os.getpid()}"
+    
+    def start(self):
+        with self._lock:
+            if self._thread:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="cart-retention", daemon=True)
+            self._thread.start()
+    
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread:
+            self._stop.set()
+            thread.join(timeout)
+    
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("❌ Error en la retención de carritos")
+            self._stop.wait(self.interval_seconds)
+    
+    def run_once(self, now: Optional[datetime] = None, force: bool = False) -> dict:
+        """Una pasada completa; `now` permite simular el paso del tiempo en benchmarks"""
+        now = now or datetime.now()
+        conn = get_db_connection()
+        try:
+            if not force and not acquire_maintenance_lease(conn, self.LEASE_NAME, self.owner, self.interval_seconds):
+                with self._lock:
+                    self._stats["skipped"] += 1
+                return {"skipped": True}
+            
+            start = time.perf_counter()
+            archived = self.archive_expired(conn, (now - timedelta(days=self.expiry_days)).isoformat(), now.isoformat())
+            purged = self.purge_archive(conn, (now - timedelta(days=self.archive_retention_days)).isoformat())
+            vacuumed = self.incremental_vacuum(conn)
+            self.refresh_table_stats(conn)
+            # Devuelve al sistema el WAL que crecieron los lotes anteriores
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        finally:
+            conn.close()
+        
+        result = {
+            "archived": archived,
+            "purged": purged,
+            "vacuumed_pages": vacuumed,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+            "ran_at": now.isoformat()
+        }
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["archived"] += archived
+            self._stats["purged"] += purged
+            self._stats["vacuumed_pages"] += vacuumed
+            self._last_run = result
+        if archived or purged or vacuumed:
+            logger.info("🧹 Retención de carritos", **result)
+        return result
+    
+    def archive_expired(self, conn, cutoff: str, archived_at: str) -> int:
+        """Mueve al archivo los carritos sin actividad desde `cutoff`, en lotes cortos"""
+        total = 0
+        while True:
+            # IMMEDIATE: un PATCH concurrente no puede actualizar un carrito que se está archivando
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute('''
+                    SELECT id, items, total_amount, total_items, created_at, updated_at FROM carts
+                    WHERE updated_at < ? ORDER BY updated_at LIMIT ?
+                ''', (cutoff, self.batch_size)).fetchall()
+                conn.executemany('''
+                    INSERT OR REPLACE INTO carts_archive
+                        (id, items, total_amount, total_items, created_at, updated_at, archived_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(row[0], zlib.compress(row[1].encode('utf-8'))) + tuple(row[2:]) + (archived_at,) for row in rows])
+                conn.executemany("DELETE FROM carts WHERE id = ?", [(row[0],) for row in rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            total += len(rows)
+            if len(rows) < self.batch_size:
+                return total
+    
+    def purge_archive(self, conn, cutoff: str) -> int:
+        """Borra del archivo los carritos archivados antes de `cutoff`"""
+        total = 0
+        while True:
+            cursor = conn.execute('''
+                DELETE FROM carts_archive WHERE id IN (
+                    SELECT id FROM carts_archive WHERE archived_at < ? LIMIT ?
+                )
+            ''', (cutoff, self.batch_size))
+            conn.commit()
+            total += cursor.rowcount
+            if cursor.rowcount < self.batch_size:
+                return total
+    
+    def refresh_table_stats(self, conn):
+        """ANALYZE muestreado de las tablas que crecen: /debug/database cuenta filas desde sqlite_stat1"""
+        conn.execute("PRAGMA analysis_limit = 1000")
+        for table in self.ANALYZED_TABLES:
+            conn.execute(f"ANALYZE {table}")
+        conn.commit()
+    
+    def incremental_vacuum(self, conn) -> int:
+        """Libera las páginas vacías del archivo de a `vacuum_pages` por transacción"""
+        freed = 0
+        while True:
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return freed
+            # executescript corre el pragma hasta el final (execute libera una sola página por paso)
+            conn.executescript(f"PRAGMA incremental_vacuum({min(free, self.vacuum_pages)});")
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if remaining >= free:
+                return freed  # auto_vacuum no es INCREMENTAL: no hay nada que liberar así
+            freed += free - remaining
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "running": bool(self._thread),
+                "expiry_days": self.expiry_days,
+                "archive_retention_days": self.archive_retention_days,
+                "interval_seconds": self.interval_seconds,
+                "last_run": self._last_run,
+                **self._stats
+            }
+
+
+cart_retention = CartRetention(
+    expiry_days=CART_EXPIRY_DAYS,
+    archive_retention_days=CART_ARCHIVE_RETENTION_DAYS,
+    interval_seconds=CART_RETENTION_INTERVAL_SECONDS,
+    batch_size=CART_RETENTION_BATCH_SIZE,
+    vacuum_pages=VACUUM_PAGES_PER_STEP
+)
+
+@app.on_event("startup")
+def start_cart_retention():
+    cart_retention.start()
+
+@app.on_event("shutdown")
+def stop_cart_retention():
+    cart_retention.stop()
+
+def estimated_row_counts(conn) -> dict:
+    """Filas por tabla según sqlite_stat1 (último ANALYZE), sin recorrer las tablas"""
+    try:
+        return dict(conn.execute("SELECT tbl, MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 GROUP BY tbl").fetchall())
+    except sqlite3.Error:
+        return {}  # nunca se corrió ANALYZE
+
+def database_size_report(conn, exact: bool = False) -> dict:
+    """Tamaño del archivo, páginas libres y filas por tabla.
+    
+    Por defecto las filas salen de sqlite_stat1 (aproximadas, None si la tabla no
+    se analizó) y no se recorre nada; con `exact` se cuentan con COUNT(*) y se
+    suman los bytes por tabla desde dbstat, recorriendo todas las páginas.
+    """
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+    table_bytes = None
+    if exact:
+        rows = {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+        try:
+            table_bytes = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall())
+        except sqlite3.Error:
+            pass  # SQLite compilado sin SQLITE_ENABLE_DBSTAT_VTAB
+    else:
+        estimates = estimated_row_counts(conn)
+        rows = {table: estimates.get(table) for table in tables}
+    wal_path = f"{DB_PATH}-wal"
+    return {
+        "file_bytes": page_size * page_count,
+        "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_pages": freelist,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, auto_vacuum),
+        "rows": rows,
+        "rows_exact": exact,
+        "table_bytes": table_bytes
+    }
+
+# Probes: solo leen estado en memoria (contadores de SQLite, versión de catálogo
+# ya leída, colas y breakers), así que son baratos y no toman locks de la BD
+PROCESS_STARTED_AT = time.time()
+
+@app.get("/livez")
+def livez():
+    """Liveness: el proceso atiende requests"""
+    return {"status": "ok", "pid": os.getpid(), "uptime_seconds": round(time.time() - PROCESS_STARTED_AT, 3)}
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    """Alias de /livez (compatibilidad con health checks configurados antes)"""
+    return livez()
 
-@app.get("/debug/database")
-def debug_database():
-    """Endpoint para verificar el estado de la base de datos"""
+@app.get("/readyz")
+def readyz():
+    """Readiness: 503 si la BD no se inicializó o falló después de la última consulta exitosa.
+    Los breakers abiertos marcan "degraded" pero la instancia sigue recibiendo tráfico."""
+    version, modified_at, read_at = _catalog_state
+    scheduler = llm_scheduler.snapshot()
+    outbox = outbound_sender.runtime_snapshot()
+    breakers = {name: breaker.snapshot()["state"] for name, breaker in circuit_breakers.items()}
+    
+    degraded = [f"{name}_breaker_{state}" for name, state in breakers.items() if state != CircuitBreaker.CLOSED]
+    ready = db_stats.healthy
+    
+    payload = {
+        "status": "not_ready" if not ready else ("degraded" if degraded else "ready"),
+        "degraded": degraded,
+        "pid": os.getpid(),
+        "checks": {
+            "database": dict(db_stats.snapshot(), ok=ready),
+            "catalog": {
+                "version": version,
+                "modified_at": modified_at,
+                "checked_seconds_ago": round(time.monotonic() - read_at, 3) if read_at > float('-inf') else None,
+                "indexed_products": facet_index.snapshot()["products"],
+            },
+            "queues": {
+                "llm_scheduler": {key: scheduler[key] for key in ("queue_depth", "in_flight", "max_concurrency")},
+                "outbox": outbox,
+            },
+            "breakers": breakers,
+        },
+    }
+    return JSONBytesResponse(json_bytes(payload), status_code=200 if ready else 503)
+
+DEBUG_STATS_TTL_SECONDS = float(os.getenv('DEBUG_STATS_TTL_SECONDS', '30'))
+
+
+class DatabaseReportCache:
+    """Reporte de /debug/database cacheado: se regenera como mucho una vez por TTL y,
+    si está vencido, se sirve el anterior mientras un hilo lo recalcula"""
+    
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._report = None
+        self._generated_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+    
+    def get(self) -> tuple:
+        """(reporte, antigüedad en segundos)"""
+        with self._lock:
+            report, generated_at = self._report, self._generated_at
+            stale = time.monotonic() - generated_at >= self.ttl_seconds
+            refresh_in_background = stale and report is not None and not self._refreshing
+            if refresh_in_background:
+                self._refreshing = True
+        if report is None:
+            report = self._refresh()  # primera vez: no hay nada que servir
+        elif refresh_in_background:
+            threading.Thread(target=self._refresh, name="debug-db-stats", daemon=True).start()
+        return report, round(time.monotonic() - self._generated_at, 3)
+    
+    def _refresh(self) -> dict:
+        try:
+            report = build_database_report()
+            with self._lock:
+                self._report, self._generated_at = report, time.monotonic()
+            return report
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+def build_database_report(exact: bool = False) -> dict:
+    """Esquema, muestra de productos, tamaño y filas por tabla (ver database_size_report)"""
+    conn = get_db_connection()
     try:
-        conn = sqlite3.connect('laburen_app.db')
         cursor = conn.cursor()
         
         # Listar todas las tablas
@@ -390,25 +2510,53 @@ def debug_database():
         cursor.execute("SELECT id, name, price FROM products LIMIT 5")
         sample_products = [{"id": row[0], "name": row[1], "price": row[2]} for row in cursor.fetchall()]
         
-        # Contar productos
-        cursor.execute("SELECT COUNT(*) FROM products")
-        product_count = cursor.fetchone()[0]
-        
+        # Tamaño del archivo y filas por tabla (carritos activos y archivados)
+        size = database_size_report(conn, exact=exact)
+        cursor.execute("SELECT MIN(updated_at) FROM carts")
+        oldest_cart_activity = cursor.fetchone()[0]
+    finally:
         conn.close()
-        
-        return {
-            "status": "ok",
-            "database": "laburen_app.db",
-            "tables": tables,
-            "carts_structure": {
-                "columns": [{"id": col[0], "name": col[1], "type": col[2], "not_null": col[3], "default": col[4], "pk": col[5]} for col in carts_columns]
-            },
-            "product_count": product_count,
-            "sample_products": sample_products
-        }
-        
+    
+    return {
+        "tables": tables,
+        "carts_structure": {
+            "columns": [{"id": col[0], "name": col[1], "type": col[2], "not_null": col[3], "default": col[4], "pk": col[5]} for col in carts_columns]
+        },
+        "sample_products": sample_products,
+        "size": size,
+        "oldest_cart_activity": oldest_cart_activity
+    }
+
+
+database_report_cache = DatabaseReportCache(DEBUG_STATS_TTL_SECONDS)
+
+@app.get("/debug/database")
+def debug_database(exact: bool = False):
+    """Estado de la base de datos desde estadísticas cacheadas (exact=true cuenta filas recorriendo las tablas)"""
+    try:
+        if exact:
+            report, age = build_database_report(exact=True), 0.0
+        else:
+            report, age = database_report_cache.get()
     except Exception as e:
         return {"status": "error", "message": str(e)}
+    
+    products = facet_index.snapshot()["products"] or report["size"]["rows"].get("products")
+    return dict(
+        report,
+        status="ok",
+        database=DB_PATH,
+        stats_age_seconds=age,
+        product_count=products,
+        connections=db_stats.snapshot(),
+        catalog_version=_catalog_state[0],
+        cart_retention=cart_retention.snapshot()
+    )
+
+@app.post("/debug/cart-retention")
+def run_cart_retention():
+    """Ejecuta ya una pasada de retención de carritos (sin esperar el intervalo ni el lease)"""
+    return cart_retention.run_once(force=True)
 
 @app.get("/debug/fix-carts-table")
 def fix_carts_table_get():
@@ -417,77 +2565,978 @@ def fix_carts_table_get():
 
 @app.post("/debug/fix-carts-table")  
 def fix_carts_table():
-    """Endpoint para corregir la estructura de la tabla carts"""
+    """Endpoint para corregir la estructura de la tabla carts (aplica las migraciones pendientes)"""
     try:
-        conn = sqlite3.connect('laburen_app.db')
-        cursor = conn.cursor()
+        conn = get_db_connection()
+        applied = apply_migrations(conn)
+        conn.close()
         
-        # Verificar si la tabla carts tiene la columna items
-        cursor.execute("PRAGMA table_info(carts)")
-        columns = cursor.fetchall()
-        has_items_column = any(col[1] == 'items' for col in columns)
+        if applied:
+            return {
+                "status": "fixed",
+                "message": "Migraciones pendientes aplicadas",
+                "applied": applied
+            }
+        return {"status": "ok", "message": "Tabla carts ya tiene la estructura correcta"}
+            
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@app.get("/debug/migrations")
+def debug_migrations():
+    """Migraciones aplicadas y pendientes"""
+    conn = get_db_connection()
+    applied = {
+        row[0]: {"version": row[0], "name": row[1], "applied_at": row[2]}
+        for row in conn.execute("SELECT version, name, applied_at FROM schema_migrations ORDER BY version")
+    }
+    conn.close()
+    return {
+        "applied": list(applied.values()),
+        "pending": [{"version": version, "name": name} for version, name, _ in MIGRATIONS if version not in applied]
+    }
+
+import requests
+import google.generativeai as genai
+
+# Confianza mínima del router determinístico para responder sin llamar a Gemini
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv('FAST_PATH_MIN_CONFIDENCE', '0.9'))
+
+GREETING_RESPONSE = "¡Hola! 👋 Soy tu asistente de Laburen.com\n\n🛍️ Puedo ayudarte a:\n• Ver productos\n• Buscar productos específicos\n• Crear carritos de compra\n\n¿Qué te interesa?"
+
+# Frases que el router reconoce sin ambigüedad (ya normalizadas)
+GREETING_PHRASES = {
+    "hola", "hi", "hello", "hey", "buenas", "buen dia", "buenos dias",
+    "buenas tardes", "buenas noches", "hola buenas", "hola buen dia",
+    "hola buenos dias", "hola buenas tardes", "hola buenas noches"
+}
+LIST_PRODUCTS_PHRASES = {
+    "productos", "catalogo", "ver productos", "ver catalogo", "ver el catalogo",
+    "lista de productos", "mostrar productos", "muestrame los productos",
+    "que productos tienen", "que productos hay", "ver todos los productos"
+}
+# Palabras que pueden aparecer en un pedido de carrito sin agregar ambigüedad
+CART_FILLER_WORDS = {
+    "quiero", "comprar", "compro", "agregar", "agrega", "agregame", "añadir",
+    "anadir", "al", "carrito", "del", "de", "el", "la", "los", "las", "producto",
+    "productos", "id", "cantidad", "unidad", "unidades", "pieza", "piezas",
+    "item", "items", "y", "por", "favor", "me", "un", "una", "mi", "en"
+}
+# Palabras que indican modificar un carrito existente (requieren al modelo)
+CART_UPDATE_PATTERN = re.compile(r"carrito\s+\d+|\b(?:actualiz|elimin|quit|cambi|sac)")
+
+
+def normalize_message(message: str) -> str:
+    """Normaliza un mensaje: minúsculas, sin acentos ni signos de puntuación"""
+    text = unicodedata.normalize('NFKD', message.lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# Nombres locales de los tipos de prenda del catálogo (ya normalizados)
+PRODUCT_TYPE_SYNONYMS = {
+    "remera": "camiseta", "playera": "camiseta", "buzo": "sudadera",
+    "campera": "chaqueta", "pollera": "falda", "jean": "pantalon"
+}
+# Palabras que pueden acompañar un pedido con filtros sin agregar ambigüedad
+FILTER_FILLER_WORDS = {
+    "quiero", "busco", "buscar", "busca", "ver", "mostrame", "muestrame", "tenes", "tienen",
+    "hay", "necesito", "algo", "alguna", "alguno", "algunas", "algunos", "un", "una", "unos",
+    "unas", "el", "la", "los", "las", "de", "del", "en", "color", "talle", "talla", "y", "que",
+    "con", "por", "a", "para", "precio", "pesos", "productos", "prendas", "ropa"
+}
+PRICE_RANGE_PATTERN = re.compile(r"\bentre\s+(\d+)\s+y\s+(\d+)")
+MAX_PRICE_PATTERN = re.compile(r"\b(?:menos\s+de|hasta|maximo|menor\s+a|debajo\s+de)\s+(\d+)")
+MIN_PRICE_PATTERN = re.compile(r"\b(?:mas\s+de|desde|minimo|mayor\s+a|arriba\s+de)\s+(\d+)")
+SIZE_PATTERN = re.compile(r"\btall[ae]s?\s+(\w+)")
+IN_STOCK_PATTERN = re.compile(r"\b(?:en|con)\s+stock\b|\bdisponibles?\b")
+# Claves de ACCION:filter_products y su parámetro en GET /products
+FILTER_ACTION_KEYS = {
+    "categoria": "category", "tipo": "product_type", "talle": "size", "color": "color",
+    "precio_min": "min_price", "precio_max": "max_price", "stock": "in_stock"
+}
+
+
+def _facet_key(word: str, known: dict) -> Optional[str]:
+    """Valor normalizado de faceta que corresponde a una palabra (plurales y género: 'negras' -> 'negro')"""
+    candidates = [word]
+    if word.endswith("es"):
+        candidates.append(word[:-2])
+    if word.endswith("s"):
+        candidates.append(word[:-1])
+    for candidate in candidates:
+        if candidate in known:
+            return candidate
+        if candidate.endswith("a") and candidate[:-1] + "o" in known:
+            return candidate[:-1] + "o"
+    return None
+
+
+def extract_product_filters(message: str):
+    """Extrae filtros estructurados de un mensaje; devuelve (filtros, palabras sin explicar)"""
+    # "1.500" -> "1500" antes de normalizar (la normalización separa en la puntuación)
+    text = normalize_message(re.sub(r"(?<=\d)[.,](?=\d{3}\b)", "", message))
+    filters = {}
+    
+    def take(pattern, handler):
+        nonlocal text
+        match = pattern.search(text)
+        if match and handler(match):
+            text = text[:match.start()] + " " + text[match.end():]
+    
+    def price_range(match):
+        filters["min_price"], filters["max_price"] = sorted((float(match.group(1)), float(match.group(2))))
+        return True
+    
+    def max_price(match):
+        filters["max_price"] = float(match.group(1))
+        return True
+    
+    def min_price(match):
+        filters["min_price"] = float(match.group(1))
+        return True
+    
+    def size(match):
+        sizes = facet_index.labels("size")
+        if match.group(1) in sizes:
+            filters["size"] = sizes[match.group(1)]
+            return True
+        return False
+    
+    def in_stock(match):
+        filters["in_stock"] = True
+        return True
+    
+    take(PRICE_RANGE_PATTERN, price_range)
+    if "max_price" not in filters:
+        take(MAX_PRICE_PATTERN, max_price)
+    if "min_price" not in filters:
+        take(MIN_PRICE_PATTERN, min_price)
+    take(SIZE_PATTERN, size)
+    take(IN_STOCK_PATTERN, in_stock)
+    
+    unexplained = []
+    for word in text.split():
+        if word in FILTER_FILLER_WORDS:
+            continue
+        for facet in ("product_type", "color", "category", "size"):
+            # Talles de una letra solo después de "talle" (evita confundir "a", "s", "m" sueltas)
+            if facet == "size" and len(word) < 2:
+                continue
+            known = facet_index.labels(facet)
+            key = _facet_key(PRODUCT_TYPE_SYNONYMS.get(word, word), known)
+            if key is None and facet == "product_type" and word.endswith("s"):
+                key = _facet_key(PRODUCT_TYPE_SYNONYMS.get(word[:-1], word), known)
+            if key is not None and filters.get(facet) in (None, known[key]):
+                filters[facet] = known[key]
+                break
+        else:
+            unexplained.append(word)
+    return filters, unexplained
+
+
+def parse_filter_action(spec: str) -> dict:
+    """'tipo=Camiseta;talle=M;precio_max=900' -> filtros de GET /products"""
+    filters = {}
+    for part in spec.split(';'):
+        if '=' not in part:
+            continue
+        key, value = (piece.strip() for piece in part.split('=', 1))
+        param = FILTER_ACTION_KEYS.get(normalize_message(key).replace(' ', '_'))
+        if not param or not value:
+            continue
+        if param in ("min_price", "max_price"):
+            try:
+                filters[param] = float(re.sub(r"[^\d.]", "", value))
+            except ValueError:
+                continue
+        elif param == "in_stock":
+            filters[param] = normalize_message(value) in ("si", "true", "1")
+        else:
+            filters[param] = value
+    return filters
+
+
+def describe_product_filters(filters: dict) -> str:
+    """Texto corto de los filtros para el encabezado de resultados"""
+    parts = [filters[facet] for facet in ("product_type", "category", "color") if filters.get(facet)]
+    if filters.get("size"):
+        parts.append(f"talle {filters['size']}")
+    if filters.get("min_price") is not None:
+        parts.append(f"desde ${filters['min_price']:.0f}")
+    if filters.get("max_price") is not None:
+        parts.append(f"hasta ${filters['max_price']:.0f}")
+    if filters.get("in_stock"):
+        parts.append("en stock")
+    return " ".join(parts)
+
+
+class AgentPathStats:
+    """Contadores de turnos y latencia por camino de resolución del agente"""
+    
+    # fast_path: router sin modelo, gemini: llamada al modelo,
+    # rule_based: sin API key, breaker_open: circuito de Gemini abierto (antes o durante el turno),
+    # fallback: error de Gemini
+    PATHS = ("fast_path", "gemini", "rule_based", "breaker_open", "fallback")
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._turns = {path: 0 for path in self.PATHS}
+        self._latency_total = {path: 0.0 for path in self.PATHS}
+        self._latency_max = {path: 0.0 for path in self.PATHS}
+    
+    def record(self, path: str, seconds: float):
+        with self._lock:
+            self._turns[path] = self._turns.get(path, 0) + 1
+            self._latency_total[path] = self._latency_total.get(path, 0.0) + seconds
+            self._latency_max[path] = max(self._latency_max.get(path, 0.0), seconds)
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            total_turns = sum(self._turns.values())
+            model_calls = self._turns.get("gemini", 0) + self._turns.get("fallback", 0)
+            paths = {}
+            for path, turns in self._turns.items():
+                paths[path] = {
+                    "turns": turns,
+                    "avg_latency_ms": round(self._latency_total[path] / turns * 1000, 3) if turns else 0.0,
+                    "max_latency_ms": round(self._latency_max[path] * 1000, 3)
+                }
+        return {
+            "total_turns": total_turns,
+            "turns_without_model_call": total_turns - model_calls,
+            "model_free_ratio": round((total_turns - model_calls) / total_turns, 4) if total_turns else 0.0,
+            "paths": paths
+        }
+
+
+agent_stats = AgentPathStats()
+
+AGENT_TURN_LOG_SIZE = int(os.getenv('AGENT_TURN_LOG_SIZE', '500'))
+
+
+class AgentTurnLog:
+    """Últimos turnos del agente: camino, intent, etapas, llamadas al modelo, tools y operaciones de carrito.
+    
+    Cada turno tiene un número de secuencia creciente para que un consumidor (bench/replay.py,
+    /debug/agent-turns) lea solo los nuevos con `since`.
+    """
+    
+    def __init__(self, maxlen: int = AGENT_TURN_LOG_SIZE):
+        self._lock = threading.Lock()
+        self._turns = deque(maxlen=maxlen)
+        self._sequence = 0
+    
+    @contextmanager
+    def turn(self, phone: str, message: str):
+        turn = {
+            "seq": None,
+            "request_id": request_id_var.get(),
+            "phone": phone,
+            "message": preview(message),
+            "started_at": time.time(),
+            "intent": None,
+            "confidence": None,
+            "path": None,
+            "model_calls": 0,
+            "tool_calls": 0,
+            "cart_ops": [],
+            "stages_ms": {},
+            "latency_ms": None,
+            "response_chars": 0,
+        }
+        token = current_turn_var.set(turn)
+        start = time.perf_counter()
+        try:
+            yield turn
+        finally:
+            turn["latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            current_turn_var.reset(token)
+            with self._lock:
+                self._sequence += 1
+                turn["seq"] = self._sequence
+                self._turns.append(turn)
+    
+    def recent(self, since: int = 0, limit: Optional[int] = None) -> List[dict]:
+        """Turnos con secuencia mayor a `since`, del más viejo al más nuevo"""
+        with self._lock:
+            turns = [turn for turn in self._turns if turn["seq"] > since]
+        return turns[-limit:] if limit else turns
+    
+    @property
+    def last_sequence(self) -> int:
+        return self._sequence
+
+
+agent_turn_log = AgentTurnLog()
+
+
+def record_cart_op(operation: str, cart_id=None, ok: bool = True):
+    """Anota una operación de carrito del agente en el turno en curso"""
+    turn = current_turn_var.get()
+    if turn is not None:
+        turn["cart_ops"].append({"op": operation, "cart_id": cart_id, "ok": ok})
+
+
+class CircuitOpenError(Exception):
+    """El circuito del backend está abierto: no se intenta la llamada"""
+    
+    def __init__(self, name: str):
+        super().__init__(f"Circuito '{name}' abierto")
+        self.name = name
+
+
+class CircuitBreaker:
+    """Circuit breaker por tasa de fallas y latencia con sondeo half-open"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_rate_threshold: float = 0.5,
+                 slow_call_seconds: float = 10.0, window_size: int = 20,
+                 min_calls: int = 5, open_seconds: float = 30.0,
+                 half_open_max_calls: int = 1, clock=time.monotonic):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock  # inyectable para los tests
+        self._lock = threading.Lock()
+        self._window = deque(maxlen=window_size)  # True = falla o llamada lenta
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self._rejected = 0
+        self._times_opened = 0
+    
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.warning("⚡ Cambio de estado del circuito", breaker=self.name, from_state=self._state, to_state=state)
+        self._state = state
+        if state == self.OPEN:
+            self._opened_at = self._clock()
+            self._times_opened += 1
+        elif state == self.CLOSED:
+            self._window.clear()
+        self._half_open_in_flight = 0
+    
+    def _refresh_state(self):
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._transition(self.HALF_OPEN)
+    
+    def is_open(self) -> bool:
+        """True si las llamadas se rechazarían ahora (sin consumir un sondeo)"""
+        with self._lock:
+            self._refresh_state()
+            if self._state == self.HALF_OPEN:
+                return self._half_open_in_flight >= self.half_open_max_calls
+            return self._state == self.OPEN
+    
+    def allow_request(self) -> bool:
+        """Reserva permiso para una llamada; en half-open solo pasan los sondeos"""
+        with self._lock:
+            self._refresh_state()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._half_open_in_flight < self.half_open_max_calls:
+                self._half_open_in_flight += 1
+                return True
+            self._rejected += 1
+            return False
+    
+    def record_success(self, duration: float):
+        # Una llamada exitosa pero lenta cuenta como falla
+        if duration >= self.slow_call_seconds:
+            self.record_failure()
+            return
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._transition(self.CLOSED)
+                return
+            self._window.append(False)
+    
+    def record_failure(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._transition(self.OPEN)
+                return
+            self._window.append(True)
+            if self._state == self.CLOSED and len(self._window) >= self.min_calls:
+                if sum(self._window) / len(self._window) >= self.failure_rate_threshold:
+                    self._transition(self.OPEN)
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._refresh_state()
+            calls = len(self._window)
+            return {
+                "state": self._state,
+                "window_calls": calls,
+                "failure_rate": round(sum(self._window) / calls, 4) if calls else 0.0,
+                "failure_rate_threshold": self.failure_rate_threshold,
+                "slow_call_seconds": self.slow_call_seconds,
+                "open_seconds": self.open_seconds,
+                "retry_in_seconds": round(max(self.open_seconds - (self._clock() - self._opened_at), 0.0), 3) if self._state == self.OPEN else 0.0,
+                "rejected_calls": self._rejected,
+                "times_opened": self._times_opened
+            }
+
+
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+
+# Un breaker por backend: el modelo y los endpoints que consumen las tools del agente
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    failure_rate_threshold=float(os.getenv('GEMINI_BREAKER_FAILURE_RATE', '0.5')),
+    slow_call_seconds=float(os.getenv('GEMINI_BREAKER_SLOW_CALL_SECONDS', '8')),
+    open_seconds=BREAKER_OPEN_SECONDS
+)
+products_api_breaker = CircuitBreaker(
+    "products_api",
+    failure_rate_threshold=float(os.getenv('API_BREAKER_FAILURE_RATE', '0.5')),
+    slow_call_seconds=float(os.getenv('API_BREAKER_SLOW_CALL_SECONDS', '5')),
+    open_seconds=BREAKER_OPEN_SECONDS
+)
+carts_api_breaker = CircuitBreaker(
+    "carts_api",
+    failure_rate_threshold=float(os.getenv('API_BREAKER_FAILURE_RATE', '0.5')),
+    slow_call_seconds=float(os.getenv('API_BREAKER_SLOW_CALL_SECONDS', '5')),
+    open_seconds=BREAKER_OPEN_SECONDS
+)
+circuit_breakers = {
+    breaker.name: breaker for breaker in (gemini_breaker, products_api_breaker, carts_api_breaker)
+}
+
+
+
+class TokenBucket:
+    """Token bucket: se recarga a `rate` tokens por segundo hasta `capacity`"""
+    
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock  # inyectable para los tests
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Segundos hasta que haya `amount` tokens (0 si ya están disponibles)"""
+        with self._lock:
+            self._refill()
+            amount = min(amount, self.capacity)
+            if self._tokens >= amount:
+                return 0.0
+            return (amount - self._tokens) / self.rate
+    
+    def consume(self, amount: float = 1.0):
+        """Descuenta tokens; un valor negativo los devuelve (el saldo puede quedar en deuda)"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - min(amount, self.capacity))
+    
+    def try_acquire(self, amount: float = 1.0) -> float:
+        """Consume si hay tokens y devuelve 0; si no, devuelve los segundos a esperar"""
+        with self._lock:
+            self._refill()
+            amount = min(amount, self.capacity)
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.rate
+    
+    @property
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+class SchedulerTimeoutError(Exception):
+    """La llamada al modelo esperó en la cola más que el máximo permitido"""
+
+
+class LLMSlot:
+    """Turno concedido por el scheduler; reconcilia los tokens estimados con los reales"""
+    
+    def __init__(self, scheduler, estimated_tokens: int):
+        self.scheduler = scheduler
+        self.estimated_tokens = estimated_tokens
+        self.actual_tokens = None
+    
+    def record_usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        total = getattr(usage, "total_token_count", None)
+        if total:
+            self.actual_tokens = int(total)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.scheduler._release(self)
+        return False
+
+
+class LLMScheduler:
+    """Cola con prioridad, límite de concurrencia y rate limit (RPM/TPM) para Gemini"""
+    
+    FOLLOW_UP = 0
+    NEW_TURN = 1
+    PRIORITY_NAMES = {FOLLOW_UP: "follow_up", NEW_TURN: "new_turn"}
+    
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 max_concurrency: int, queue_timeout: float, expected_output_tokens: int = 300,
+                 clock=time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.expected_output_tokens = expected_output_tokens
+        self._clock = clock  # inyectable para los tests (las esperas reales siguen en el Condition)
+        # Capacidad mínima de 1: con la cuota repartida entre workers el RPM puede quedar < 1
+        self._requests = TokenBucket(requests_per_minute / 60.0, max(requests_per_minute, 1.0), clock)
+        self._tokens = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute, clock)
+        self._cond = threading.Condition()
+        self._queue = []  # heap de (prioridad, secuencia)
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._max_queue_depth = 0
+        self._stats = {
+            name: {"scheduled": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for name in self.PRIORITY_NAMES.values()
+        }
+        self._rate_limited_waits = 0
+    
+    def estimate_tokens(self, prompt: str) -> int:
+        # ~4 caracteres por token más la respuesta esperada
+        return len(prompt) // 4 + self.expected_output_tokens
+    
+    def slot(self, prompt: str, priority: int = NEW_TURN) -> LLMSlot:
+        """Bloquea hasta que haya concurrencia y cuota disponibles para la llamada"""
+        estimated = self.estimate_tokens(prompt)
+        ticket = (priority, next(self._sequence))
+        stats = self._stats[self.PRIORITY_NAMES[priority]]
+        enqueued = self._clock()
+        deadline = enqueued + self.queue_timeout
         
-        if not has_items_column:
-            # Hacer backup de datos existentes si los hay
-            cursor.execute("SELECT * FROM carts")
-            existing_carts = cursor.fetchall()
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+            rate_limited = False
+            try:
+                while True:
+                    wait = None
+                    # Solo la cabeza de la cola puede tomar turno: respeta la prioridad
+                    if self._queue[0] == ticket and self._in_flight < self.max_concurrency:
+                        wait = max(self._requests.wait_time(1), self._tokens.wait_time(estimated))
+                        if wait == 0:
+                            break
+                        rate_limited = True
+                    
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        stats["timeouts"] += 1
+                        raise SchedulerTimeoutError(
+                            f"Sin turno para Gemini tras {self.queue_timeout:.1f}s en cola"
+                        )
+                    self._cond.wait(min(wait, remaining) if wait else remaining)
+            except BaseException:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                raise
             
-            # Recrear la tabla con la estructura correcta
-            cursor.execute("DROP TABLE IF EXISTS carts")
-            cursor.execute('''
-            CREATE TABLE carts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                items TEXT NOT NULL,
-                total_amount REAL NOT NULL,
-                total_items INTEGER NOT NULL,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            heapq.heappop(self._queue)
+            self._requests.consume(1)
+            self._tokens.consume(estimated)
+            self._in_flight += 1
+            
+            waited = self._clock() - enqueued
+            stats["scheduled"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            if rate_limited:
+                self._rate_limited_waits += 1
+            self._cond.notify_all()
+        
+        return LLMSlot(self, estimated)
+    
+    def _release(self, slot: LLMSlot):
+        if slot.actual_tokens is not None:
+            self._tokens.consume(slot.actual_tokens - slot.estimated_tokens)
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+    
+    def snapshot(self) -> dict:
+        with self._cond:
+            priorities = {}
+            for name, stats in self._stats.items():
+                scheduled = stats["scheduled"]
+                priorities[name] = {
+                    "scheduled": scheduled,
+                    "timeouts": stats["timeouts"],
+                    "avg_wait_ms": round(stats["wait_total"] / scheduled * 1000, 3) if scheduled else 0.0,
+                    "max_wait_ms": round(stats["wait_max"] * 1000, 3)
+                }
+            return {
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self._max_queue_depth,
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "rate_limited_waits": self._rate_limited_waits,
+                "requests_available": round(self._requests.available, 2),
+                "tokens_available": round(self._tokens.available, 2),
+                "priorities": priorities
+            }
+
+
+# Los token buckets son por proceso: con N workers de gunicorn (gunicorn.conf.py
+# exporta WEB_CONCURRENCY) cada uno se queda con 1/N de las cuotas del proveedor
+WEB_WORKERS = max(int(os.getenv('WEB_CONCURRENCY', '1')), 1)
+
+def per_worker_quota(value: float) -> float:
+    """Parte de una cuota global (RPM, TPM, mensajes/s) que le corresponde a este proceso"""
+    return value / WEB_WORKERS
+
+# Valores por defecto del tier gratuito de gemini-1.5-flash (cuota de toda la app)
+llm_scheduler = LLMScheduler(
+    requests_per_minute=per_worker_quota(float(os.getenv('GEMINI_RPM', '15'))),
+    tokens_per_minute=per_worker_quota(float(os.getenv('GEMINI_TPM', '1000000'))),
+    max_concurrency=int(os.getenv('GEMINI_MAX_CONCURRENCY', '4')),
+    queue_timeout=float(os.getenv('GEMINI_QUEUE_TIMEOUT_SECONDS', '10'))
+)
+
+# Límites de cuerpo de mensaje de cada canal
+WHATSAPP_MAX_BODY = 4096
+TWILIO_MAX_BODY = 1600
+
+
+def split_message(text: str, limit: int = WHATSAPP_MAX_BODY) -> List[str]:
+    """Divide un mensaje en partes de hasta `limit` caracteres sin cortar bloques si se puede"""
+    if len(text) <= limit:
+        return [text]
+    
+    chunks = []
+    current = []
+    current_len = 0
+    
+    def flush():
+        nonlocal current, current_len
+        if current:
+            chunks.append("\n\n".join(current))
+        current, current_len = [], 0
+    
+    for block in text.split("\n\n"):
+        # Bloques que solos superan el límite se cortan por línea y, si hace falta, por caracteres
+        if len(block) > limit:
+            flush()
+            line_chunk = ""
+            for line in block.split("\n"):
+                while len(line) > limit:
+                    if line_chunk:
+                        chunks.append(line_chunk)
+                        line_chunk = ""
+                    chunks.append(line[:limit])
+                    line = line[limit:]
+                candidate = f"{line_chunk}\n{line}" if line_chunk else line
+                if len(candidate) > limit:
+                    chunks.append(line_chunk)
+                    line_chunk = line
+                else:
+                    line_chunk = candidate
+            if line_chunk:
+                current, current_len = [line_chunk], len(line_chunk)
+            continue
+        
+        separator = 2 if current else 0
+        if current_len + separator + len(block) > limit:
+            flush()
+            separator = 0
+        current.append(block)
+        current_len += separator + len(block)
+    
+    flush()
+    return chunks
+
+
+class ProductRenderer:
+    """Arma los mensajes de WhatsApp a partir de snippets precalculados por versión de catálogo"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._list_snippets = {}
+        self._detail_snippets = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def _cached(self, cache: dict, product: dict, build) -> str:
+        version = get_catalog_version()
+        with self._lock:
+            if version != self._version:
+                self._list_snippets.clear()
+                self._detail_snippets.clear()
+                self._version = version
+            snippet = cache.get(product['id'])
+            if snippet is not None:
+                self.hits += 1
+                return snippet
+            self.misses += 1
+        
+        snippet = build(product)
+        with self._lock:
+            if version == self._version:
+                cache[product['id']] = snippet
+        return snippet
+    
+    @staticmethod
+    def _build_list_snippet(product: dict) -> str:
+        return (
+            f"🔸 *{product['name']}*\n"
+            f"   💰 ${product['price']:.2f}\n"
+            f"   📦 Stock: {product['stock']}\n"
+            f"   🏷️ {product.get('category') or 'General'}\n"
+            f"   ID: {product['id']}"
+        )
+    
+    @staticmethod
+    def _build_detail_snippet(product: dict) -> str:
+        return (
+            f"🔸 *{product['name']}*\n"
+            f"📝 {product['description']}\n"
+            f"💰 ${product['price']:.2f}\n"
+            f"📦 Stock: {product['stock']}\n"
+            f"🏷️ Categoría: {product.get('category') or 'General'}\n"
+            f"🆔 ID: {product['id']}"
+        )
+    
+    def render_products(self, products: list, search_query: Optional[str] = None,
+                        max_items: Optional[int] = 10, total: Optional[int] = None,
+                        header: Optional[str] = None) -> str:
+        """Lista de productos; `max_items=None` incluye todos, `total` cuenta los que no se trajeron y `header` reemplaza el encabezado"""
+        if header is None:
+            header = (f"🔍 *RESULTADOS PARA '{search_query.upper()}'*" if search_query
+                      else "🛍️ *PRODUCTOS DISPONIBLES:*")
+        
+        shown = products if max_items is None else products[:max_items]
+        parts = [header]
+        parts.extend(self._cached(self._list_snippets, p, self._build_list_snippet) for p in shown)
+        remaining = max(total or len(products), len(products)) - len(shown)
+        if remaining > 0:
+            parts.append(f"... y {remaining} productos más")
+        parts.append("💡 *¿Necesitas más detalles de algún producto específico?*")
+        return "\n\n".join(parts)
+    
+    def render_product_detail(self, product: dict) -> str:
+        snippet = self._cached(self._detail_snippets, product, self._build_detail_snippet)
+        return f"🔍 *DETALLE DEL PRODUCTO*\n\n{snippet}\n\n💡 *¿Te gustaría agregarlo al carrito?*"
+    
+    def render_product_details(self, products: list, missing: Optional[list] = None) -> str:
+        """Detalle de varios productos en un solo mensaje"""
+        parts = ["🔍 *DETALLE DE LOS PRODUCTOS*"]
+        parts.extend(self._cached(self._detail_snippets, p, self._build_detail_snippet) for p in products)
+        if missing:
+            parts.append(f"❌ No encontrados: {', '.join(f'ID {product_id}' for product_id in missing)}")
+        parts.append("💡 *¿Te gustaría agregar alguno al carrito?*")
+        return "\n\n".join(parts)
+    
+    def render_cart(self, cart: dict, header: str) -> str:
+        """Carrito creado o actualizado (los items dependen del carrito: no se cachean)"""
+        parts = [header]
+        if not cart['items']:
+            parts.append("🗑️ Carrito vacío")
+        else:
+            parts.extend(
+                f"🔸 {item['name']}\n"
+                f"   Cantidad: {item['qty']}\n"
+                f"   Precio: ${item['price']:.2f}\n"
+                f"   Subtotal: ${item['price'] * item['qty']:.2f}"
+                for item in cart['items']
             )
-            ''')
-            
-            conn.commit()
-            conn.close()
-            
+        parts.append(
+            f"📊 *RESUMEN:*\n"
+            f"Total items: {cart['total_items']}\n"
+            f"💰 *Total: ${cart['total_amount']:.2f}*"
+        )
+        return "\n\n".join(parts)
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
             return {
-                "status": "fixed", 
-                "message": "Tabla carts recreada con estructura correcta",
-                "backup_count": len(existing_carts)
+                "catalog_version": self._version,
+                "cached_snippets": len(self._list_snippets) + len(self._detail_snippets),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
             }
-        else:
-            conn.close()
-            return {"status": "ok", "message": "Tabla carts ya tiene la estructura correcta"}
-            
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
 
-import requests
-import google.generativeai as genai
+
+product_renderer = ProductRenderer()
 
 # Agente de IA inteligente que consume la API
 class AIAgent:
     def __init__(self):
         self.api_key = os.getenv('GEMINI_API_KEY', '')
         if self.api_key:
-            genai.configure(api_key=self.api_key)
+            endpoint = os.getenv('GEMINI_API_ENDPOINT')
+            if endpoint:
+                # Endpoint alternativo, p. ej. el stub local de bench/stubs.py
+                genai.configure(api_key=self.api_key, transport="rest", client_options={"api_endpoint": endpoint})
+            else:
+                genai.configure(api_key=self.api_key)
             self.model = genai.GenerativeModel('gemini-1.5-flash')
         else:
             self.model = None
         # Usar URL dinámica - Render o local
         self.base_url = os.getenv('API_BASE_URL', 'https://laburen-ai-agent.onrender.com')
+        # Últimas respuestas del catálogo por URL: (ETag, JSON) para revalidar con If-None-Match
+        self._etag_cache = OrderedDict()
+        self._etag_cache_lock = threading.Lock()
+        self.etag_revalidations = 0
         
     def process_message(self, message: str, phone: str) -> str:
-        """Procesa mensajes usando Gemini y consume la API"""
+        """Procesa mensajes: router determinístico primero, Gemini solo si hace falta"""
+        with agent_turn_log.turn(phone, message) as turn:
+            start = time.perf_counter()
+            intent, confidence, args = self._classify_message(message)
+            observe_stage(time.perf_counter() - start, "intent")
+            turn.update(intent=intent, confidence=confidence)
+            
+            path, response = self._resolve_turn(message, intent, confidence, args)
+            agent_stats.record(path, time.perf_counter() - start)
+            turn.update(path=path, response_chars=len(response))
+            return response
+    
+    def _resolve_turn(self, message: str, intent: str, confidence: float, args: dict):
+        """(camino de resolución, respuesta) de un mensaje ya clasificado"""
+        # Mensajes inequívocos se resuelven sin llamar al modelo
+        if confidence >= FAST_PATH_MIN_CONFIDENCE:
+            return "fast_path", self._handle_intent(intent, args)
         
         # Si no hay API key de Gemini, usar lógica simple
         if not self.model:
-            return self._simple_logic(message)
+            return "rule_based", self._simple_logic(message)
+        
+        # Con el circuito abierto no se espera al modelo: lógica simple directa
+        if gemini_breaker.is_open():
+            return "breaker_open", self._simple_logic(message)
+        
+        try:
+            return "gemini", self._process_with_gemini(message)
+        except CircuitOpenError as e:
+            # El circuito se abrió mientras el mensaje esperaba en el scheduler: no hubo llamada
+            logger.warning("Circuito de Gemini abierto, usando lógica simple", breaker=e.name)
+            return "breaker_open", self._simple_logic(message)
+        except Exception as e:
+            logger.warning("Error con Gemini, usando lógica simple", error=str(e))
+            return "fallback", self._simple_logic(message)
+    
+    def _generate(self, prompt: str, follow_up: bool = False):
+        """Llama a Gemini a través del scheduler y del circuit breaker"""
+        if gemini_breaker.is_open():
+            raise CircuitOpenError(gemini_breaker.name)
+        
+        # Las segundas llamadas completan un turno ya empezado: van primero en la cola
+        priority = LLMScheduler.FOLLOW_UP if follow_up else LLMScheduler.NEW_TURN
+        with llm_scheduler.slot(prompt, priority) as slot:
+            if not gemini_breaker.allow_request():
+                raise CircuitOpenError(gemini_breaker.name)
+            
+            start = time.perf_counter()
+            try:
+                response = self.model.generate_content(prompt)
+                response.text  # Falla si la respuesta vino bloqueada o vacía
+            except Exception:
+                gemini_breaker.record_failure()
+                raise
+            finally:
+                duration = time.perf_counter() - start
+                observe_stage(duration, "model_call_2" if follow_up else "model_call_1")
+            
+            gemini_breaker.record_success(duration)
+            slot.record_usage(response)
+        return response
+    
+    def _follow_up(self, prompt: str, tool_result: str) -> str:
+        """Segunda llamada al modelo; si falla, devuelve el resultado de la tool tal cual"""
+        try:
+            return self._generate(prompt, follow_up=True).text
+        except Exception as e:
+            # La tool ya se ejecutó: no reintentar el turno (crearía otro carrito)
+            logger.warning("Error con Gemini en la segunda llamada", error=str(e))
+            return tool_result
+    
+    def _api_request(self, breaker: CircuitBreaker, method: str, url: str, **kwargs):
+        """Request HTTP a la API propia a través del circuit breaker del backend"""
+        if not breaker.allow_request():
+            raise CircuitOpenError(breaker.name)
         
-        # Usar Gemini para procesar el mensaje
+        # Propaga el id de correlación al request que atiende la tool
+        headers = kwargs.pop("headers", None) or {}
+        headers.setdefault("X-Request-ID", request_id_var.get())
+        
+        start = time.perf_counter()
         try:
-            # Crear el prompt con información sobre las funciones disponibles
-            system_prompt = """Eres un asistente de ventas de Laburen.com. 
+            response = requests.request(method, url, headers=headers, **kwargs)
+        except requests.exceptions.RequestException:
+            breaker.record_failure()
+            raise
+        
+        # Los 4xx son errores del pedido, no del backend
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success(time.perf_counter() - start)
+        return response
+    
+    def _get_catalog_json(self, url: str, params: Optional[dict] = None):
+        """GET al catálogo de la API; si el ETag guardado sigue vigente (304) reutiliza el JSON"""
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._etag_cache_lock:
+            cached = self._etag_cache.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        
+        response = self._api_request(products_api_breaker, "GET", url, params=params, headers=headers, timeout=30)
+        if response.status_code == 304 and cached:
+            with self._etag_cache_lock:
+                self.etag_revalidations += 1
+                if key in self._etag_cache:
+                    self._etag_cache.move_to_end(key)
+            return cached[1]
+        response.raise_for_status()
+        
+        data = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            with self._etag_cache_lock:
+                self._etag_cache[key] = (etag, data)
+                self._etag_cache.move_to_end(key)
+                while len(self._etag_cache) > CATALOG_RESPONSE_CACHE_SIZE:
+                    self._etag_cache.popitem(last=False)
+        return data
+    
+    def _process_with_gemini(self, message: str) -> str:
+        """Procesa mensajes usando Gemini y consume la API"""
+        # Crear el prompt con información sobre las funciones disponibles
+        system_prompt = """Eres un asistente de ventas de Laburen.com. 
 
 Tienes acceso a estas funciones de API:
-- GET /products: Lista productos (opcional ?search=término)
+- GET /products: Lista productos (opcional ?search=término y filtros por categoría, tipo, talle, color, precio y stock)
 - GET /products/{id}: Detalle de producto específico
 - POST /carts: Crea carrito con productos
 - PATCH /carts/{id}: Actualiza carrito existente
@@ -501,11 +3550,18 @@ INSTRUCCIONES:
 
 IMPORTANTE: Analiza el mensaje del usuario y determina si necesitas:
 1. Mostrar productos (usa: ACCION:get_products)
-2. Buscar productos (usa: ACCION:search_products:término_búsqueda)  
-3. Ver detalle producto (usa: ACCION:get_product:ID)
-4. Crear carrito (usa: ACCION:create_cart:product_id,qty;product_id,qty)
-5. Actualizar carrito (usa: ACCION:update_cart:cart_id:product_id,qty;product_id,qty)
-6. Solo conversar (responde directamente)
+2. Buscar productos, tolera errores de tipeo (usa: ACCION:search_products:término_búsqueda)  
+3. Filtrar productos (usa: ACCION:filter_products:clave=valor;clave=valor con claves categoria, tipo, talle, color, precio_min, precio_max, stock=si)
+4. Ver detalle de uno o varios productos (usa: ACCION:get_product:ID o ACCION:get_product:ID,ID,ID)
+5. Crear carrito (usa: ACCION:create_cart:product_id,qty;product_id,qty)
+6. Actualizar carrito (usa: ACCION:update_cart:cart_id:product_id,qty;product_id,qty)
+7. Recomendar productos para una ocasión o necesidad (usa: ACCION:recommend_products:pedido del usuario)
+8. Solo conversar (responde directamente)
+
+EJEMPLOS DE FILTROS:
+- Usuario: "remeras talle M en negro por menos de 900" → ACCION:filter_products:tipo=Camiseta;talle=M;color=Negro;precio_max=900
+- Usuario: "algo formal entre 500 y 800" → ACCION:filter_products:categoria=Formal;precio_min=500;precio_max=800
+- Usuario: "¿qué me recomendás para el verano?" → ACCION:recommend_products:algo para el verano
 
 EJEMPLOS DE USO DE CARRITOS:
 - Usuario: "quiero comprar el producto 15 cantidad 2" → ACCION:create_cart:15,2
@@ -522,134 +3578,240 @@ NOTAS:
 
 """
 
-            full_prompt = f"{system_prompt}\n\nUsuario: {message}"
-            
-            response = self.model.generate_content(full_prompt)
-            response_text = response.text
-            
-            # Verificar si Gemini quiere ejecutar alguna acción
-            if "ACCION:" in response_text:
-                lines = response_text.split('\n')
-                for line in lines:
-                    if "ACCION:" in line:
-                        action_line = line.strip()
+        full_prompt = f"{system_prompt}\n\nUsuario: {message}"
+        
+        response = self._generate(full_prompt)
+        response_text = response.text
+        
+        # Verificar si Gemini quiere ejecutar alguna acción
+        if "ACCION:" in response_text:
+            lines = response_text.split('\n')
+            for line in lines:
+                if "ACCION:" in line:
+                    action_line = line.strip()
+                    
+                    if "recommend_products:" in action_line:
+                        request_text = action_line.split("recommend_products:")[1].strip() or message
+                        recommend_result = (self.recommend_products_api(request_text)
+                                            or f"❌ No encontré productos para '{request_text}'")
+                        
+                        follow_up_prompt = f"""Usuario pidió una recomendación: {message}
+
+Productos más adecuados del catálogo:
+{recommend_result}
+
+Recomienda estos productos de forma amigable con emojis, explicando brevemente por qué sirven para lo que pidió."""
                         
-                        if "get_products" in action_line:
-                            products_result = self.get_products_api()
-                            # Segunda llamada con los resultados
-                            follow_up_prompt = f"""Usuario preguntó: {message}
+                        return self._follow_up(follow_up_prompt, recommend_result)
+                    
+                    elif "get_products" in action_line:
+                        # Si el mensaje describe lo que busca, solo los candidatos relevantes en vez del catálogo
+                        products_result = self.recommend_products_api(message) or self.get_products_api()
+                        # Segunda llamada con los resultados
+                        follow_up_prompt = f"""Usuario preguntó: {message}
 
 Productos disponibles:
 {products_result}
 
 Presenta esta información de forma amigable con emojis, incluyendo nombres, precios y una breve descripción."""
-                            
-                            final_response = self.model.generate_content(follow_up_prompt)
-                            return final_response.text
                         
-                        elif "search_products:" in action_line:
-                            search_term = action_line.split("search_products:")[1].strip()
-                            search_result = self.get_products_api(search_term)
-                            
-                            follow_up_prompt = f"""Usuario buscó: {message}
+                        return self._follow_up(follow_up_prompt, products_result)
+                    
+                    elif "filter_products:" in action_line:
+                        filters = parse_filter_action(action_line.split("filter_products:")[1])
+                        filter_result = self.get_products_api(filters=filters)
+                        
+                        follow_up_prompt = f"""Usuario pidió: {message}
+
+Productos que cumplen los filtros ({describe_product_filters(filters)}):
+{filter_result}
+
+Presenta los resultados de forma atractiva con emojis."""
+                        
+                        return self._follow_up(follow_up_prompt, filter_result)
+                    
+                    elif "search_products:" in action_line:
+                        search_term = action_line.split("search_products:")[1].strip()
+                        search_result = self.get_products_api(search_term)
+                        
+                        follow_up_prompt = f"""Usuario buscó: {message}
 
 Resultados de búsqueda para "{search_term}":
 {search_result}
 
 Presenta los resultados de forma atractiva con emojis."""
-                            
-                            final_response = self.model.generate_content(follow_up_prompt)
-                            return final_response.text
                         
-                        elif "get_product:" in action_line:
-                            try:
-                                product_id = int(action_line.split("get_product:")[1].strip())
-                                product_result = self.get_product_detail_api(product_id)
-                                
-                                follow_up_prompt = f"""Usuario preguntó por producto: {message}
+                        return self._follow_up(follow_up_prompt, search_result)
+                    
+                    elif "get_product:" in action_line:
+                        try:
+                            product_ids = [int(part) for part in action_line.split("get_product:")[1].split(',') if part.strip()]
+                            product_result = self.get_product_details(product_ids)
+                            
+                            follow_up_prompt = f"""Usuario preguntó por producto: {message}
 
 Detalle del producto:
 {product_result}
 
 Presenta esta información de forma detallada y atractiva con emojis."""
+                            
+                            return self._follow_up(follow_up_prompt, product_result)
+                        except:
+                            pass
+                    
+                    elif "create_cart:" in action_line:
+                        try:
+                            # Parsear productos y cantidades: "create_cart:product_id,qty;product_id,qty"
+                            cart_data = action_line.split("create_cart:")[1].strip()
+                            items = []
+                            
+                            for item_str in cart_data.split(';'):
+                                if ',' in item_str:
+                                    product_id, qty = item_str.split(',')
+                                    items.append({
+                                        "product_id": int(product_id.strip()),
+                                        "qty": int(qty.strip())
+                                    })
+                            
+                            if items:
+                                cart_result = self.create_cart_api(items)
                                 
-                                final_response = self.model.generate_content(follow_up_prompt)
-                                return final_response.text
-                            except:
-                                pass
-                        
-                        elif "create_cart:" in action_line:
-                            try:
-                                # Parsear productos y cantidades: "create_cart:product_id,qty;product_id,qty"
-                                cart_data = action_line.split("create_cart:")[1].strip()
-                                items = []
-                                
-                                for item_str in cart_data.split(';'):
-                                    if ',' in item_str:
-                                        product_id, qty = item_str.split(',')
-                                        items.append({
-                                            "product_id": int(product_id.strip()),
-                                            "qty": int(qty.strip())
-                                        })
-                                
-                                if items:
-                                    cart_result = self.create_cart_api(items)
-                                    
-                                    follow_up_prompt = f"""Usuario quiso crear carrito: {message}
+                                follow_up_prompt = f"""Usuario quiso crear carrito: {message}
 
 Resultado:
 {cart_result}
 
 Presenta esta información de forma celebratoria con emojis."""
-                                    
-                                    final_response = self.model.generate_content(follow_up_prompt)
-                                    return final_response.text
-                                else:
-                                    return "❌ No pude entender qué productos agregar al carrito. ¿Puedes especificar el ID del producto y la cantidad?"
-                            except Exception as e:
-                                print(f"Error creando carrito: {e}")
-                                return "❌ Hubo un error al crear el carrito. ¿Puedes intentarlo de nuevo especificando el ID del producto y la cantidad?"
-                        
-                        elif "update_cart:" in action_line:
-                            try:
-                                # Parsear cart_id y productos: "update_cart:cart_id:product_id,qty;product_id,qty"
-                                parts = action_line.split("update_cart:")[1].strip()
-                                cart_id_str, cart_data = parts.split(':', 1)
-                                cart_id = int(cart_id_str.strip())
                                 
-                                items = []
-                                for item_str in cart_data.split(';'):
-                                    if ',' in item_str:
-                                        product_id, qty = item_str.split(',')
-                                        items.append({
-                                            "product_id": int(product_id.strip()),
-                                            "qty": int(qty.strip())
-                                        })
+                                return self._follow_up(follow_up_prompt, cart_result)
+                            else:
+                                return "❌ No pude entender qué productos agregar al carrito. ¿Puedes especificar el ID del producto y la cantidad?"
+                        except Exception:
+                            logger.exception("Error creando carrito")
+                            return "❌ Hubo un error al crear el carrito. ¿Puedes intentarlo de nuevo especificando el ID del producto y la cantidad?"
+                    
+                    elif "update_cart:" in action_line:
+                        try:
+                            # Parsear cart_id y productos: "update_cart:cart_id:product_id,qty;product_id,qty"
+                            parts = action_line.split("update_cart:")[1].strip()
+                            cart_id_str, cart_data = parts.split(':', 1)
+                            cart_id = int(cart_id_str.strip())
+                            
+                            items = []
+                            for item_str in cart_data.split(';'):
+                                if ',' in item_str:
+                                    product_id, qty = item_str.split(',')
+                                    items.append({
+                                        "product_id": int(product_id.strip()),
+                                        "qty": int(qty.strip())
+                                    })
+                            
+                            if items:
+                                cart_result = self.update_cart_api(cart_id, items)
                                 
-                                if items:
-                                    cart_result = self.update_cart_api(cart_id, items)
-                                    
-                                    follow_up_prompt = f"""Usuario quiso actualizar carrito: {message}
+                                follow_up_prompt = f"""Usuario quiso actualizar carrito: {message}
 
 Resultado:
 {cart_result}
 
 Presenta esta información de forma positiva con emojis."""
-                                    
-                                    final_response = self.model.generate_content(follow_up_prompt)
-                                    return final_response.text
-                                else:
-                                    return "❌ No pude entender qué productos actualizar en el carrito."
-                            except Exception as e:
-                                print(f"Error actualizando carrito: {e}")
-                                return "❌ Hubo un error al actualizar el carrito. Verifica que el carrito exista y los datos sean correctos."
+                                
+                                return self._follow_up(follow_up_prompt, cart_result)
+                            else:
+                                return "❌ No pude entender qué productos actualizar en el carrito."
+                        except Exception:
+                            logger.exception("Error actualizando carrito")
+                            return "❌ Hubo un error al actualizar el carrito. Verifica que el carrito exista y los datos sean correctos."
+        
+        # Si no hay acciones específicas, devolver la respuesta directa
+        return response_text.replace("ACCION:", "").strip()
+    
+    def _classify_message(self, message: str):
+        """Clasifica el mensaje con reglas y devuelve (intención, confianza, argumentos)"""
+        text = normalize_message(message)
+        
+        if not text:
+            return "unknown", 0.0, {}
+        
+        if text in GREETING_PHRASES:
+            return "greeting", 1.0, {}
+        
+        if text in LIST_PRODUCTS_PHRASES:
+            return "list_products", 1.0, {}
+        
+        # "remeras talle M en negro por menos de 900": filtros por faceta y precio
+        filter_confidence = 0.0
+        filters, unexplained = extract_product_filters(message)
+        if filters and not re.search(r"\b(?:producto|id|carrito)\b", text):
+            if not unexplained:
+                return "filter_products", 0.95, {"filters": filters}
+            filter_confidence = max(0.95 - 0.2 * len(unexplained), 0.1)
+        
+        # "buscar remeras": términos cortos son búsquedas directas
+        search_match = re.fullmatch(r"(?:buscar|busca|busco)\s+(.+)", text)
+        if search_match:
+            term = search_match.group(1)
+            confidence = 0.95 if len(term.split()) <= 3 else 0.6
+            return "search", confidence, {"term": term}
+        
+        # "producto 15", "ver detalle del producto 15", "productos 3, 4 y 7"
+        detail_match = re.fullmatch(
+            r"(?:ver\s+)?(?:el\s+|los\s+)?(?:detalles?\s+(?:del?\s+|de\s+los\s+)?)?productos?\s+(?:ids?\s+)?(\d+(?:\s+(?:y\s+)?\d+)*)", text
+        )
+        if detail_match:
+            product_ids = [int(product_id) for product_id in re.findall(r"\d+", detail_match.group(1))]
+            return "product_detail", 0.95, {"product_ids": product_ids}
+        
+        # Pedidos de carrito nuevos con IDs y cantidades explícitas
+        words = text.split()
+        if any(word in words for word in ["comprar", "carrito", "agregar", "añadir", "anadir", "quiero"]):
+            if CART_UPDATE_PATTERN.search(text):
+                return "update_cart", 0.3, {}
             
-            # Si no hay acciones específicas, devolver la respuesta directa
-            return response_text.replace("ACCION:", "").strip()
-                
-        except Exception as e:
-            print(f"Error con Gemini: {e}")
-            return self._simple_logic(message)
+            items = self._extract_product_info_from_message(message)
+            if not items:
+                # "quiero 3 remeras negras": sin IDs el pedido se resuelve mostrando los productos que encajan
+                if filter_confidence:
+                    return "filter_products", filter_confidence, {"filters": filters}
+                return "create_cart", 0.3, {}
+            
+            # La confianza baja con cada palabra que las reglas no explican (colores, talles...)
+            unexplained = [w for w in words if not w.isdigit() and w not in CART_FILLER_WORDS]
+            confidence = 0.95 if not unexplained else max(0.95 - 0.2 * len(unexplained), 0.1)
+            return "create_cart", confidence, {"items": items}
+        
+        if filter_confidence:
+            return "filter_products", filter_confidence, {"filters": filters}
+        
+        return "unknown", 0.0, {}
+    
+    def _handle_intent(self, intent: str, args: dict) -> str:
+        """Resuelve una intención clasificada por el router sin llamar al modelo"""
+        if intent == "greeting":
+            return GREETING_RESPONSE
+        
+        if intent == "list_products":
+            return self.get_products_api()
+        
+        if intent == "search":
+            return self.get_products_api(args["term"])
+        
+        if intent == "filter_products":
+            return self.get_products_api(filters=args["filters"])
+        
+        if intent == "product_detail":
+            return self.get_product_details(args["product_ids"])
+        
+        if intent == "create_cart":
+            return self._created_cart_reply(self.create_cart_api(args["items"]))
+        
+        return self._simple_logic("")
+    
+    def _created_cart_reply(self, cart_result: str) -> str:
+        """Respuesta sin modelo a create_cart_api: el encabezado de éxito solo si el carrito se creó"""
+        if cart_result.startswith("❌"):
+            return cart_result
+        return f"🛒 He creado tu carrito:\n\n{cart_result}"
     
     def _extract_product_info_from_message(self, message: str):
         """Extrae IDs de productos y cantidades de mensajes naturales"""
@@ -707,296 +3869,756 @@ Presenta esta información de forma positiva con emojis."""
         
         # Debug: Imprimir lo que encontramos
         if products:
-            print(f"🔍 Productos extraídos del mensaje '{message}': {products}")
+            logger.debug("🔍 Productos extraídos del mensaje", message=preview(message), products=products)
         else:
-            print(f"❌ No se pudieron extraer productos del mensaje '{message}'")
+            logger.debug("❌ No se pudieron extraer productos del mensaje", message=preview(message))
         
         return products
     
     def _simple_logic(self, message):
         """Lógica simple cuando no hay Gemini API key"""
         msg = message.lower().strip()
+        # Palabras completas: "ver" no debe coincidir con "verano" ni "hi" con "chaqueta"
+        words = set(normalize_message(message).split())
         
-        if "hola" in msg or "buenos" in msg or "hi" in msg:
-            return "¡Hola! 👋 Soy tu asistente de Laburen.com\n\n🛍️ Puedo ayudarte a:\n• Ver productos\n• Buscar productos específicos\n• Crear carritos de compra\n\n¿Qué te interesa?"
+        if words & {"hola", "buenos", "buenas", "hi"}:
+            return GREETING_RESPONSE
         
-        elif "productos" in msg or "catalogo" in msg or "ver" in msg:
-            return self.get_products_api()
+        elif words & {"productos", "catalogo", "ver"}:
+            # "productos para el verano": los candidatos relevantes antes que el catálogo entero
+            return self.recommend_products_api(message) or self.get_products_api()
         
-        elif "buscar" in msg or "busca" in msg:
-            search_term = msg.replace("buscar", "").replace("busca", "").strip()
+        elif words & {"buscar", "busca", "busco"}:
+            search_term = re.sub(r"\b(?:buscar|busca|busco)\b", "", msg).strip()
             return self.get_products_api(search_term if search_term else None)
         
-        elif any(word in msg for word in ["comprar", "carrito", "agregar", "añadir", "quiero"]):
+        elif words & {"comprar", "carrito", "agregar", "anadir", "quiero"}:
             # Intentar extraer información de productos
             products = self._extract_product_info_from_message(message)
             
             if products:
                 # Crear carrito con los productos encontrados
-                cart_result = self.create_cart_api(products)
-                return f"🛒 He creado tu carrito:\n\n{cart_result}"
+                return self._created_cart_reply(self.create_cart_api(products))
             else:
                 # Si no se pudieron extraer productos, pedir más información
                 return "🛍️ ¡Perfecto! Te ayudo a crear un carrito.\n\n📝 Para agregar productos necesito:\n• ID del producto\n• Cantidad deseada\n\n💡 Ejemplo: 'quiero 2 del producto 15'\n\n¿Podrías decirme qué productos específicos te interesan?"
         
         else:
+            # Pedidos abiertos ("algo para el verano"): recomendaciones si el catálogo tiene algo parecido
+            recommend_result = self.recommend_products_api(message)
+            if recommend_result:
+                return recommend_result
             return "🤔 Puedo ayudarte con:\n\n• 'productos' - Ver catálogo\n• 'buscar [término]' - Buscar específico\n• 'quiero comprar...' - Crear carrito\n\n¿Qué necesitas?"
     
-    def get_products_api(self, search_query=None):
-        """Consume GET /products de la API con fallback directo a BD"""
+    @timed_stage("tool_call")
+    def get_products_api(self, search_query=None, filters=None):
+        """Consume GET /products de la API (búsqueda y/o filtros) con fallback directo a BD"""
         try:
             # Intentar conexión HTTP primero con timeout más largo
+            if search_query and not filters:
+                # Búsqueda por texto sola: ranking tolerante a errores de tipeo ("remra negr")
+                result = self._get_catalog_json(
+                    f"{self.base_url}/products/search", {"q": search_query, "limit": FUZZY_SEARCH_LIMIT}
+                )
+                return self._format_search_response(result)
+            
             url = f"{self.base_url}/products"
             params = {"q": search_query} if search_query else {}
+            params.update({key: value for key, value in (filters or {}).items() if value is not None})
             
-            response = requests.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            
-            products = response.json()
+            products = self._get_catalog_json(url, params)
             
             if not products:
                 return "❌ No se encontraron productos"
             
-            return self._format_products_response(products, search_query)
+            return self._format_products_response(products, search_query or describe_product_filters(filters or {}))
+            
+        except CircuitOpenError:
+            # Circuito abierto: directo a la BD sin esperar el timeout
+            return self._get_products_direct(search_query, filters)
             
         except requests.exceptions.Timeout:
             # Fallback: acceso directo a la base de datos
-            print(f"Timeout en API, usando acceso directo a BD para búsqueda: {search_query}")
-            return self._get_products_direct(search_query)
+            logger.warning("Timeout en API, usando acceso directo a BD", search_query=search_query)
+            return self._get_products_direct(search_query, filters)
             
         except requests.exceptions.RequestException as e:
-            print(f"Error HTTP: {e}")
+            logger.warning("Error HTTP, usando acceso directo a BD", error=str(e))
             # Fallback: acceso directo a la base de datos
-            return self._get_products_direct(search_query)
+            return self._get_products_direct(search_query, filters)
             
-        except Exception as e:
-            print(f"Error inesperado: {e}")
+        except Exception:
+            logger.exception("Error inesperado")
             return f"❌ Error temporal del sistema. Intenta de nuevo en unos segundos. 🔄"
     
-    def _get_products_direct(self, search_query=None):
-        """Acceso directo a la base de datos como fallback"""
+    def _get_products_direct(self, search_query=None, filters=None):
+        """Fallback sin HTTP: los mismos índices en memoria (construidos desde la BD) que usa la API"""
         try:
-            conn = sqlite3.connect('laburen_app.db')
-            cursor = conn.cursor()
-            
-            if search_query:
-                # Solo buscar en name y description (sin category)
-                cursor.execute('''
-                    SELECT id, name, description, price, stock FROM products 
-                    WHERE LOWER(name) LIKE ? OR LOWER(description) LIKE ?
-                ''', (f'%{search_query.lower()}%', f'%{search_query.lower()}%'))
-            else:
-                cursor.execute('SELECT id, name, description, price, stock FROM products LIMIT 20')
-            
-            rows = cursor.fetchall()
-            conn.close()
+            if search_query and not filters:
+                return self._format_search_response(product_search_index.search(search_query))
             
-            if not rows:
-                return f"❌ No se encontraron productos para '{search_query}'" if search_query else "❌ No hay productos disponibles"
+            # Mismo índice y misma semántica que GET /products (sin distinguir acentos ni mayúsculas)
+            description = search_query or describe_product_filters(filters or {})
+            limit = None if search_query or filters else 20
+            products = facet_index.search(q=search_query, limit=limit, **(filters or {}))
             
-            # Convertir a formato similar al JSON de la API
-            products = []
-            for row in rows:
-                products.append({
-                    'id': row[0],
-                    'name': row[1],
-                    'description': row[2],
-                    'price': row[3],
-                    'stock': row[4],
-                    'category': 'General'  # Valor por defecto ya que no existe la columna
-                })
+            if not products:
+                return f"❌ No se encontraron productos para '{description}'" if description else "❌ No hay productos disponibles"
             
-            return self._format_products_response(products, search_query)
+            return self._format_products_response(products, description)
             
-        except Exception as e:
-            print(f"Error acceso directo BD: {e}")
+        except Exception:
+            logger.exception("Error acceso directo BD")
             return f"❌ Error accediendo a la base de datos. Intenta más tarde. 😔"
     
     def _format_products_response(self, products, search_query=None):
         """Formatea la respuesta de productos de manera consistente"""
-        if search_query:
-            result = f"🔍 *RESULTADOS PARA '{search_query.upper()}'*\n\n"
-        else:
-            result = "🛍️ *PRODUCTOS DISPONIBLES:*\n\n"
-        
-        for product in products[:10]:  # Máximo 10 productos
-            result += f"🔸 *{product['name']}*\n"
-            result += f"   💰 ${product['price']:.2f}\n"
-            result += f"   📦 Stock: {product['stock']}\n"
-            result += f"   🏷️ {product['category']}\n"
-            result += f"   ID: {product['id']}\n\n"
-        
-        if len(products) > 10:
-            result += f"... y {len(products) - 10} productos más\n\n"
+        return product_renderer.render_products(products, search_query)
+    
+    @timed_stage("tool_call")
+    def recommend_products_api(self, query):
+        """Consume GET /products/recommend con fallback al índice en proceso.
+
+        Devuelve None si nada se parece al pedido o si falló algo inesperado,
+        para que el llamador caiga al catálogo (get_products_api).
+        """
+        try:
+            result = self._get_catalog_json(f"{self.base_url}/products/recommend", {"q": query, "k": RECOMMEND_TOP_K})
+        except CircuitOpenError:
+            result = product_recommender.recommend(query)
+        except requests.exceptions.RequestException as e:
+            logger.warning("Error HTTP, usando el índice de recomendaciones en proceso", error=str(e))
+            result = product_recommender.recommend(query)
+        except Exception:
+            logger.exception("Error inesperado en recomendaciones, se usa el catálogo")
+            return None
         
-        result += "💡 *¿Necesitas más detalles de algún producto específico?*"
-        return result
+        if not result["products"]:
+            return None
+        return self._format_recommend_response(result)
+    
+    def _format_recommend_response(self, result):
+        """Recomendaciones con el mismo formato de lista que el resto de los resultados"""
+        concepts = ", ".join(result["concepts"]).upper()
+        header = f"✨ *RECOMENDADOS PARA {concepts}*" if concepts else "✨ *RECOMENDADOS PARA VOS*"
+        return product_renderer.render_products(result["products"], header=header)
+    
+    def _format_search_response(self, result):
+        """Resultados de GET /products/search; si hubo correcciones, el encabezado muestra lo interpretado"""
+        if not result["products"]:
+            return f"❌ No se encontraron productos para '{result['query']}'"
+        terms = result["terms"]
+        interpreted = " ".join(label or word for word, label in terms.items())
+        corrected = any(label and normalize_message(label) != word for word, label in terms.items())
+        return product_renderer.render_products(
+            result["products"], interpreted if corrected else result["query"], total=result["total"]
+        )
+    
+    def get_product_details(self, product_ids):
+        """Detalle de uno o varios productos (varios IDs van en un solo request)"""
+        product_ids = list(dict.fromkeys(product_ids))
+        if len(product_ids) == 1:
+            return self.get_product_detail_api(product_ids[0])
+        return self.get_products_by_ids_api(product_ids)
+    
+    @timed_stage("tool_call")
+    def get_products_by_ids_api(self, product_ids):
+        """Consume GET /products?ids=... de la API con fallback a BD directa"""
+        try:
+            products = self._get_catalog_json(
+                f"{self.base_url}/products",
+                {"ids": ",".join(str(product_id) for product_id in product_ids)}
+            )
+            found = {product['id'] for product in products}
+            return self._format_product_details(products, [i for i in product_ids if i not in found])
+            
+        except CircuitOpenError:
+            return self._get_products_by_ids_direct(product_ids)
+            
+        except requests.exceptions.Timeout:
+            logger.warning("Timeout en API, usando acceso directo a BD", product_ids=product_ids)
+            return self._get_products_by_ids_direct(product_ids)
+            
+        except requests.exceptions.RequestException as e:
+            logger.warning("Error HTTP, usando acceso directo a BD", error=str(e))
+            return self._get_products_by_ids_direct(product_ids)
+            
+        except Exception:
+            logger.exception("Error inesperado")
+            return "❌ Error temporal del sistema. Intenta de nuevo en unos segundos. 🔄"
+    
+    def _get_products_by_ids_direct(self, product_ids):
+        """Acceso directo a la base de datos para el detalle de varios productos"""
+        try:
+            products, missing = get_products_by_ids(product_ids)
+            return self._format_product_details(products, missing)
+        except HTTPException as e:
+            return f"❌ {e.detail}"
+        except Exception:
+            logger.exception("Error acceso directo BD")
+            return "❌ Error accediendo a la base de datos. Intenta más tarde. 😔"
+    
+    def _format_product_details(self, products, missing):
+        """Formatea el detalle de varios productos"""
+        if not products:
+            return f"❌ No se encontraron productos con ID {', '.join(str(i) for i in missing)}"
+        return product_renderer.render_product_details(products, missing)
     
+    @timed_stage("tool_call")
     def get_product_detail_api(self, product_id):
         """Consume GET /products/:id de la API con fallback a BD directa"""
         try:
-            response = requests.get(f"{self.base_url}/products/{product_id}", timeout=30)
-            response.raise_for_status()
-            
-            product = response.json()
+            product = self._get_catalog_json(f"{self.base_url}/products/{product_id}")
             return self._format_product_detail(product)
             
+        except CircuitOpenError:
+            return self._get_product_detail_direct(product_id)
+            
         except requests.exceptions.Timeout:
-            print(f"Timeout en API, usando acceso directo a BD para producto {product_id}")
+            logger.warning("Timeout en API, usando acceso directo a BD", product_id=product_id)
             return self._get_product_detail_direct(product_id)
             
         except requests.exceptions.RequestException as e:
-            print(f"Error HTTP: {e}")
+            logger.warning("Error HTTP, usando acceso directo a BD", error=str(e))
             return self._get_product_detail_direct(product_id)
             
-        except Exception as e:
-            print(f"Error inesperado: {e}")
+        except Exception:
+            logger.exception("Error inesperado")
             return f"❌ Error temporal del sistema. Intenta de nuevo en unos segundos. 🔄"
     
     def _get_product_detail_direct(self, product_id):
         """Acceso directo a la base de datos para detalle de producto"""
         try:
-            conn = sqlite3.connect('laburen_app.db')
+            conn = get_db_connection()
             cursor = conn.cursor()
             
-            cursor.execute('SELECT id, name, description, price, stock FROM products WHERE id = ?', (product_id,))
+            cursor.execute(f'SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ?', (product_id,))
             row = cursor.fetchone()
             conn.close()
             
             if not row:
                 return f"❌ Producto con ID {product_id} no encontrado"
             
-            product = {
-                'id': row[0],
-                'name': row[1],
-                'description': row[2],
-                'price': row[3],
-                'stock': row[4],
-                'category': 'General'  # Valor por defecto
-            }
+            product = product_from_row(row)
             
             return self._format_product_detail(product)
             
-        except Exception as e:
-            print(f"Error acceso directo BD: {e}")
+        except Exception:
+            logger.exception("Error acceso directo BD")
             return f"❌ Error accediendo a la base de datos. Intenta más tarde. 😔"
     
     def _format_product_detail(self, product):
         """Formatea el detalle de un producto"""
-        result = f"🔍 *DETALLE DEL PRODUCTO*\n\n"
-        result += f"🔸 *{product['name']}*\n"
-        result += f"📝 {product['description']}\n"
-        result += f"💰 ${product['price']:.2f}\n"
-        result += f"📦 Stock: {product['stock']}\n"
-        result += f"🏷️ Categoría: {product['category']}\n"
-        result += f"🆔 ID: {product['id']}\n\n"
-        result += "💡 *¿Te gustaría agregarlo al carrito?*"
-        
-        return result
+        return product_renderer.render_product_detail(product)
     
+    @timed_stage("tool_call")
     def create_cart_api(self, items):
         """Consume POST /carts de la API"""
         try:
             data = {"items": items}
-            response = requests.post(f"{self.base_url}/carts", json=data, timeout=10)
+            response = self._api_request(carts_api_breaker, "POST", f"{self.base_url}/carts", json=data, timeout=10)
             response.raise_for_status()
             
             cart = response.json()
+            record_cart_op("create", cart['id'])
+            return self._format_cart_response(cart, f"🛒 *CARRITO CREADO* (ID: {cart['id']})")
             
-            result = f"� *CARRITO CREADO* (ID: {cart['id']})\n\n"
-            
-            for item in cart['items']:
-                result += f"🔸 {item['name']}\n"
-                result += f"   Cantidad: {item['qty']}\n"
-                result += f"   Precio: ${item['price']:.2f}\n"
-                result += f"   Subtotal: ${item['price'] * item['qty']:.2f}\n\n"
-            
-            result += f"📊 *RESUMEN:*\n"
-            result += f"Total items: {cart['total_items']}\n"
-            result += f"💰 *Total: ${cart['total_amount']:.2f}*"
-            
-            return result
-            
+        except CircuitOpenError:
+            # Circuito abierto: crear el carrito en proceso sin pasar por HTTP
+            return self._create_cart_direct(items)
         except requests.exceptions.HTTPError as e:
+            record_cart_op("create", ok=False)
             return f"❌ Error al crear carrito: {e.response.text}"
+        except requests.exceptions.RequestException as e:
+            # Sin reintento directo: ante un timeout el carrito pudo haberse creado igual
+            logger.warning("Error HTTP creando carrito", error=str(e))
+            record_cart_op("create", ok=False)
+            return "❌ No pude crear el carrito: el servicio no responde. Intenta de nuevo en unos segundos. 🔄"
+        except Exception as e:
+            record_cart_op("create", ok=False)
+            return f"❌ Error: {e}"
+    
+    def _create_cart_direct(self, items):
+        """Crea el carrito llamando al endpoint en proceso (fallback sin HTTP)"""
+        try:
+            cart = insert_cart(CartCreate(items=items))
+            record_cart_op("create", cart['id'])
+            return self._format_cart_response(cart, f"🛒 *CARRITO CREADO* (ID: {cart['id']})")
+        except HTTPException as e:
+            record_cart_op("create", ok=False)
+            return f"❌ Error al crear carrito: {e.detail}"
         except Exception as e:
+            record_cart_op("create", ok=False)
             return f"❌ Error: {e}"
     
+    @timed_stage("tool_call")
     def update_cart_api(self, cart_id, items):
         """Consume PATCH /carts/:id de la API"""
         try:
             data = {"items": items}
-            response = requests.patch(f"{self.base_url}/carts/{cart_id}", json=data, timeout=10)
+            response = self._api_request(carts_api_breaker, "PATCH", f"{self.base_url}/carts/{cart_id}", json=data, timeout=10)
             response.raise_for_status()
             
             cart = response.json()
+            record_cart_op("update", cart['id'])
+            return self._format_cart_response(cart, f"🔄 *CARRITO ACTUALIZADO* (ID: {cart['id']})")
             
-            result = f"🔄 *CARRITO ACTUALIZADO* (ID: {cart['id']})\n\n"
-            
-            if not cart['items']:
-                result += "🗑️ Carrito vacío\n"
-            else:
-                for item in cart['items']:
-                    result += f"🔸 {item['name']}\n"
-                    result += f"   Cantidad: {item['qty']}\n"
-                    result += f"   Precio: ${item['price']:.2f}\n"
-                    result += f"   Subtotal: ${item['price'] * item['qty']:.2f}\n\n"
-            
-            result += f"📊 *RESUMEN:*\n"
-            result += f"Total items: {cart['total_items']}\n"
-            result += f"💰 *Total: ${cart['total_amount']:.2f}*"
-            
-            return result
-            
+        except CircuitOpenError:
+            return self._update_cart_direct(cart_id, items)
         except requests.exceptions.HTTPError as e:
+            record_cart_op("update", cart_id, ok=False)
             if e.response.status_code == 404:
                 return "❌ Carrito no encontrado"
+            if e.response.status_code == 410:
+                return CART_EXPIRED_MESSAGE
             return f"❌ Error al actualizar carrito: {e.response.text}"
         except Exception as e:
+            record_cart_op("update", cart_id, ok=False)
+            return f"❌ Error: {e}"
+    
+    def _update_cart_direct(self, cart_id, items):
+        """Actualiza el carrito llamando al endpoint en proceso (fallback sin HTTP)"""
+        try:
+            cart = replace_cart_items(cart_id, CartCreate(items=items))
+            record_cart_op("update", cart['id'])
+            return self._format_cart_response(cart, f"🔄 *CARRITO ACTUALIZADO* (ID: {cart['id']})")
+        except HTTPException as e:
+            record_cart_op("update", cart_id, ok=False)
+            if e.status_code == 404:
+                return "❌ Carrito no encontrado"
+            if e.status_code == 410:
+                return CART_EXPIRED_MESSAGE
+            return f"❌ Error al actualizar carrito: {e.detail}"
+        except Exception as e:
+            record_cart_op("update", cart_id, ok=False)
             return f"❌ Error: {e}"
+    
+    def _format_cart_response(self, cart, header):
+        """Formatea un carrito creado o actualizado"""
+        return product_renderer.render_cart(cart, header)
 
 # Instanciar agente
 ai_agent = AIAgent()
 
-# Función para enviar mensajes de WhatsApp
-def send_whatsapp_message(to_number: str, message: str):
-    """Envía un mensaje de respuesta a WhatsApp"""
-    try:
-        whatsapp_token = os.getenv('WHATSAPP_TOKEN')
-        phone_number_id = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
+# Graph API de WhatsApp (configurable para apuntar a un stub local en benchmarks)
+WHATSAPP_API_URL = os.getenv('WHATSAPP_API_URL', 'https://graph.facebook.com/v18.0').rstrip('/')
+
+# Outbox de mensajes salientes: las respuestas se guardan en SQLite y un pool
+# de hilos las envía a la Graph API respetando sus límites. Lo pendiente se
+# retoma al reiniciar y los envíos que quedaron a medias (worker caído) se
+# recuperan cuando vence su lease.
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '32'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_RETENTION_HOURS = float(os.getenv('OUTBOX_RETENTION_HOURS', '24'))
+# Límites de la Cloud API: 80 mensajes/s por número en el tier por defecto y
+# ~1 mensaje cada 6s al mismo usuario ("pair rate"), con ráfagas cortas.
+# Se configuran para toda la app y cada worker aplica su parte (per_worker_quota).
+WHATSAPP_MPS = per_worker_quota(float(os.getenv('WHATSAPP_MPS', '80')))
+WHATSAPP_RECIPIENT_MPS = per_worker_quota(float(os.getenv('WHATSAPP_RECIPIENT_MPS', str(1 / 6))))
+WHATSAPP_RECIPIENT_BURST = max(per_worker_quota(float(os.getenv('WHATSAPP_RECIPIENT_BURST', '10'))), 1.0)
+
+outbox_delivery_duration = metrics.histogram(
+    "outbox_delivery_seconds", "Tiempo desde que se encola un mensaje hasta que la Graph API lo acepta"
+)
+
+# Cabeza de fila de cada destinatario: las partes de un mismo usuario salen en orden
+_OUTBOX_CLAIM_SQL = '''
+    SELECT id, recipient, body, attempts, created_at, status, request_id FROM outbox AS o
+    WHERE ((status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND lease_until <= ?))
+      AND NOT EXISTS (
+        SELECT 1 FROM outbox AS p
+        WHERE p.recipient = o.recipient AND p.id < o.id AND p.status IN ('pending', 'sending')
+      )
+    ORDER BY next_attempt_at, id
+    LIMIT ?
+'''
+_OUTBOX_NEXT_DUE_SQL = '''
+    SELECT MIN(CASE WHEN status = 'pending' THEN next_attempt_at ELSE lease_until END) FROM outbox AS o
+    WHERE status IN ('pending', 'sending')
+      AND NOT EXISTS (
+        SELECT 1 FROM outbox AS p
+        WHERE p.recipient = o.recipient AND p.id < o.id AND p.status IN ('pending', 'sending')
+      )
+'''
+
+
+class OutboundSender:
+    """Outbox persistente con un despachador y un pool de hilos que envían a la Graph API.
+    
+    El despachador reclama en lote las filas vencidas (la más vieja de cada
+    destinatario), aplica el rate limit global y por destinatario y reparte los
+    envíos en el pool. 429, 5xx y errores de red se reintentan con backoff
+    exponencial y jitter; el resto de los 4xx se marcan como fallidos.
+    """
+    
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+    PAIR_RATE_LIMIT_CODE = 131056  # demasiados mensajes al mismo usuario
+    MAX_RECIPIENT_BUCKETS = 10000
+    
+    def __init__(self, workers: int, batch_size: int, max_attempts: int, lease_seconds: float,
+                 messages_per_second: float, recipient_messages_per_second: float, recipient_burst: float,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, send_timeout: float = 10.0,
+                 poll_seconds: float = 1.0, retention_hours: float = 24.0):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.recipient_messages_per_second = recipient_messages_per_second
+        self.recipient_burst = recipient_burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.send_timeout = send_timeout
+        self.poll_seconds = poll_seconds
+        self.retention_seconds = retention_hours * 3600
+        self._global = TokenBucket(messages_per_second, max(messages_per_second, 1.0))
+        self._recipients = OrderedDict()  # destinatario -> TokenBucket (LRU)
+        self._recipients_lock = threading.Lock()
+        self._work = queue.Queue()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_prune = 0.0
+        self._table_stats_cache = (float('-inf'), None)  # (recontado en, (estados, pendiente más viejo))
+        self._stats = {name: 0 for name in ("enqueued", "sent", "retried", "failed", "deferred", "reclaimed")}
+    
+    @property
+    def max_in_flight(self) -> int:
+        return self.workers * 2
+    
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+    
+    def _recipient_bucket(self, recipient: str) -> TokenBucket:
+        with self._recipients_lock:
+            bucket = self._recipients.get(recipient)
+            if bucket is None:
+                bucket = self._recipients[recipient] = TokenBucket(self.recipient_messages_per_second, self.recipient_burst)
+                if len(self._recipients) > self.MAX_RECIPIENT_BUCKETS:
+                    self._recipients.popitem(last=False)
+            else:
+                self._recipients.move_to_end(recipient)
+            return bucket
+    
+    def backoff_delay(self, attempts: int) -> float:
+        """Backoff exponencial con jitter: entre la mitad y el total de base * 2^(intento-1)"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    def enqueue(self, recipient: str, message: str) -> int:
+        """Guarda el mensaje (en partes de hasta 4096 caracteres) y despierta al despachador"""
+        parts = split_message(message, WHATSAPP_MAX_BODY)
+        now = time.time()
+        request_id = request_id_var.get()
+        conn = get_db_connection()
+        try:
+            conn.executemany(
+                "INSERT INTO outbox (recipient, body, next_attempt_at, created_at, request_id) VALUES (?, ?, ?, ?, ?)",
+                [(recipient, body, now, now, request_id) for body in parts]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._count("enqueued", len(parts))
+        self.start()
+        self._wakeup.set()
+        return len(parts)
+    
+    def start(self):
+        """Arranca el despachador y el pool (idempotente: se llama al iniciar la app y al encolar)"""
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            self._threads = [threading.Thread(target=self._dispatch_loop, name="outbox-dispatcher", daemon=True)]
+            self._threads += [
+                threading.Thread(target=self._send_loop, name=f"outbox-sender-{index}", daemon=True)
+                for index in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+        logger.info("📤 Outbox iniciado", workers=self.workers, pid=os.getpid())
+    
+    def stop(self, timeout: float = 5.0):
+        """Deja de reclamar filas y espera a que el pool termine los envíos ya reclamados"""
+        with self._start_lock:
+            threads, self._threads = self._threads, []
+        if not threads:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        for _ in range(self.workers):
+            self._work.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+    
+    def _dispatch_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                wait = self._dispatch()
+            except Exception:
+                logger.exception("❌ Error en el despachador del outbox")
+                wait = self.poll_seconds
+            if wait:
+                self._wakeup.wait(wait)
+    
+    def _dispatch(self) -> float:
+        """Reclama un lote de filas vencidas; devuelve cuántos segundos esperar antes de volver a mirar"""
+        with self._lock:
+            free_slots = self.max_in_flight - self._in_flight
+        if free_slots <= 0:
+            return self.poll_seconds  # el pool avisa al terminar cada envío
+        allowance = int(self._global.available)
+        if allowance <= 0:
+            return max(self._global.wait_time(1), 0.001)
         
-        if not whatsapp_token or not phone_number_id:
-            print("❌ Faltan tokens de WhatsApp")
-            return False
-            
-        url = f"https://graph.facebook.com/v18.0/{phone_number_id}/messages"
+        now = time.time()
+        conn = get_db_connection()
+        try:
+            self._prune(conn, now)
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(_OUTBOX_CLAIM_SQL, (now, now, min(self.batch_size, free_slots, allowance))).fetchall()
+            claimed, deferred = [], []
+            for row in rows:
+                wait = self._recipient_bucket(row[1]).try_acquire()
+                if wait:
+                    deferred.append((now + wait, row[0]))
+                else:
+                    claimed.append(row)
+            conn.executemany(
+                "UPDATE outbox SET status = 'pending', lease_until = NULL, next_attempt_at = ? WHERE id = ?",
+                deferred
+            )
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', lease_until = ? WHERE id = ?",
+                [(now + self.lease_seconds, row[0]) for row in claimed]
+            )
+            next_due = None if rows else conn.execute(_OUTBOX_NEXT_DUE_SQL).fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
         
+        if claimed:
+            self._global.consume(len(claimed))
+            with self._lock:
+                self._in_flight += len(claimed)
+                self._stats["deferred"] += len(deferred)
+                self._stats["reclaimed"] += sum(1 for row in claimed if row[5] == 'sending')
+            for row in claimed:
+                self._work.put((*row[:5], row[6]))
+        elif deferred:
+            self._count("deferred", len(deferred))
+        if rows:
+            return 0.0
+        # Otros workers también encolan: no esperar más que poll_seconds
+        if next_due is None:
+            return self.poll_seconds
+        return min(max(next_due - now, 0.001), self.poll_seconds)
+    
+    def _prune(self, conn, now: float):
+        """Borra las filas enviadas o descartadas más viejas que la retención (como mucho una vez por minuto)"""
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        conn.execute("DELETE FROM outbox WHERE finished_at < ?", (now - self.retention_seconds,))
+        conn.commit()
+    
+    def _send_loop(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            # Los logs del envío llevan el id del webhook que originó el mensaje
+            token = request_id_var.set(item[5] or "-")
+            try:
+                self._deliver(*item[:5])
+            except Exception:
+                logger.exception("❌ Error enviando mensaje del outbox", outbox_id=item[0])
+            finally:
+                request_id_var.reset(token)
+                with self._lock:
+                    self._in_flight -= 1
+                self._wakeup.set()
+    
+    @timed_stage("outbound_send")
+    def _post(self, recipient: str, body: str):
+        """POST a la Graph API: (status HTTP o None si falló la conexión, JSON o texto de error, Retry-After)"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        url = f"{WHATSAPP_API_URL}/{os.getenv('WHATSAPP_PHONE_NUMBER_ID')}/messages"
         headers = {
-            "Authorization": f"Bearer {whatsapp_token}",
+            "Authorization": f"Bearer {os.getenv('WHATSAPP_TOKEN')}",
             "Content-Type": "application/json"
         }
-        
         data = {
             "messaging_product": "whatsapp",
-            "to": to_number,
+            "to": recipient,
             "type": "text",
             "text": {
-                "body": message
+                "body": body
             }
         }
-        
-        response = requests.post(url, headers=headers, json=data)
-        
-        if response.status_code == 200:
-            print(f"✅ Mensaje enviado a {to_number}")
-            return True
-        else:
-            print(f"❌ Error enviando mensaje: {response.status_code} - {response.text}")
-            return False
+        try:
+            response = session.post(url, headers=headers, json=data, timeout=self.send_timeout)
+        except requests.RequestException as e:
+            return None, str(e), None
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = response.text
+        try:
+            retry_after = float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            retry_after = None
+        return response.status_code, payload, retry_after
+    
+    def _deliver(self, outbox_id: int, recipient: str, body: str, attempts: int, created_at: float):
+        status, payload, retry_after = self._post(recipient, body)
+        attempts += 1
+        now = time.time()
+        conn = get_db_connection()
+        try:
+            if status is not None and 200 <= status < 300:
+                messages = payload.get("messages") if isinstance(payload, dict) else None
+                provider_id = messages[0].get("id") if messages else None
+                conn.execute('''
+                    UPDATE outbox SET status = 'sent', attempts = ?, lease_until = NULL, finished_at = ?,
+                        provider_message_id = ?, last_error = NULL
+                    WHERE id = ?
+                ''', (attempts, now, provider_id, outbox_id))
+                conn.commit()
+                outbox_delivery_duration.observe(now - created_at)
+                self._count("sent")
+                return
             
-    except Exception as e:
-        print(f"❌ Error enviando mensaje: {e}")
+            error = f"HTTP {status}: {preview(json.dumps(payload) if isinstance(payload, dict) else str(payload))}" if status else payload
+            if (status is None or status in self.RETRYABLE_STATUS) and attempts < self.max_attempts:
+                delay = max(self.backoff_delay(attempts), retry_after or 0.0)
+                if status == 429:
+                    self._penalize(recipient, payload)
+                conn.execute('''
+                    UPDATE outbox SET status = 'pending', attempts = ?, lease_until = NULL,
+                        next_attempt_at = ?, last_error = ?
+                    WHERE id = ?
+                ''', (attempts, now + delay, error, outbox_id))
+                conn.commit()
+                self._count("retried")
+                logger.warning("⚠️ Reintentando mensaje", to=recipient, outbox_id=outbox_id,
+                               attempts=attempts, delay_s=round(delay, 2), error=error)
+            else:
+                conn.execute('''
+                    UPDATE outbox SET status = 'failed', attempts = ?, lease_until = NULL,
+                        finished_at = ?, last_error = ?
+                    WHERE id = ?
+                ''', (attempts, now, error, outbox_id))
+                conn.commit()
+                self._count("failed")
+                logger.error("❌ Mensaje descartado", to=recipient, outbox_id=outbox_id, attempts=attempts, error=error)
+        finally:
+            conn.close()
+    
+    def _penalize(self, recipient: str, payload):
+        """Ante un 429 vacía el bucket que corresponde: el del usuario (pair rate) o el global"""
+        code = payload.get("error", {}).get("code") if isinstance(payload, dict) else None
+        bucket = self._recipient_bucket(recipient) if code == self.PAIR_RATE_LIMIT_CODE else self._global
+        bucket.consume(bucket.available)
+    
+    def runtime_snapshot(self) -> dict:
+        """Estado en memoria de este worker (sin consultar la tabla outbox)"""
+        with self._lock:
+            in_flight = self._in_flight
+            processed = dict(self._stats)
+        return {
+            "running": bool(self._threads),
+            "in_flight": in_flight,
+            "queued": self._work.qsize(),
+            "processed": processed,
+        }
+    
+    def _table_stats(self, max_age: float) -> tuple:
+        """(filas por estado, created_at del pendiente más viejo); se recuentan como mucho una vez cada `max_age` segundos"""
+        counted_at, stats = self._table_stats_cache
+        if stats is not None and time.monotonic() - counted_at < max_age:
+            return stats
+        statuses = {status: 0 for status in ("pending", "sending", "sent", "failed")}
+        oldest = None
+        try:
+            conn = get_db_connection()
+            try:
+                for status, count in conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"):
+                    statuses[status] = count
+                oldest = conn.execute(
+                    "SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')"
+                ).fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return statuses, oldest  # BD sin migrar todavía
+        self._table_stats_cache = (time.monotonic(), (statuses, oldest))
+        return statuses, oldest
+    
+    def snapshot(self, max_age: float = 0.0) -> dict:
+        """Estado del outbox; con `max_age` reutiliza el recuento de la tabla si es más nuevo que eso"""
+        statuses, oldest = self._table_stats(max_age)
+        with self._lock:
+            processed = dict(self._stats)
+            in_flight = self._in_flight
+        return {
+            "running": bool(self._threads),
+            "workers": self.workers,
+            "in_flight": in_flight,
+            "statuses": dict(statuses),
+            "oldest_pending_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "processed": processed,
+            "global_tokens_available": round(self._global.available, 2),
+            "recipients_tracked": len(self._recipients),
+        }
+
+
+outbound_sender = OutboundSender(
+    workers=OUTBOX_WORKERS,
+    batch_size=OUTBOX_BATCH_SIZE,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    lease_seconds=OUTBOX_LEASE_SECONDS,
+    messages_per_second=WHATSAPP_MPS,
+    recipient_messages_per_second=WHATSAPP_RECIPIENT_MPS,
+    recipient_burst=WHATSAPP_RECIPIENT_BURST,
+    retention_hours=OUTBOX_RETENTION_HOURS
+)
+
+@app.on_event("startup")
+def start_outbound_sender():
+    """Retoma los mensajes pendientes del outbox al arrancar el worker"""
+    outbound_sender.start()
+
+@app.on_event("shutdown")
+def stop_outbound_sender():
+    outbound_sender.stop()
+
+# Función para enviar mensajes de WhatsApp
+def send_whatsapp_message(to_number: str, message: str):
+    """Encola la respuesta en el outbox; el envío a WhatsApp lo hace OutboundSender"""
+    if not os.getenv('WHATSAPP_TOKEN') or not os.getenv('WHATSAPP_PHONE_NUMBER_ID'):
+        logger.error("❌ Faltan tokens de WhatsApp")
+        return False
+    
+    try:
+        parts = outbound_sender.enqueue(to_number, message)
+    except sqlite3.Error:
+        logger.exception("❌ Error encolando mensaje")
         return False
+    
+    logger.info("📤 Mensaje encolado", to=to_number, parts=parts)
+    return True
 
 @app.post("/webhook")
 async def whatsapp_webhook(request: dict):
@@ -1022,20 +4644,21 @@ async def whatsapp_webhook(request: dict):
                             elif "interactive" in message:
                                 message_body = message["interactive"].get("button_reply", {}).get("title", "")
                             
-                            print(f"📱 Mensaje de {from_number}: {message_body}")
+                            logger.info("📱 Mensaje recibido", channel="whatsapp", sender=from_number, chars=len(message_body), text=preview(message_body))
                             
-                            # Procesar con AI Agent
+                            # Procesar con AI Agent (en el threadpool: las tools hacen HTTP
+                            # bloqueante contra esta misma API y no deben frenar el event loop)
                             if message_body:
-                                ai_response = ai_agent.process_message(message_body, from_number)
-                                print(f"🤖 Respuesta AI: {ai_response}")
+                                ai_response = await run_in_threadpool(ai_agent.process_message, message_body, from_number)
+                                logger.info("🤖 Respuesta AI", chars=len(ai_response))
                                 
-                                # Enviar respuesta de vuelta a WhatsApp
-                                send_whatsapp_message(from_number, ai_response)
+                                # Encolar la respuesta en el outbox (el envío a WhatsApp es asíncrono)
+                                await run_in_threadpool(send_whatsapp_message, from_number, ai_response)
         
         return {"status": "success"}
     
     except Exception as e:
-        print(f"❌ Error procesando webhook: {e}")
+        logger.exception("❌ Error procesando webhook")
         return {"status": "error", "message": str(e)}
 
 # Webhook para Twilio WhatsApp
@@ -1043,22 +4666,23 @@ async def whatsapp_webhook(request: dict):
 async def twilio_whatsapp_webhook(Body: str = Form(...), From: str = Form(...)):
     """Webhook para Twilio WhatsApp - Formato más simple"""
     try:
-        print(f"📱 Mensaje Twilio de {From}: {Body}")
+        logger.info("📱 Mensaje recibido", channel="twilio", sender=From, chars=len(Body), text=preview(Body))
         
         # Procesar con AI Agent
-        ai_response = ai_agent.process_message(Body, From)
-        print(f"🤖 Respuesta AI: {ai_response}")
+        ai_response = await run_in_threadpool(ai_agent.process_message, Body, From)
+        logger.info("🤖 Respuesta AI", chars=len(ai_response))
         
         # Enviar respuesta usando Twilio
-        send_twilio_message(From, ai_response)
+        await run_in_threadpool(send_twilio_message, From, ai_response)
         
         return {"status": "success"}
     
     except Exception as e:
-        print(f"❌ Error procesando webhook Twilio: {e}")
+        logger.exception("❌ Error procesando webhook Twilio")
         return {"status": "error", "message": str(e)}
 
 # Función para enviar mensajes vía Twilio
+@timed_stage("outbound_send")
 def send_twilio_message(to_number: str, message: str):
     """Envía un mensaje de respuesta usando Twilio"""
     try:
@@ -1069,22 +4693,25 @@ def send_twilio_message(to_number: str, message: str):
         from_number = os.getenv('TWILIO_WHATSAPP_FROM', 'whatsapp:+14155238886')
         
         if not account_sid or not auth_token:
-            print("❌ Faltan credenciales de Twilio")
+            logger.error("❌ Faltan credenciales de Twilio")
             return False
             
         client = Client(account_sid, auth_token)
+        if os.getenv('TWILIO_API_BASE_URL'):
+            client.api.base_url = os.getenv('TWILIO_API_BASE_URL')
         
-        message_response = client.messages.create(
-            body=message,
-            from_=from_number,
-            to=to_number  # Twilio espera formato whatsapp:+1234567890
-        )
+        for body in split_message(message, TWILIO_MAX_BODY):
+            message_response = client.messages.create(
+                body=body,
+                from_=from_number,
+                to=to_number  # Twilio espera formato whatsapp:+1234567890
+            )
+            logger.info("✅ Mensaje Twilio enviado", to=to_number, sid=message_response.sid)
         
-        print(f"✅ Mensaje Twilio enviado: {message_response.sid}")
         return True
         
-    except Exception as e:
-        print(f"❌ Error enviando mensaje Twilio: {e}")
+    except Exception:
+        logger.exception("❌ Error enviando mensaje Twilio")
         return False
 
 @app.get("/webhook")
@@ -1097,12 +4724,116 @@ def verify_whatsapp_webhook(
     verify_token = os.getenv('WHATSAPP_VERIFY_TOKEN', 'laburen_verify_2024')
     
     if mode == "subscribe" and token == verify_token:
-        print(f"✅ Webhook verificado con token: {token}")
+        logger.info("✅ Webhook verificado")
         return int(challenge)
     else:
-        print(f"❌ Verificación fallida. Mode: {mode}, Token: {token}")
+        logger.warning("❌ Verificación de webhook fallida", mode=mode)
         raise HTTPException(status_code=403, detail="Forbidden")
 
+@app.get("/debug/agent-stats")
+def agent_stats_endpoint():
+    """Turnos resueltos sin llamar al modelo y latencia por camino del agente"""
+    return agent_stats.snapshot()
+
+@app.get("/debug/agent-turns")
+def agent_turns_endpoint(since: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=AGENT_TURN_LOG_SIZE)):
+    """Últimos turnos del agente con camino, llamadas al modelo, tools, operaciones de carrito y latencia"""
+    return {"last_seq": agent_turn_log.last_sequence, "turns": agent_turn_log.recent(since, limit)}
+
+@app.get("/debug/circuit-breakers")
+def circuit_breakers_endpoint():
+    """Estado de los circuit breakers del modelo y de las tools del agente"""
+    return {name: breaker.snapshot() for name, breaker in circuit_breakers.items()}
+
+@app.get("/debug/llm-scheduler")
+def llm_scheduler_endpoint():
+    """Profundidad de cola, concurrencia y tiempos de espera de las llamadas a Gemini"""
+    return llm_scheduler.snapshot()
+
+@app.get("/debug/outbox")
+def outbox_endpoint():
+    """Mensajes salientes por estado, antigüedad del más viejo pendiente y resultados de envío"""
+    return outbound_sender.snapshot()
+
+OUTBOX_METRICS_TTL_SECONDS = float(os.getenv('OUTBOX_METRICS_TTL_SECONDS', '15'))
+
+def _collect_runtime_metrics():
+    """Expone en /metrics los contadores que mantienen el agente, los breakers, el scheduler, el renderer, el outbox y la retención"""
+    agent = agent_stats.snapshot()
+    scheduler = llm_scheduler.snapshot()
+    renderer = product_renderer.snapshot()
+    facets = facet_index.snapshot()
+    search = product_search_index.snapshot()
+    recommender = product_recommender.snapshot()
+    response_cache = catalog_response_cache.snapshot()
+    # El recuento por estado recorre la tabla outbox: no más de una vez por OUTBOX_METRICS_TTL_SECONDS
+    outbox = outbound_sender.snapshot(max_age=OUTBOX_METRICS_TTL_SECONDS)
+    retention = cart_retention.snapshot()
+    breaker_states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    breakers = {name: breaker.snapshot() for name, breaker in circuit_breakers.items()}
+    
+    return [
+        ("agent_turns_total", "counter", "Turnos del agente por camino de resolución",
+         [({"path": path}, data["turns"]) for path, data in agent["paths"].items()]),
+        ("agent_model_free_ratio", "gauge", "Fracción de turnos resueltos sin llamar al modelo",
+         [({}, agent["model_free_ratio"])]),
+        ("circuit_breaker_state", "gauge", "Estado del circuit breaker (0=closed, 1=half_open, 2=open)",
+         [({"name": name}, breaker_states[data["state"]]) for name, data in breakers.items()]),
+        ("circuit_breaker_rejected_total", "counter", "Llamadas rechazadas con el circuito abierto",
+         [({"name": name}, data["rejected_calls"]) for name, data in breakers.items()]),
+        ("llm_scheduler_queue_depth", "gauge", "Llamadas a Gemini esperando turno",
+         [({}, scheduler["queue_depth"])]),
+        ("llm_scheduler_in_flight", "gauge", "Llamadas a Gemini en curso",
+         [({}, scheduler["in_flight"])]),
+        ("llm_scheduler_scheduled_total", "counter", "Llamadas a Gemini despachadas por prioridad",
+         [({"priority": name}, data["scheduled"]) for name, data in scheduler["priorities"].items()]),
+        ("llm_scheduler_timeouts_total", "counter", "Llamadas a Gemini descartadas por espera en cola",
+         [({"priority": name}, data["timeouts"]) for name, data in scheduler["priorities"].items()]),
+        ("render_snippet_cache_hits_total", "counter", "Snippets de producto servidos desde cache",
+         [({}, renderer["hits"])]),
+        ("render_snippet_cache_misses_total", "counter", "Snippets de producto calculados",
+         [({}, renderer["misses"])]),
+        ("facet_index_products", "gauge", "Productos en el índice de facetas",
+         [({}, facets["products"])]),
+        ("facet_index_builds_total", "counter", "Reconstrucciones del índice de facetas",
+         [({}, facets["builds"])]),
+        ("product_search_queries_total", "counter", "Búsquedas aproximadas por si alguna palabra se corrigió",
+         [({"corrected": "true"}, search["corrected"]),
+          ({"corrected": "false"}, search["queries"] - search["corrected"])]),
+        ("product_recommend_queries_total", "counter", "Pedidos de recomendación resueltos con el índice TF-IDF",
+         [({}, recommender["queries"])]),
+        ("product_recommend_vectorized_texts_total", "counter", "Textos de producto vectorizados (solo nuevos o cambiados)",
+         [({}, recommender["vectorized_texts"])]),
+        ("catalog_response_cache_total", "counter", "GET del catálogo por resultado del cache HTTP",
+         [({"result": result}, response_cache[result]) for result in ("hits", "misses", "not_modified")]),
+        ("agent_etag_revalidations_total", "counter", "Respuestas del catálogo reutilizadas por el agente tras un 304",
+         [({}, ai_agent.etag_revalidations)]),
+        ("catalog_version", "gauge", "Versión actual del catálogo de productos",
+         [({}, get_catalog_version())]),
+        ("outbox_messages", "gauge", "Mensajes en el outbox de WhatsApp por estado",
+         [({"status": status}, count) for status, count in outbox["statuses"].items()]),
+        ("outbox_oldest_pending_seconds", "gauge", "Antigüedad del mensaje pendiente más viejo del outbox",
+         [({}, outbox["oldest_pending_seconds"])]),
+        ("sqlite_open_connections", "gauge", "Conexiones SQLite abiertas en este worker",
+         [({}, db_stats.open_connections)]),
+        ("sqlite_errors_total", "counter", "Errores operacionales de SQLite (locks, disco, esquema)",
+         [({}, db_stats.errors_total)]),
+        ("sqlite_database_bytes", "gauge", "Tamaño del archivo de la BD y de su WAL",
+         [({"file": "db"}, os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0),
+          ({"file": "wal"}, os.path.getsize(f"{DB_PATH}-wal") if os.path.exists(f"{DB_PATH}-wal") else 0)]),
+        ("cart_retention_total", "counter", "Carritos archivados y purgados por este worker, y páginas liberadas",
+         [({"action": action}, retention[action]) for action in ("archived", "purged", "vacuumed_pages")]),
+        ("outbox_processed_total", "counter", "Mensajes del outbox procesados por este worker por resultado",
+         [({"result": result}, count) for result, count in outbox["processed"].items()]),
+    ]
+
+metrics.register_collector(_collect_runtime_metrics)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    """Métricas en formato de texto de Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/test/{message}")
 def test_bot(message: str):
     """Probar el bot sin WhatsApp"""
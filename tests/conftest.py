@@ -0,0 +1,29 @@
+"""Importa la app sobre una BD temporal, sin Gemini y con la API propia inalcanzable.
+
+Las tools del agente fallan rápido contra API_BASE_URL y usan sus fallbacks en proceso.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["GEMINI_API_KEY"] = ""
+os.environ["API_BASE_URL"] = "http://127.0.0.1:9"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import main as app_main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def main():
+    return app_main
+
+
+@pytest.fixture
+def client(main):
+    from fastapi.testclient import TestClient
+    return TestClient(main.app)
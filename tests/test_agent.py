@@ -0,0 +1,90 @@
+def test_open_ended_request_gets_recommendations_without_gemini(main):
+    agent = main.ai_agent
+    assert agent.model is None
+
+    response = agent.process_message("algo para el verano", "5491100000000")
+
+    assert "RECOMENDADOS" in response
+    assert "PRODUCTOS DISPONIBLES" not in response
+    assert agent_turn(main)["path"] == "rule_based"
+
+
+def test_ver_catalog_still_lists_products(main):
+    response = main.ai_agent._simple_logic("quiero ver los productos")
+    assert "PRODUCTOS DISPONIBLES" in response
+
+
+def agent_turn(main):
+    return main.agent_turn_log.recent()[-1]
+
+
+def test_unexpected_recommend_error_falls_back_to_catalog(main, monkeypatch):
+    agent = main.ai_agent
+    get_catalog_json = agent._get_catalog_json
+
+    def broken(url, params=None):
+        if url.endswith("/products/recommend"):
+            raise ValueError("respuesta inesperada")
+        return get_catalog_json(url, params)
+
+    monkeypatch.setattr(agent, "_get_catalog_json", broken)
+
+    assert agent.recommend_products_api("algo para el verano") is None
+    response = agent._simple_logic("ver productos para el verano")
+    assert "Error temporal" not in response
+    assert "PRODUCTOS" in response
+
+
+def test_direct_fallback_matches_products_endpoint(main, client):
+    api_products = client.get("/products", params={"product_type": "pantalon"}).json()
+    assert api_products
+
+    response = main.ai_agent.get_products_api(filters={"product_type": "pantalon"})
+
+    assert "No se encontraron" not in response
+    assert "RESULTADOS PARA 'PANTALON'" in response
+    assert f"*{api_products[0]['name']}*" in response
+    assert main.product_renderer.render_products(api_products, "pantalon") == response
+
+
+def test_cart_keyword_with_filters_but_no_ids_filters_products(main):
+    intent, confidence, args = main.ai_agent._classify_message("quiero 3 remeras negras")
+    assert intent == "filter_products"
+    assert args["filters"] == {"product_type": "Camiseta", "color": "Negro"}
+    assert confidence > 0.3
+
+
+def test_cart_with_explicit_ids_still_creates_cart(main):
+    intent, confidence, args = main.ai_agent._classify_message("quiero 2 del producto 15")
+    assert intent == "create_cart"
+    assert args["items"] == [{"product_id": 15, "qty": 2}]
+
+
+def test_breaker_rejection_inside_generate_is_not_counted_as_model_call(main, monkeypatch):
+    agent = main.ai_agent
+    stats = main.AgentPathStats()
+    monkeypatch.setattr(main, "agent_stats", stats)
+    monkeypatch.setattr(agent, "model", object())
+
+    def rejected(message):
+        raise main.CircuitOpenError("gemini")
+
+    monkeypatch.setattr(agent, "_process_with_gemini", rejected)
+
+    response = agent.process_message("algo para el verano", "5491100000000")
+
+    assert "RECOMENDADOS" in response
+    assert agent_turn(main)["path"] == "breaker_open"
+    snapshot = stats.snapshot()
+    assert snapshot["paths"]["breaker_open"]["turns"] == 1
+    assert snapshot["paths"]["fallback"]["turns"] == 0
+    assert snapshot["model_free_ratio"] == 1.0
+
+
+def test_fast_path_cart_failure_has_no_success_headline(main):
+    response = main.ai_agent.process_message("quiero 2 del producto 15", "5491100000000")
+
+    assert agent_turn(main)["path"] == "fast_path"
+    assert "He creado" not in response
+    assert response.startswith("❌")
+    assert "HTTPConnectionPool" not in response
@@ -0,0 +1,48 @@
+from email.utils import formatdate
+
+FAR_FUTURE = formatdate(4102444800, usegmt=True)  # 2100-01-01
+
+
+def test_missing_product_is_404_even_with_if_modified_since(client):
+    response = client.get("/products/99999", headers={"If-Modified-Since": FAR_FUTURE})
+    assert response.status_code == 404
+
+
+def test_invalid_query_is_422_even_with_wildcard_etag(client):
+    response = client.get("/products", params={"min_price": "barato"}, headers={"If-None-Match": "*"})
+    assert response.status_code == 422
+
+
+def test_cached_listing_answers_conditionals_with_304(client):
+    first = client.get("/products", params={"product_type": "pantalon"})
+    assert first.status_code == 200
+
+    by_etag = client.get("/products", params={"product_type": "pantalon"},
+                         headers={"If-None-Match": first.headers["etag"]})
+    by_date = client.get("/products", params={"product_type": "pantalon"},
+                         headers={"If-Modified-Since": FAR_FUTURE})
+    assert by_etag.status_code == 304
+    assert by_date.status_code == 304
+    assert by_etag.headers["etag"] == first.headers["etag"]
+
+
+def test_uncached_listing_runs_endpoint_before_304(client, main):
+    main.bump_catalog_version()
+    response = client.get("/products", params={"color": "negro"}, headers={"If-None-Match": "*"})
+    assert response.status_code == 304
+    again = client.get("/products", params={"color": "negro"})
+    assert again.status_code == 200
+    assert again.json()
+
+
+def test_cors_headers_on_cache_miss_hit_and_304(client, main):
+    main.bump_catalog_version()
+    origin = {"Origin": "https://tienda.example"}
+
+    miss = client.get("/products/1", headers=origin)
+    hit = client.get("/products/1", headers=origin)
+    not_modified = client.get("/products/1", headers=dict(origin, **{"If-None-Match": miss.headers["etag"]}))
+
+    assert (miss.status_code, hit.status_code, not_modified.status_code) == (200, 200, 304)
+    for response in (miss, hit, not_modified):
+        assert response.headers["access-control-allow-origin"] == "*"
@@ -0,0 +1,119 @@
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(main, clock):
+    return main.CircuitBreaker("test", failure_rate_threshold=0.5, slow_call_seconds=2.0,
+                               window_size=10, min_calls=4, open_seconds=30.0, clock=clock)
+
+
+def state(breaker):
+    return breaker.snapshot()["state"]
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record_failure()
+    assert state(breaker) == "open"
+
+
+def test_stays_closed_until_min_calls(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    assert state(breaker) == "closed"
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert state(breaker) == "open"
+    assert breaker.is_open()
+    assert not breaker.allow_request()
+    assert breaker.snapshot()["rejected_calls"] == 1
+
+
+def test_opens_only_when_failure_rate_reaches_threshold(breaker):
+    breaker.record_failure()
+    for _ in range(3):
+        breaker.record_success(0.1)
+    breaker.record_failure()
+    assert breaker.snapshot()["failure_rate"] == 0.4
+    assert state(breaker) == "closed"
+
+    breaker.record_failure()
+    assert state(breaker) == "open"
+
+
+def test_slow_successful_calls_count_as_failures(breaker):
+    for _ in range(3):
+        breaker.record_success(1.9)
+    assert breaker.snapshot()["failure_rate"] == 0.0
+
+    for _ in range(4):
+        breaker.record_success(2.0)
+    assert state(breaker) == "open"
+
+
+def test_half_opens_after_reset_timeout(breaker, clock):
+    open_breaker(breaker)
+
+    clock.advance(29.9)
+    assert state(breaker) == "open"
+    assert breaker.snapshot()["retry_in_seconds"] == pytest.approx(0.1)
+
+    clock.advance(0.1)
+    assert state(breaker) == "half_open"
+    assert not breaker.is_open()
+
+
+def test_successful_probe_closes_the_circuit(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(30)
+
+    assert breaker.allow_request()
+    assert breaker.is_open()  # el único sondeo ya está en curso
+    assert not breaker.allow_request()
+
+    breaker.record_success(0.1)
+    snapshot = breaker.snapshot()
+    assert snapshot["state"] == "closed"
+    assert snapshot["window_calls"] == 0
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_for_another_timeout(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(30)
+
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert state(breaker) == "open"
+    assert breaker.snapshot()["times_opened"] == 2
+
+    clock.advance(29)
+    assert not breaker.allow_request()
+    clock.advance(1)
+    assert breaker.allow_request()
+
+
+def test_slow_probe_reopens(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(30)
+
+    assert breaker.allow_request()
+    breaker.record_success(5.0)
+    assert state(breaker) == "open"
@@ -0,0 +1,90 @@
+import json
+import sqlite3
+import zlib
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def test_connection_execute_errors_make_readyz_fail(client, main):
+    conn = main.get_db_connection()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("SELECT * FROM tabla_inexistente")
+        assert client.get("/readyz").status_code == 503
+
+        conn.execute("SELECT 1").fetchone()
+        assert client.get("/readyz").status_code == 200
+    finally:
+        conn.close()
+
+
+def test_connection_shortcuts_are_timed(main):
+    conn = main.get_db_connection()
+    try:
+        assert isinstance(conn.execute("SELECT 1"), main.TimedCursor)
+        assert isinstance(conn.executemany("UPDATE catalog_state SET version = version WHERE 0 = ?", [(1,)]), main.TimedCursor)
+        assert isinstance(conn.executescript("SELECT 1;"), main.TimedCursor)
+    finally:
+        conn.close()
+
+
+def test_unused_product_filter_indexes_are_dropped(main):
+    conn = main.get_db_connection()
+    try:
+        indexes = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'products'")}
+    finally:
+        conn.close()
+    assert not {name for name in indexes if not name.startswith("sqlite_autoindex")}
+
+
+@pytest.fixture
+def retention_db(main, tmp_path, monkeypatch):
+    """BD temporal propia, con auto_vacuum incremental como la deja initialize_database"""
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "retention.db"))
+    conn = main.get_db_connection()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    main.apply_migrations(conn)
+    yield conn
+    conn.close()
+
+
+def test_cart_retention_archives_purges_and_vacuums(main, retention_db):
+    conn = retention_db
+    now = datetime(2026, 6, 1, 12, 0, 0)
+    items = json.dumps([{"product_id": 1, "qty": 1, "note": "x" * 2000}])
+
+    def iso(days_ago):
+        return (now - timedelta(days=days_ago)).isoformat()
+
+    conn.executemany(
+        "INSERT INTO carts (id, items, total_amount, total_items, created_at, updated_at) VALUES (?, ?, 10, 1, ?, ?)",
+        [(cart_id, items, iso(30), iso(8 + cart_id % 5)) for cart_id in range(1, 21)]
+        + [(cart_id, items, iso(30), iso(cart_id % 7)) for cart_id in range(21, 31)]
+    )
+    conn.executemany(
+        "INSERT INTO carts_archive (id, items, total_amount, total_items, created_at, updated_at, archived_at)"
+        " VALUES (?, ?, 10, 1, ?, ?, ?)",
+        [(cart_id, zlib.compress(items.encode() * 20), iso(400), iso(390), iso(200)) for cart_id in range(101, 131)]
+    )
+    conn.commit()
+
+    retention = main.CartRetention(expiry_days=7, archive_retention_days=180, interval_seconds=3600,
+                                   batch_size=7, vacuum_pages=8)
+    result = retention.run_once(now=now, force=True)
+
+    assert result["archived"] == 20
+    assert result["purged"] == 30
+    assert result["vacuumed_pages"] > 0
+    remaining = [row[0] for row in conn.execute("SELECT id FROM carts ORDER BY id")]
+    assert remaining == list(range(21, 31))
+    archive = conn.execute("SELECT id, items, archived_at FROM carts_archive ORDER BY id").fetchall()
+    assert [row[0] for row in archive] == list(range(1, 21))
+    assert zlib.decompress(archive[0][1]).decode() == items
+    assert {row[2] for row in archive} == {now.isoformat()}
+    assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+    # Otra pasada sin nada vencido no mueve filas
+    again = retention.run_once(now=now, force=True)
+    assert (again["archived"], again["purged"], again["vacuumed_pages"]) == (0, 0, 0)
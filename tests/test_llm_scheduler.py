@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+
+def test_quotas_are_split_between_gunicorn_workers(main, monkeypatch):
+    monkeypatch.setattr(main, "WEB_WORKERS", 4)
+    assert main.per_worker_quota(80) == 20
+    assert main.per_worker_quota(15) == 3.75
+
+
+def test_request_bucket_keeps_whole_requests_below_one_rpm(main):
+    scheduler = main.LLMScheduler(requests_per_minute=0.5, tokens_per_minute=1000,
+                                  max_concurrency=1, queue_timeout=1)
+    assert scheduler._requests.capacity == 1.0
+    assert scheduler._requests.rate == 0.5 / 60
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_scheduler(main, clock, rpm=600, tpm=1_000_000, max_concurrency=1, queue_timeout=10):
+    return main.LLMScheduler(requests_per_minute=rpm, tokens_per_minute=tpm, max_concurrency=max_concurrency,
+                             queue_timeout=queue_timeout, expected_output_tokens=100, clock=clock)
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timeout esperando al scheduler"
+        time.sleep(0.001)
+
+
+def wake(scheduler):
+    """Despierta a los hilos en espera para que vuelvan a mirar el reloj falso"""
+    with scheduler._cond:
+        scheduler._cond.notify_all()
+
+
+def start_waiter(scheduler, priority, order, errors):
+    def run():
+        try:
+            with scheduler.slot("x" * 40, priority):
+                order.append(priority)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_token_bucket_refills_with_clock(main):
+    clock = FakeClock()
+    bucket = main.TokenBucket(rate=2.0, capacity=4.0, clock=clock)
+
+    assert bucket.try_acquire(4) == 0.0
+    assert bucket.try_acquire(1) == pytest.approx(0.5)
+    clock.advance(1.0)
+    assert bucket.available == pytest.approx(2.0)
+    clock.advance(10.0)
+    assert bucket.available == pytest.approx(4.0)  # no pasa de la capacidad
+
+
+def test_follow_up_calls_jump_ahead_of_new_turns(main):
+    scheduler = make_scheduler(main, FakeClock())
+    order, errors = [], []
+
+    with scheduler.slot("primer turno"):
+        threads = [start_waiter(scheduler, scheduler.NEW_TURN, order, errors)]
+        wait_until(lambda: scheduler.queue_depth == 1)
+        threads.append(start_waiter(scheduler, scheduler.NEW_TURN, order, errors))
+        wait_until(lambda: scheduler.queue_depth == 2)
+        threads.append(start_waiter(scheduler, scheduler.FOLLOW_UP, order, errors))
+        wait_until(lambda: scheduler.queue_depth == 3)
+
+    for thread in threads:
+        thread.join(5)
+    assert not errors
+    assert order == [scheduler.FOLLOW_UP, scheduler.NEW_TURN, scheduler.NEW_TURN]
+    assert scheduler.snapshot()["max_queue_depth"] == 3
+
+
+def test_requests_per_minute_bucket_refills(main):
+    clock = FakeClock()
+    scheduler = make_scheduler(main, clock, rpm=2)
+    for _ in range(2):
+        with scheduler.slot("hola"):
+            pass
+    assert scheduler._requests.wait_time(1) == pytest.approx(30.0)
+
+    order, errors = [], []
+    thread = start_waiter(scheduler, scheduler.NEW_TURN, order, errors)
+    wait_until(lambda: scheduler.queue_depth == 1)
+    clock.advance(30.0)
+    wake(scheduler)
+    thread.join(5)
+
+    assert order == [scheduler.NEW_TURN] and not errors
+    snapshot = scheduler.snapshot()
+    assert snapshot["rate_limited_waits"] == 1
+    assert snapshot["priorities"]["new_turn"]["max_wait_ms"] == pytest.approx(30000.0)
+
+
+def test_tokens_per_minute_uses_estimate_then_actual_usage(main):
+    clock = FakeClock()
+    scheduler = make_scheduler(main, clock, tpm=600)
+    prompt = "x" * 400
+    estimated = scheduler.estimate_tokens(prompt)
+    assert estimated == 200
+
+    with scheduler.slot(prompt) as slot:
+        assert scheduler._tokens.available == pytest.approx(400)
+        slot.actual_tokens = 500
+    assert scheduler._tokens.available == pytest.approx(100)
+
+    # 10 tokens/s: el siguiente prompt de 200 tokens espera 10s
+    assert scheduler._tokens.wait_time(estimated) == pytest.approx(10.0)
+    clock.advance(10.0)
+    assert scheduler._tokens.wait_time(estimated) == 0.0
+
+
+def test_queue_wait_stats_and_timeouts(main):
+    clock = FakeClock()
+    scheduler = make_scheduler(main, clock, queue_timeout=5)
+    order, errors = [], []
+
+    with scheduler.slot("en curso"):
+        waiter = start_waiter(scheduler, scheduler.FOLLOW_UP, order, errors)
+        wait_until(lambda: scheduler.queue_depth == 1)
+        clock.advance(2.5)
+    waiter.join(5)
+
+    with scheduler.slot("en curso"):
+        late = start_waiter(scheduler, scheduler.NEW_TURN, order, errors)
+        wait_until(lambda: scheduler.queue_depth == 1)
+        clock.advance(5.0)
+        wake(scheduler)
+        late.join(5)
+
+    assert order == [scheduler.FOLLOW_UP]
+    assert len(errors) == 1 and isinstance(errors[0], main.SchedulerTimeoutError)
+    snapshot = scheduler.snapshot()
+    assert snapshot["queue_depth"] == 0
+    assert snapshot["priorities"]["follow_up"] == {
+        "scheduled": 1, "timeouts": 0, "avg_wait_ms": 2500.0, "max_wait_ms": 2500.0
+    }
+    assert snapshot["priorities"]["new_turn"] == {
+        "scheduled": 2, "timeouts": 1, "avg_wait_ms": 0.0, "max_wait_ms": 0.0
+    }
@@ -0,0 +1,48 @@
+import threading
+
+
+def test_delivery_keeps_originating_request_id(main, monkeypatch):
+    sender = main.outbound_sender
+    delivered = threading.Event()
+    seen = []
+
+    def fake_post(recipient, body):
+        seen.append((body, main.request_id_var.get()))
+        delivered.set()
+        return 200, {"messages": [{"id": "wamid.test"}]}, None
+
+    monkeypatch.setattr(sender, "_post", fake_post)
+    token = main.request_id_var.set("webhook-abc123")
+    try:
+        sender.enqueue("5491100000001", "hola desde el test")
+    finally:
+        main.request_id_var.reset(token)
+
+    assert delivered.wait(5)
+    assert seen == [("hola desde el test", "webhook-abc123")]
+
+    conn = main.get_db_connection()
+    try:
+        row = conn.execute("SELECT request_id FROM outbox WHERE body = ?", ("hola desde el test",)).fetchone()
+    finally:
+        conn.close()
+    assert row == ("webhook-abc123",)
+
+
+def test_metrics_scrapes_reuse_the_outbox_table_count(main, client, monkeypatch):
+    connections = []
+    get_db_connection = main.get_db_connection
+
+    def counting():
+        connections.append(1)
+        return get_db_connection()
+
+    monkeypatch.setattr(main, "CATALOG_VERSION_TTL_SECONDS", 3600)  # sin relecturas de catalog_state
+    client.get("/metrics")  # recuento inicial
+    monkeypatch.setattr(main, "get_db_connection", counting)
+    for _ in range(3):
+        assert "outbox_messages" in client.get("/metrics").text
+    assert connections == []
+
+    main.outbound_sender.snapshot()  # /debug/outbox siempre recuenta
+    assert connections == [1]
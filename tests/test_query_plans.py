@@ -0,0 +1,123 @@
+"""Semántica de los filtros de GET /products y planes de las consultas que ese endpoint ejecuta.
+
+GET /products filtra sobre el índice de facetas en memoria; a SQLite solo llegan la
+lectura de la versión de catálogo, la carga del catálogo al reconstruir el índice
+y la lectura por IDs (`ids=`). Se capturan con el trace de SQLite y se verifica el
+plan de cada una.
+"""
+import sqlite3
+import unicodedata
+
+import pytest
+
+
+def fold(text):
+    """Sin acentos ni mayúsculas, independiente de normalize_message"""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).lower()
+
+
+@pytest.fixture(scope="module")
+def catalog(main):
+    conn = sqlite3.connect(main.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute("SELECT * FROM products ORDER BY id")]
+    conn.close()
+    return rows
+
+
+def expected_ids(catalog, q=None, min_price=None, max_price=None, in_stock=None, **facets):
+    ids = []
+    for product in catalog:
+        if any(fold(product[facet]) != fold(value) for facet, value in facets.items()):
+            continue
+        if min_price is not None and product["price"] < min_price:
+            continue
+        if max_price is not None and product["price"] > max_price:
+            continue
+        if in_stock is not None and (product["stock"] > 0) != in_stock:
+            continue
+        if q and fold(q) not in fold(f"{product['name']} {product['description']}"):
+            continue
+        ids.append(product["id"])
+    return ids
+
+
+FILTER_CASES = [
+    {"product_type": "pantalon"},
+    {"product_type": "PANTALÓN"},
+    {"category": "deportivo", "color": "negro"},
+    {"size": "xl", "in_stock": True},
+    {"in_stock": False},
+    {"min_price": 500, "max_price": 900},
+    {"min_price": 1058, "max_price": 1058},
+    {"q": "comoda"},
+    {"q": "Cómoda", "category": "Deportivo", "max_price": 1000},
+    {"color": "violeta"},
+]
+
+
+@pytest.mark.parametrize("filters", FILTER_CASES, ids=lambda filters: str(filters))
+def test_products_filter_semantics(client, catalog, filters):
+    response = client.get("/products", params=filters)
+    assert response.status_code == 200
+    assert [product["id"] for product in response.json()] == expected_ids(catalog, **filters)
+
+
+def test_accented_and_plain_filters_agree(client):
+    plain = client.get("/products", params={"product_type": "pantalon"}).json()
+    accented = client.get("/products", params={"product_type": "Pantalón"}).json()
+    assert plain and plain == accented
+
+
+@pytest.fixture
+def traced_sql(main, monkeypatch):
+    """SELECT ejecutados por las conexiones de la app mientras dura el test"""
+    statements = []
+    get_db_connection = main.get_db_connection
+
+    def traced():
+        conn = get_db_connection()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(main, "get_db_connection", traced)
+    yield statements
+
+
+def plans(main, statements):
+    conn = sqlite3.connect(main.DB_PATH)
+    try:
+        return {sql: main.explain_query_plan(conn, sql) for sql in dict.fromkeys(statements)
+                if sql.lstrip().upper().startswith("SELECT")}
+    finally:
+        conn.close()
+
+
+def test_products_endpoint_queries_use_indexes(client, main, traced_sql):
+    main.bump_catalog_version()  # fuerza la reconstrucción del índice
+    main._catalog_state = main._catalog_state[:2] + (float("-inf"),)  # y la relectura de la versión
+    traced_sql.clear()
+
+    assert client.get("/products", params={"product_type": "pantalon", "in_stock": True}).status_code == 200
+    assert client.get("/products", params={"ids": "3,1,2"}).status_code == 200
+
+    query_plans = plans(main, traced_sql)
+    assert any("FROM catalog_state" in sql for sql in query_plans)
+    assert any("FROM products ORDER BY id" in sql for sql in query_plans)
+    assert any("WHERE id IN" in sql for sql in query_plans)
+    for sql, plan in query_plans.items():
+        assert not any("TEMP B-TREE" in step for step in plan), (sql, plan)
+        if "WHERE" in sql:
+            assert not main.full_scans(plan), (sql, plan)
+        else:
+            # Única consulta sin WHERE: la carga completa del catálogo, en orden de rowid
+            assert "FROM products ORDER BY id" in sql, (sql, plan)
+
+
+def test_filtered_requests_do_not_query_sqlite(client, main, traced_sql):
+    client.get("/products", params={"color": "azul"})  # índice ya construido para esta versión
+    traced_sql.clear()
+    for filters in FILTER_CASES:
+        client.get("/products", params=filters)
+    assert not [sql for sql in traced_sql if "FROM products" in sql]